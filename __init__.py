@@ -6,10 +6,12 @@
 
 from config import ENGINE
 
-AVAILABLE_ENGINES = ["meili", "mongo", "zinc"]
+AVAILABLE_ENGINES = ["meili", "sqlite"]
 
 if ENGINE == "meili":
     print("Using MeiliSearch as search engine")
+elif ENGINE == "sqlite":
+    print("Using SQLite FTS5 as search engine")
 # elif ENGINE == "mongo":
 #     print("Using MongoDB as search engine")
 #     from mongo import SearchEngine
@@ -0,0 +1,332 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+# client.py 的 asyncio 版本：消息处理、历史同步和写入索引都是同一个事件循环中的 task，
+# 处理器只把消息放进内存缓冲区，由后台 task 合并成 pipeline 写入 Redis。
+# 与 client.py 使用同一个 Telegram 会话和队列，二者只能运行一个。
+
+import asyncio
+import logging
+import time
+
+import redis
+import redis.asyncio as aioredis
+from pyrogram import Client, filters, idle, types
+
+import metrics
+from async_queue import get_async_queue, AsyncCoalescingQueue
+from message_queue import DEAD_LETTER_KEY
+from engine import SearchEngine
+from queue_codec import decode_message, serialize_message, get_doc_id
+from rate_control import AdaptiveRateLimiter
+from sync_config import ChatFilter, load_config, load_sync_status, get_chat_id
+from sync_checkpoint import AsyncCheckpointStore, Checkpoint, legacy_checkpoint
+from fingerprint import AsyncFingerprintIndex
+from sync_scheduler import AsyncSyncScheduler, ChatSync
+from config import BOT_ID, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, BATCH_SIZE, BATCH_FLUSH_INTERVAL, \
+    MAX_INDEX_LAG, METRICS_HOST, CLIENT_METRICS_PORT, INDEX_TARGET_LAG, INDEX_WORKERS, SKIP_UNCHANGED
+from init_client import get_client
+from utils import setup_logger
+
+setup_logger()
+
+app = get_client()
+tgdb = SearchEngine()
+
+r = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD)
+message_queue = get_async_queue(r)
+checkpoints = AsyncCheckpointStore(r)
+fingerprints = AsyncFingerprintIndex(r) if SKIP_UNCHANGED else None
+limiter = AdaptiveRateLimiter()
+chat_filter = ChatFilter()
+
+messages_received = metrics.counter("searchgram_messages_received_total", "New and edited messages received")
+messages_skipped = metrics.counter("searchgram_messages_skipped_total", "Messages skipped by whitelist/blacklist")
+upsert_batches = metrics.counter("searchgram_upsert_batches_total", "Batches written to the search engine")
+upsert_documents = metrics.counter("searchgram_upsert_documents_total", "Documents written to the search engine")
+documents_unchanged = metrics.counter("searchgram_documents_unchanged_total",
+                                      "Documents skipped because their content has not changed")
+upsert_failures = metrics.counter("searchgram_upsert_failed_batches_total", "Batches put back into the queue")
+rate_limit_wait = metrics.histogram("searchgram_rate_limit_wait_seconds", "Time a batch waits for the rate limiter")
+upsert_latency = metrics.histogram("searchgram_upsert_seconds", "Time spent submitting a batch")
+push_batch_size = metrics.histogram("searchgram_queue_push_batch_size", "Messages written to Redis per pipeline",
+                                    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+metrics.gauge("searchgram_index_lag", "Search engine tasks not yet processed", lambda: tgdb.tasks.lag())
+metrics.gauge("searchgram_index_rate", "Current indexing rate limit in batches per second", lambda: limiter.rate)
+metrics.gauge("searchgram_index_rate_min", "Lower bound of the indexing rate", lambda: limiter.min_rate)
+metrics.gauge("searchgram_index_rate_max", "Upper bound of the indexing rate", lambda: limiter.max_rate)
+
+
+class QueueWriter:
+    """处理器调用 push 不等待 Redis，后台 task 把期间积累的消息通过一个 pipeline 写入"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.buffer = []
+        self.ready = asyncio.Event()
+
+    def push(self, payload, doc_id=None):
+        self.buffer.append((payload, doc_id))
+        self.ready.set()
+
+    async def run(self, stop):
+        while True:
+            if not self.buffer:
+                if stop.is_set():
+                    return
+                try:
+                    await asyncio.wait_for(self.ready.wait(), 1)
+                except asyncio.TimeoutError:
+                    continue
+            self.ready.clear()
+            items, self.buffer = self.buffer, []
+            try:
+                await self.queue.push_many(items)
+                push_batch_size.observe(len(items))
+            except redis.RedisError as e:
+                logging.error(f"Error pushing {len(items)} messages to Redis: {str(e)}")
+                # 放回缓冲区开头，保持顺序
+                self.buffer[:0] = items
+                await asyncio.sleep(1)
+
+
+writer = QueueWriter(message_queue)
+
+
+def is_allowed(chat_id, chat_type):
+    return chat_filter.is_allowed(chat_id, chat_type)
+
+
+@app.on_edited_message(~filters.chat(BOT_ID))
+async def message_edit_handler(client: Client, message: types.Message):
+    messages_received.inc()
+    if is_allowed(message.chat.id, message.chat.type):
+        logging.info("Editing old message: %s-%s", message.chat.id, message.id)
+        writer.push(serialize_message(message), get_doc_id(message))
+    else:
+        messages_skipped.inc()
+        logging.info("Skipping edited message from chat %s (type: %s) due to whitelist/blacklist", message.chat.id,
+                     message.chat.type)
+
+
+@app.on_message((filters.outgoing | filters.incoming) & ~filters.chat(BOT_ID))
+async def message_handler(client: Client, message: types.Message):
+    messages_received.inc()
+    if is_allowed(message.chat.id, message.chat.type):
+        logging.info("Adding new message: %s-%s", message.chat.id, message.id)
+        writer.push(serialize_message(message), get_doc_id(message))
+    else:
+        messages_skipped.inc()
+        logging.info("Skipping message from chat %s (type: %s) due to whitelist/blacklist", message.chat.id,
+                     message.chat.type)
+
+
+async def rate_limited_upsert(messages):
+    # meilisearch-python 是同步的，写入请求在线程池中执行，其余等待都在事件循环中
+    with rate_limit_wait.time():
+        await asyncio.sleep(max(limiter.reserve(), 0))
+        await wait_for_index_lag()
+    with upsert_latency.time():
+        task = await asyncio.to_thread(tgdb.upsert_many, messages)
+    await asyncio.to_thread(tgdb.tasks.poll, tgdb.tasks.lag() > INDEX_TARGET_LAG)
+    limiter.feedback(tgdb.tasks.lag(), tgdb.tasks.latency, error=task is None)
+    return task
+
+
+async def upsert_changed(messages):
+    # 跳过内容没有变化的消息，返回提交的条数，提交失败时返回 None
+    changed = messages
+    if fingerprints:
+        try:
+            changed = await fingerprints.changed(messages)
+        except redis.RedisError as e:
+            logging.warning(f"Cannot check document fingerprints, writing all: {str(e)}")
+        documents_unchanged.inc(len(messages) - len(changed))
+    if not changed:
+        return 0
+    if await rate_limited_upsert(changed) is None:
+        return None
+    return len(changed)
+
+
+async def record_fingerprints(documents):
+    # 写入任务成功后才记录指纹，重试后仍失败而被丢弃的文档不会被当作已写入
+    try:
+        await fingerprints.record(documents)
+    except redis.RedisError as e:
+        logging.warning(f"Cannot record document fingerprints: {str(e)}")
+
+
+async def wait_for_index_lag():
+    while tgdb.tasks.lag() > MAX_INDEX_LAG:
+        wait = tgdb.tasks.drain_time(tgdb.tasks.lag() - MAX_INDEX_LAG)
+        logging.info("MeiliSearch is %s tasks behind, waiting %.1fs", tgdb.tasks.lag(), wait)
+        await asyncio.sleep(wait)
+        await asyncio.to_thread(tgdb.tasks.poll, True)
+
+
+async def dead_letter(handle, payload, error):
+    # 无法解码的消息重新投递也会失败，移到死信列表后确认
+    logging.error(f"Cannot decode queued message, moving it to {DEAD_LETTER_KEY}: {str(error)}")
+    try:
+        await r.rpush(DEAD_LETTER_KEY, payload)
+        await message_queue.ack([handle])
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logging.error(f"Error moving message to {DEAD_LETTER_KEY}: {str(e)}")
+
+
+async def process_queue(stop):
+    batch = []
+    handles = []
+    deadline = 0
+    while True:
+        stopping = stop.is_set()
+        if stopping and not batch:
+            return
+        try:
+            await asyncio.to_thread(tgdb.tasks.poll)
+        except Exception as e:
+            # 查询任务或任务完成后的回调（如记录指纹）失败不应中断索引循环，下次再查询
+            logging.error(f"Error polling index tasks: {str(e)}")
+        timeout = max(deadline - time.time(), 0.1) if batch else 1
+        try:
+            entries = await message_queue.pop(BATCH_SIZE - len(batch), timeout) if not stopping else []
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            # Redis 短暂不可用时继续提交手上的批次，之后重试
+            logging.error(f"Error reading from the queue: {str(e)}")
+            entries = []
+            await asyncio.sleep(1)
+        if entries:
+            if not batch:
+                deadline = time.time() + BATCH_FLUSH_INTERVAL
+            for handle, payload in entries:
+                try:
+                    message = decode_message(payload)
+                except Exception as e:
+                    await dead_letter(handle, payload, e)
+                    continue
+                handles.append(handle)
+                batch.append(message)
+
+        if batch and (len(batch) >= BATCH_SIZE or time.time() >= deadline or stopping):
+            written = await upsert_changed(batch)
+            try:
+                if written is not None:
+                    await message_queue.ack(handles)
+                else:
+                    await message_queue.nack(handles)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                # 确认失败的消息之后会被重新投递，重复写入索引不影响结果
+                logging.error(f"Error acknowledging {len(handles)} messages: {str(e)}")
+            if written:
+                upsert_batches.inc()
+                upsert_documents.inc(written)
+            elif written is None:
+                upsert_failures.inc()
+                if not stopping:
+                    await asyncio.sleep(1)
+            batch = []
+            handles = []
+
+
+last_edit = 0
+
+
+async def safe_edit(msg, new_text, force=False):
+    # 进度消息最多每 2 秒编辑一次
+    global last_edit
+    if force or time.time() - last_edit >= 2:
+        last_edit = time.time()
+        await msg.edit_text(new_text)
+
+
+async def migrate_legacy_checkpoint(uid, chat_id, sync_status, budget):
+    # 聊天还没有检查点时，把旧版本的同步进度迁移过来，只执行一次
+    status = sync_status.get(uid, {})
+    legacy_id = await checkpoints.load_legacy(uid)
+    if not status and not legacy_id:
+        return Checkpoint()
+    await budget.acquire_async()
+    head_id = 0
+    async for msg in app.get_chat_history(chat_id, limit=1):
+        head_id = msg.id
+    checkpoint = legacy_checkpoint(legacy_id, status, head_id) or Checkpoint()
+    logging.info(f"Migrated the legacy sync progress of {uid} to {checkpoint}")
+    await checkpoints.save(chat_id, checkpoint)
+    return checkpoint
+
+
+async def sync_history():
+    config = load_config()
+    if not config.has_section("sync"):
+        return
+    saved = await app.send_message("me", "Starting to sync history...")
+    sync_status = load_sync_status()
+
+    async def on_progress(chat_sync):
+        logging.info(f"Synced {chat_sync.synced} messages for {chat_sync.uid} ({chat_sync.phase}), {chat_sync.checkpoint}")
+        await safe_edit(saved, f"Syncing history...\n{scheduler.summary()}")
+
+    scheduler = AsyncSyncScheduler(app, lambda msg: writer.push(serialize_message(msg), get_doc_id(msg)),
+                                   checkpoints, on_progress)
+
+    for uid in config.options("sync"):
+        try:
+            await scheduler.budget.acquire_async()
+            chat = await app.get_chat(get_chat_id(uid))
+            if not is_allowed(chat.id, chat.type):
+                logging.info(f"Skipping sync for chat {uid} due to whitelist/blacklist")
+                continue
+
+            if await checkpoints.exists(chat.id):
+                checkpoint = await checkpoints.load(chat.id)
+            else:
+                checkpoint = await migrate_legacy_checkpoint(uid, chat.id, sync_status, scheduler.budget)
+            total = 0
+            if not checkpoint.backfilled and not checkpoint.low:
+                await scheduler.budget.acquire_async()
+                total = await app.get_chat_history_count(chat.id)
+
+            scheduler.add(ChatSync(uid, chat.id, checkpoint, total))
+        except Exception as e:
+            logging.error(f"Error syncing history for {uid}: {str(e)}")
+            await safe_edit(saved, f"Error syncing {uid}: {str(e)}", force=True)
+
+    await scheduler.run()
+
+    log = "Sync history complete"
+    logging.info(log)
+    await safe_edit(saved, f"{log}\n{scheduler.summary()}", force=True)
+
+
+async def main():
+    stop = asyncio.Event()
+    metrics.start_http_server(CLIENT_METRICS_PORT, METRICS_HOST)
+    await app.start()
+    if fingerprints:
+        # 任务状态在线程池中查询，回调交回事件循环执行
+        loop = asyncio.get_running_loop()
+        tgdb.tasks.on_succeeded = lambda documents: asyncio.run_coroutine_threadsafe(
+            record_fingerprints(documents), loop)
+
+    # 合并队列可以多个 task 并行消费；否则只用一个，保证同一条消息按顺序写入
+    workers = INDEX_WORKERS if isinstance(message_queue, AsyncCoalescingQueue) else 1
+    writer_task = asyncio.create_task(writer.run(stop))
+    index_tasks = [asyncio.create_task(process_queue(stop)) for _ in range(workers)]
+    sync_task = asyncio.create_task(sync_history())
+    logging.info("Async client started with %s index workers", workers)
+
+    await idle()
+
+    logging.info("Stopping, flushing buffered messages and in-flight batches")
+    sync_task.cancel()
+    await asyncio.gather(sync_task, return_exceptions=True)
+    await app.stop()
+    stop.set()
+    await writer_task
+    await asyncio.gather(*index_tasks)
+    await r.close()
+
+
+if __name__ == "__main__":
+    app.run(main())
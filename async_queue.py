@@ -0,0 +1,212 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import logging
+import time
+
+import redis
+
+from config import QUEUE_TRANSPORT, STREAM_CONSUMER_NAME, STREAM_CLAIM_IDLE, QUEUE_COALESCE
+from message_queue import QUEUE_KEY, STREAM_KEY, STREAM_GROUP, PENDING_KEY, REF_PREFIX, COMPARE_AND_DELETE, \
+    COALESCE_PUSH
+
+
+class AsyncListQueue:
+    """ListQueue 的 redis.asyncio 版本，push_many 用一条 LPUSH 写入多条消息"""
+
+    kind = "list"
+
+    def __init__(self, r, key=QUEUE_KEY):
+        self.r = r
+        self.key = key
+
+    async def push_many(self, items):
+        # items 为 [(payload, doc_id)]
+        if items:
+            await self.r.lpush(self.key, *[payload for payload, _ in items])
+
+    async def pop(self, count, timeout=0):
+        payloads = await self.r.rpop(self.key, count)
+        if not payloads and timeout:
+            item = await self.r.brpop(self.key, timeout=timeout)
+            payloads = [item[1]] if item else []
+        return [(payload, payload) for payload in payloads or []]
+
+    async def ack(self, handles):
+        pass
+
+    async def nack(self, handles):
+        if handles:
+            await self.r.rpush(self.key, *reversed(handles))
+
+    async def length(self):
+        return await self.r.llen(self.key)
+
+
+class AsyncStreamQueue:
+    """StreamQueue 的 redis.asyncio 版本，push_many 通过一个 pipeline 写入"""
+
+    kind = "stream"
+
+    def __init__(self, r, key=STREAM_KEY, group=STREAM_GROUP, consumer=STREAM_CONSUMER_NAME,
+                 claim_idle=STREAM_CLAIM_IDLE):
+        self.r = r
+        self.key = key
+        self.group = group
+        self.consumer = consumer
+        self.claim_idle_ms = int(claim_idle * 1000)
+        self.claim_start = "0-0"
+        self.last_claim = 0
+        self.read_id = "0"
+        self.group_ready = False
+
+    async def ensure_group(self):
+        try:
+            await self.r.xgroup_create(self.key, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self.group_ready = True
+
+    async def push_many(self, items):
+        if not items:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for payload, _ in items:
+            pipe.xadd(self.key, {"m": payload})
+        await pipe.execute()
+
+    async def pop(self, count, timeout=0):
+        if not self.group_ready:
+            await self.ensure_group()
+        entries = await self.reclaim(count)
+        if entries:
+            return entries
+
+        # block=0 表示一直阻塞，不足 1 毫秒的超时按 1 毫秒处理
+        block = max(int(timeout * 1000), 1) if timeout and self.read_id == ">" else None
+        try:
+            response = await self.r.xreadgroup(self.group, self.consumer, {self.key: self.read_id}, count=count,
+                                               block=block)
+        except redis.ResponseError as e:
+            if "NOGROUP" not in str(e):
+                raise
+            await self.ensure_group()
+            return []
+
+        messages = response[0][1] if response else []
+        if self.read_id != ">":
+            if messages:
+                self.read_id = messages[-1][0]
+            else:
+                self.read_id = ">"
+        return await self._payloads(messages)
+
+    async def reclaim(self, count):
+        now = time.time()
+        if now - self.last_claim < self.claim_idle_ms / 1000:
+            return []
+        self.last_claim = now
+        response = await self.r.xautoclaim(self.key, self.group, self.consumer, self.claim_idle_ms,
+                                           start_id=self.claim_start, count=count)
+        self.claim_start = response[0]
+        entries = await self._payloads(response[1])
+        if entries:
+            logging.warning("Reclaimed %s stale entries from %s", len(entries), self.key)
+        return entries
+
+    async def _payloads(self, messages):
+        entries = []
+        deleted = []
+        for entry_id, fields in messages:
+            if fields:
+                entries.append((entry_id, fields[b"m"]))
+            else:
+                deleted.append(entry_id)
+        await self.ack(deleted)
+        return entries
+
+    async def ack(self, entry_ids):
+        if not entry_ids:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        pipe.xack(self.key, self.group, *entry_ids)
+        pipe.xdel(self.key, *entry_ids)
+        await pipe.execute()
+
+    async def nack(self, entry_ids):
+        pass
+
+    async def length(self):
+        return await self.r.xlen(self.key)
+
+
+class AsyncCoalescingQueue:
+    """CoalescingQueue 的 redis.asyncio 版本，与同步版本使用相同的键，两者可以互相消费"""
+
+    def __init__(self, r, transport, key=PENDING_KEY):
+        self.r = r
+        self.transport = transport
+        self.key = key
+        self.compare_and_delete = r.register_script(COMPARE_AND_DELETE)
+        self.coalesce_push = r.register_script(COALESCE_PUSH)
+
+    async def push_many(self, items):
+        # items 为 [(payload, doc_id)]；每个文档的内容和引用由一个脚本原子地写入，所有脚本通过一个 pipeline 发送
+        pipe = self.r.pipeline(transaction=False)
+        for payload, doc_id in items:
+            if doc_id is not None:
+                await self.coalesce_push(keys=[self.key, self.transport.key],
+                                         args=[doc_id, payload, REF_PREFIX + doc_id.encode(), self.transport.kind],
+                                         client=pipe)
+        if any(doc_id is not None for _, doc_id in items):
+            await pipe.execute()
+        await self.transport.push_many([(payload, None) for payload, doc_id in items if doc_id is None])
+
+    async def pop(self, count, timeout=0):
+        entries = await self.transport.pop(count, timeout)
+        doc_ids = [payload[len(REF_PREFIX):].decode() for _, payload in entries if payload.startswith(REF_PREFIX)]
+        payloads = dict(zip(doc_ids, await self.r.hmget(self.key, doc_ids))) if doc_ids else {}
+
+        result = []
+        processed = []
+        for handle, payload in entries:
+            if not payload.startswith(REF_PREFIX):
+                result.append(((handle, None, None), payload))
+                continue
+            doc_id = payload[len(REF_PREFIX):].decode()
+            latest = payloads.get(doc_id)
+            if latest is None:
+                processed.append(handle)
+                continue
+            result.append(((handle, doc_id, latest), latest))
+        await self.transport.ack(processed)
+        return result
+
+    async def ack(self, handles):
+        pipe = self.r.pipeline(transaction=False)
+        doc_ids = [doc_id for _, doc_id, _ in handles if doc_id is not None]
+        for _, doc_id, payload in handles:
+            if doc_id is not None:
+                await self.compare_and_delete(keys=[self.key], args=[doc_id, payload], client=pipe)
+        results = await pipe.execute() if doc_ids else []
+        # 处理期间写入了新版本，重新入队
+        await self.transport.push_many([(REF_PREFIX + doc_id.encode(), None)
+                                        for doc_id, result in zip(doc_ids, results) if result < 0])
+        await self.transport.ack([handle for handle, _, _ in handles])
+
+    async def nack(self, handles):
+        await self.transport.nack([handle for handle, _, _ in handles])
+
+    async def length(self):
+        return await self.transport.length()
+
+
+def get_async_queue(r):
+    if QUEUE_TRANSPORT == "stream":
+        transport = AsyncStreamQueue(r)
+    else:
+        transport = AsyncListQueue(r)
+    if QUEUE_COALESCE:
+        return AsyncCoalescingQueue(r, transport)
+    return transport
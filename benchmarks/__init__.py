@@ -0,0 +1,4 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - benchmarks/__init__.py
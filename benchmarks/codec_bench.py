@@ -0,0 +1,49 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+# 对比队列消息编码的大小和编解码耗时
+# 用法: python -m benchmarks.codec_bench [消息数量]
+
+import json
+import sys
+import time
+
+from benchmarks.synthetic import generate_message_dicts
+from queue_codec import decode_message, encode_message
+
+
+def bench(name, messages, encode):
+    start = time.perf_counter()
+    payloads = [encode(message) for message in messages]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for payload in payloads:
+        decode_message(payload)
+    decode_time = time.perf_counter() - start
+
+    size = sum(len(payload) for payload in payloads)
+    count = len(messages)
+    return {
+        "codec": name,
+        "bytes_per_message": round(size / count, 1),
+        "encode_us": round(encode_time / count * 1e6, 2),
+        "decode_us": round(decode_time / count * 1e6, 2),
+    }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    messages = generate_message_dicts(count)
+    for message in messages[:100]:
+        assert decode_message(encode_message(message, "msgpack")) == message
+
+    results = [
+        bench("json", messages, lambda message: json.dumps(message).encode()),
+        bench("msgpack", messages, lambda message: encode_message(message, "msgpack")),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - benchmarks/fake_meili.py
+# 基准测试使用的本地 MeiliSearch 替身，实现 SearchEngine 用到的接口，所有任务立即完成
+
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FILTER_CONDITION = re.compile(r"^\s*([\w.]+)\s*(>=|<=|=|<)\s*(.+?)\s*$")
+# 与 MeiliSearch pagination.maxTotalHits 的默认值相同
+MAX_TOTAL_HITS = 1000
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _field(document, path):
+    for key in path.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def _matches(document, conditions):
+    for path, op, value in conditions:
+        current = _field(document, path)
+        if op == "=":
+            if str(current) != value:
+                return False
+        elif current is None:
+            return False
+        elif op == ">=" and current < float(value):
+            return False
+        elif op == "<" and current >= float(value):
+            return False
+        elif op == "<=" and current > float(value):
+            return False
+    return True
+
+
+def _project(document, attributes):
+    if not attributes or "*" in attributes:
+        return dict(document)
+    result = {}
+    for attribute in attributes:
+        value = _field(document, attribute)
+        if value is None:
+            continue
+        *parents, name = attribute.split(".")
+        target = result
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[name] = value
+    return result
+
+
+class FakeMeili:
+    """内存中的索引和任务，只做简单的子串匹配"""
+
+    def __init__(self, add_latency=0):
+        # 模拟写入文档请求的耗时（秒）
+        self.add_latency = add_latency
+        self.indexes = {}
+        self.documents = {}
+        self.settings = {}
+        self.tasks = {}
+        self.add_requests = 0
+        self.last_update = _now()
+        self.lock = threading.Lock()
+
+    def task(self, index_uid, task_type, details=None):
+        now = _now()
+        uid = len(self.tasks)
+        self.tasks[uid] = {
+            "uid": uid, "indexUid": index_uid, "status": "succeeded", "type": task_type, "details": details,
+            "error": None, "canceledBy": None, "duration": "PT0S", "enqueuedAt": now, "startedAt": now,
+            "finishedAt": now,
+        }
+        return 202, {"taskUid": uid, "indexUid": index_uid, "status": "enqueued", "type": task_type,
+                     "enqueuedAt": now}
+
+    def create_index(self, uid, primary_key="ID"):
+        self.indexes.setdefault(uid, {"uid": uid, "primaryKey": primary_key, "createdAt": _now(),
+                                      "updatedAt": _now()})
+        self.documents.setdefault(uid, {})
+        self.settings.setdefault(uid, {})
+
+    def document_count(self, uid="telegram"):
+        with self.lock:
+            return len(self.documents.get(uid, {}))
+
+    def handle(self, method, path, query, body):
+        with self.lock:
+            return self._handle(method, path.strip("/").split("/"), query, body)
+
+    def _handle(self, method, parts, query, body):
+        if parts == ["stats"]:
+            return 200, {"databaseSize": 0, "lastUpdate": self.last_update,
+                         "indexes": {uid: {"numberOfDocuments": len(docs)} for uid, docs in self.documents.items()}}
+        if parts[0] == "tasks":
+            if len(parts) == 2:
+                task = self.tasks.get(int(parts[1]))
+                return (200, task) if task else self.error(404, "task_not_found")
+            uids = [int(uid) for uid in ",".join(query.get("uids", [])).split(",") if uid]
+            results = [self.tasks[uid] for uid in uids if uid in self.tasks]
+            return 200, {"results": results, "limit": len(results), "from": None, "next": None}
+        if parts == ["indexes"] and method == "POST":
+            self.create_index(body["uid"], body.get("primaryKey"))
+            return self.task(body["uid"], "indexCreation")
+
+        uid = parts[1]
+        if uid not in self.indexes:
+            # 与 MeiliSearch 相同，写入文档时自动创建索引
+            if parts[2:3] != ["documents"] or method != "POST":
+                return self.error(404, "index_not_found")
+            self.create_index(uid, query.get("primaryKey", ["ID"])[0])
+        if len(parts) == 2:
+            return 200, self.indexes[uid]
+        if parts[2] == "settings":
+            if method == "PATCH":
+                self.settings[uid].update(body)
+                return self.task(uid, "settingsUpdate")
+            return 200, self.settings[uid]
+        if parts[2] == "search":
+            return 200, self.search(uid, body)
+        if parts[2] == "documents":
+            documents = self.documents[uid]
+            if method == "POST" and len(parts) == 3:
+                for document in body:
+                    documents[str(document["ID"])] = document
+                self.add_requests += 1
+                self.last_update = _now()
+                return self.task(uid, "documentAdditionOrUpdate", {"receivedDocuments": len(body)})
+            if method == "GET" and len(parts) == 4:
+                document = documents.get(parts[3])
+                return (200, document) if document else self.error(404, "document_not_found")
+        return self.error(404, "not_found")
+
+    def search(self, uid, params):
+        start = time.perf_counter()
+        terms = (params.get("q") or "").strip('"').lower().split()
+        conditions = [FILTER_CONDITION.match(part).groups() for part in (params.get("filter") or "").split(" AND ")
+                      if part]
+        hits = []
+        for document in self.documents[uid].values():
+            body = f"{document.get('text') or ''} {document.get('caption') or ''}".lower()
+            if all(term in body for term in terms) and _matches(document, conditions):
+                hits.append(document)
+        hits.sort(key=lambda document: document.get("timestamp") or 0, reverse=True)
+
+        page_size = params.get("hitsPerPage", 20)
+        page = params.get("page", 1)
+        if "limit" in params:
+            # offset/limit 分页最多返回前 MAX_TOTAL_HITS 条
+            offset = params.get("offset", 0)
+            selected = hits[:MAX_TOTAL_HITS][offset:offset + params["limit"]]
+        else:
+            selected = hits[(page - 1) * page_size:page * page_size]
+        crop = params.get("cropLength", 10)
+        results = []
+        for document in selected:
+            hit = _project(document, params.get("attributesToRetrieve"))
+            if params.get("attributesToCrop"):
+                hit["_formatted"] = {
+                    attribute: " ".join((document.get(attribute) or "").split()[:crop])
+                    for attribute in params["attributesToCrop"]
+                }
+            results.append(hit)
+        return {
+            "hits": results, "query": params.get("q"), "processingTimeMs": int((time.perf_counter() - start) * 1000),
+            "hitsPerPage": page_size, "page": page, "totalPages": (len(hits) - 1) // page_size + 1,
+            "totalHits": len(hits),
+        }
+
+    @staticmethod
+    def error(status, code):
+        return status, {"message": code.replace("_", " "), "code": code, "type": "invalid_request", "link": ""}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        if self.command == "POST" and url.path.endswith("/documents"):
+            time.sleep(self.server.meili.add_latency)
+        status, response = self.server.meili.handle(self.command, url.path, parse_qs(url.query), body)
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host="127.0.0.1", port=0, add_latency=0):
+    # 端口为 0 时由系统分配，返回 (server, url)
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.meili = FakeMeili(add_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
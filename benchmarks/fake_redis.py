@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - benchmarks/fake_redis.py
+# 基准测试使用的内存 Redis，只实现队列用到的列表、哈希和字符串命令
+
+import threading
+import time
+from collections import deque
+
+from message_queue import COMPARE_AND_DELETE, COALESCE_PUSH
+from sync_checkpoint import SAVE_CHECKPOINT, SET_HIGH
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class MemoryRedis:
+    """线程安全的内存 Redis 替身，不需要启动 redis-server"""
+
+    def __init__(self, *args, **kwargs):
+        self.data = {}
+        self.expires = {}
+        self.cond = threading.Condition()
+
+    def _get(self, key, factory=None):
+        key = _bytes(key)
+        if key in self.expires and self.expires[key] <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        if key not in self.data and factory:
+            self.data[key] = factory()
+        return self.data.get(key)
+
+    def lpush(self, key, *values):
+        with self.cond:
+            items = self._get(key, deque)
+            items.extendleft(_bytes(value) for value in values)
+            self.cond.notify_all()
+            return len(items)
+
+    def rpush(self, key, *values):
+        with self.cond:
+            items = self._get(key, deque)
+            items.extend(_bytes(value) for value in values)
+            self.cond.notify_all()
+            return len(items)
+
+    def rpop(self, key, count=None):
+        with self.cond:
+            items = self._get(key)
+            if not items:
+                return None
+            if count is None:
+                return items.pop()
+            return [items.pop() for _ in range(min(count, len(items)))]
+
+    def brpop(self, key, timeout=0):
+        deadline = time.time() + timeout if timeout else None
+        with self.cond:
+            while not self._get(key):
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            return _bytes(key), self._get(key).pop()
+
+    def llen(self, key):
+        with self.cond:
+            return len(self._get(key) or ())
+
+    def hset(self, key, field, value):
+        with self.cond:
+            table = self._get(key, dict)
+            added = _bytes(field) not in table
+            table[_bytes(field)] = _bytes(value)
+            return int(added)
+
+    def hget(self, key, field):
+        with self.cond:
+            return (self._get(key) or {}).get(_bytes(field))
+
+    def hmget(self, key, fields):
+        with self.cond:
+            table = self._get(key) or {}
+            return [table.get(_bytes(field)) for field in fields]
+
+    def hexists(self, key, field):
+        with self.cond:
+            return _bytes(field) in (self._get(key) or {})
+
+    def hdel(self, key, *fields):
+        with self.cond:
+            table = self._get(key) or {}
+            return sum(table.pop(_bytes(field), None) is not None for field in fields)
+
+    def get(self, key):
+        with self.cond:
+            return self._get(key)
+
+    def set(self, key, value, ex=None):
+        with self.cond:
+            self.data[_bytes(key)] = _bytes(value)
+            if ex:
+                self.expires[_bytes(key)] = time.time() + ex
+            return True
+
+    def exists(self, *keys):
+        with self.cond:
+            return sum(self._get(key) is not None for key in keys)
+
+    def delete(self, *keys):
+        with self.cond:
+            return sum(self.data.pop(_bytes(key), None) is not None for key in keys)
+
+    def flushdb(self):
+        with self.cond:
+            self.data.clear()
+            self.expires.clear()
+        return True
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def register_script(self, script):
+        # 没有 Lua 解释器，只支持队列和检查点中用到的脚本
+        scripts = {
+            COMPARE_AND_DELETE: self._compare_and_delete,
+            COALESCE_PUSH: self._coalesce_push,
+            SAVE_CHECKPOINT: self._save_checkpoint,
+            SET_HIGH: self._set_high,
+        }
+        if script not in scripts:
+            raise NotImplementedError("MemoryRedis only supports the queue and checkpoint scripts")
+        return scripts[script]
+
+    def _save_checkpoint(self, keys, args):
+        with self.cond:
+            table = self._get(keys[0], dict)
+            high = max(int(table.get(b"high", 0)), int(args[0]))
+            table.update({b"high": _bytes(high), b"low": _bytes(args[1]), b"backfilled": _bytes(args[2])})
+
+    def _set_high(self, keys, args):
+        with self.cond:
+            table = self._get(keys[0], dict)
+            if int(args[0]) > int(table.get(b"high", 0)):
+                table[b"high"] = _bytes(args[0])
+
+    def _coalesce_push(self, keys, args):
+        if args[3] != "list":
+            raise NotImplementedError("MemoryRedis does not support streams")
+        with self.cond:
+            if not self.hset(keys[0], args[0], args[1]):
+                return 0
+            self.lpush(keys[1], args[2])
+            return 1
+
+    def _compare_and_delete(self, keys, args):
+        with self.cond:
+            table = self._get(keys[0]) or {}
+            field = _bytes(args[0])
+            if table.get(field) == _bytes(args[1]):
+                del table[field]
+                return 1
+            return -1 if field in table else 0
+
+
+class MemoryPipeline:
+    """按顺序执行记录的命令，不保证原子性"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - benchmarks/pipeline_bench.py
+# 离线测量写入链路 message_handler -> process_queue -> upsert 的吞吐量，parse_and_search 的延迟和导出的速度
+# Redis 使用内存替身，MeiliSearch 使用本地假服务器，不需要登录 Telegram
+# 用法: python -m benchmarks.pipeline_bench [--messages 5000] [--searches 200] [--output result.json]
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import metrics
+from benchmarks.fake_meili import start_server
+from benchmarks.fake_redis import MemoryRedis
+from benchmarks.synthetic import WORDS, generate_messages
+
+# 与用户发给 bot 的文本相同，keyword 只能是一个词
+SEARCH_QUERIES = [
+    "{word}",
+    "-m=e {word}",
+    "-t=SUPERGROUP {word}",
+    "--since=2021-01-01 {word}",
+    "--since=2021-01-01 --until=2023-12-31 {word}",
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies, default=0) * 1000, 3),
+    }
+
+
+def load_modules(meili_url, sync_path):
+    # 必须在导入 client 和 bot 之前替换配置、Redis 和版本查询，它们在导入时就会连接
+    import config
+    import init_client
+    import redis
+
+    config.MEILI_HOST = meili_url
+    config.ENGINE = "meili"
+    config.QUEUE_TRANSPORT = "list"
+    memory = MemoryRedis()
+    redis.Redis = lambda *args, **kwargs: memory
+    init_client.get_revision = lambda: "benchmark"
+
+    import bot
+    import client
+    from sync_config import ChatFilter
+
+    client.chat_filter = ChatFilter(sync_path)
+    logging.getLogger().setLevel(logging.WARNING)
+    return client, bot
+
+
+def bench_ingest(client, meili, messages, timeout):
+    workers = client.start_index_workers()
+
+    start = time.perf_counter()
+    for message in messages:
+        client.message_handler(None, message)
+    handler_time = time.perf_counter() - start
+
+    deadline = time.time() + timeout
+    while meili.document_count() < len(messages) and time.time() < deadline:
+        time.sleep(0.01)
+    total_time = time.perf_counter() - start
+    client.stop_index_workers(*workers)
+    indexed = meili.document_count()
+    return {
+        "messages": len(messages),
+        "indexed": indexed,
+        "completed": indexed == len(messages),
+        "handler_us_per_message": round(handler_time / len(messages) * 1e6, 2),
+        "seconds": round(total_time, 3),
+        "messages_per_second": round(indexed / total_time, 1),
+        "add_documents_requests": meili.add_requests,
+    }
+
+
+def bench_search(bot, queries, cold):
+    if not cold:
+        # 先执行一遍，测量结果缓存命中时的延迟
+        for query in queries:
+            bot.parse_and_search(query)
+    latencies = []
+    for query in queries:
+        if cold:
+            bot.search_cache.clear()
+        start = time.perf_counter()
+        bot.parse_and_search(query)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def bench_export(bot, fmt):
+    # 通过 /export 使用的生成器导出全部文档
+    from export import export_to_tempfile
+    start = time.perf_counter()
+    path, count = export_to_tempfile(bot.tgdb, fmt)
+    total_time = time.perf_counter() - start
+    size = os.path.getsize(path)
+    os.unlink(path)
+    return {
+        "format": fmt,
+        "documents": count,
+        "seconds": round(total_time, 3),
+        "documents_per_second": round(count / total_time, 1) if total_time else 0,
+        "compressed_bytes": size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SearchGram offline pipeline benchmark")
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--meili-latency", type=float, default=0, help="simulated seconds per add_documents")
+    parser.add_argument("--timeout", type=float, default=600, help="max seconds to wait for indexing")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    server, url = start_server(add_latency=args.meili_latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        sync_path = os.path.join(tmp, "sync.ini")
+        with open(sync_path, "w") as f:
+            f.write("[sync]\n\n[blacklist]\n\n[whitelist]\n")
+        client, bot = load_modules(url, sync_path)
+
+        rng = random.Random(args.seed)
+        messages = generate_messages(args.messages, args.chats, args.seed)
+        queries = [
+            rng.choice(SEARCH_QUERIES).format(word=rng.choice(WORDS))
+            for _ in range(args.searches)
+        ]
+
+        from config import BATCH_SIZE, BATCH_FLUSH_INTERVAL, QUEUE_CODEC, QUEUE_COALESCE, INDEX_WORKERS
+        results = {
+            "config": {
+                "batch_size": BATCH_SIZE,
+                "batch_flush_interval": BATCH_FLUSH_INTERVAL,
+                "queue_codec": QUEUE_CODEC,
+                "queue_coalesce": QUEUE_COALESCE,
+                "index_workers": INDEX_WORKERS,
+                "chats": args.chats,
+                "seed": args.seed,
+                "meili_latency": args.meili_latency,
+            },
+            "ingest": bench_ingest(client, server.meili, messages, args.timeout),
+            "search_cold": bench_search(bot, queries, cold=True),
+            "search_warm": bench_search(bot, queries, cold=False),
+            "export": bench_export(bot, "jsonl"),
+            "metrics": metrics.REGISTRY.snapshot(),
+        }
+    server.shutdown()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if not results["ingest"]["completed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - benchmarks/synthetic.py
+# 生成与 client.serialize_message 输出结构相同的合成消息
+
+import random
+from datetime import datetime
+from types import SimpleNamespace
+
+from queue_codec import CHAT_TYPES
+
+WORDS = [
+    "hello", "world", "search", "message", "telegram", "python", "redis", "index", "bot", "update",
+    "release", "error", "photo", "link", "meeting", "tomorrow", "price", "server", "backup", "deploy",
+    "你好", "世界", "搜索", "消息", "测试", "明天", "服务器", "价格", "会议", "链接",
+]
+START_TIMESTAMP = 1600000000
+END_TIMESTAMP = 1730000000
+
+
+def random_text(min_words, max_words, rng=random):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def generate_chats(count, rng=random):
+    chats = []
+    for i in range(count):
+        chat_type = rng.choice(CHAT_TYPES)
+        chats.append({
+            "id": 1000000 + i if chat_type in ("ChatType.PRIVATE", "ChatType.BOT") else -1001234567890 - i,
+            "type": chat_type,
+            "title": None if chat_type in ("ChatType.PRIVATE", "ChatType.BOT") else f"Group {i}",
+            "username": rng.choice([None, f"chat_{i}"]),
+        })
+    return chats
+
+
+def generate_message_dicts(count, chats=50, seed=None):
+    # 与 serialize_message 编码前的字典相同，约 10% 为长消息
+    rng = random.Random(seed)
+    chat_list = generate_chats(chats, rng)
+    next_ids = {chat["id"]: 1 for chat in chat_list}
+    messages = []
+    for _ in range(count):
+        chat = rng.choice(chat_list)
+        message_id = next_ids[chat["id"]]
+        next_ids[chat["id"]] += 1
+        timestamp = rng.randint(START_TIMESTAMP, END_TIMESTAMP)
+        long_text = rng.random() < 0.1
+        text = random_text(100, 600, rng) if long_text else random_text(1, 40, rng)
+        with_caption = rng.random() < 0.1
+        messages.append({
+            "id": message_id,
+            "chat": dict(chat),
+            "date": datetime.fromtimestamp(timestamp).isoformat(),
+            "timestamp": timestamp,
+            "text": None if with_caption else text,
+            "caption": text if with_caption else None,
+            "from_user": {
+                "id": rng.randint(10000, 9999999999),
+                "first_name": "First",
+                "last_name": rng.choice([None, "Last"]),
+                "username": rng.choice([None, "username"]),
+            } if chat["type"] != "ChatType.CHANNEL" else None,
+        })
+    return messages
+
+
+def as_message(message):
+    # 转换为 pyrogram Message 的替身，可以直接交给 message_handler
+    from pyrogram import enums
+
+    chat = message["chat"]
+    from_user = message["from_user"]
+    return SimpleNamespace(
+        id=message["id"],
+        chat=SimpleNamespace(id=chat["id"], type=enums.ChatType[chat["type"].split(".")[1]], title=chat["title"],
+                             username=chat["username"]),
+        date=datetime.fromisoformat(message["date"]),
+        text=message["text"],
+        caption=message["caption"],
+        from_user=SimpleNamespace(**from_user) if from_user else None,
+    )
+
+
+def generate_messages(count, chats=50, seed=None):
+    return [as_message(message) for message in generate_message_dicts(count, chats, seed)]
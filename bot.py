@@ -7,26 +7,52 @@ from io import BytesIO
 from typing import Tuple, Union
 import subprocess
 import os
-import configparser
+import secrets
+import time
 
 from pyrogram import Client, enums, filters, types
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-from search_engine import SearchEngine
-from config import OWNER_IDS, TOKEN , bot2client_log
+import redis
+
+import metrics
+from engine import SearchEngine
+from export import add_filter_arguments, build_parser as build_export_parser, export_to_tempfile
+from fingerprint import FingerprintIndex
+from sync_config import load_config, save_config
+from config import OWNER_IDS, TOKEN , bot2client_log, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, \
+    SEARCH_CACHE_CHECK_INTERVAL, SEARCH_WINDOW_SIZE, SEARCH_SESSION_TTL, METRICS_HOST, CLIENT_METRICS_PORT, \
+    BOT_METRICS_PORT, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD
 from init_client import get_client
-from utils import setup_logger, rate_limit
+from utils import setup_logger, rate_limit, TTLCache, sizeof_fmt
 
 tgdb = SearchEngine()
+# 删除索引中的文档后同时清除 client.py 记录的内容指纹，否则重新同步时这些消息会被当作没有变化而跳过
+fingerprints = FingerprintIndex(redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD))
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+# 索引的 lastUpdate 变化后清空缓存
+index_last_update = None
+index_last_check = 0
+
+PAGE_SIZE = 10
+SNIPPET_MAX_LENGTH = 300
+# 每个查询按窗口预取结果，翻页时直接从窗口中取，只在越过窗口边界时才请求 MeiliSearch
+PAGES_PER_WINDOW = max(1, SEARCH_WINDOW_SIZE // PAGE_SIZE)
+search_sessions = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_SESSION_TTL)
+
+search_requests = metrics.counter("searchgram_search_requests_total", "Searches and page turns handled by the bot")
+bot_search_latency = metrics.histogram("searchgram_bot_search_seconds", "Time to build a search result page")
+metrics.gauge("searchgram_search_cache_hits", "Search cache hits", lambda: search_cache.hits)
+metrics.gauge("searchgram_search_cache_misses", "Search cache misses", lambda: search_cache.misses)
+metrics.gauge("searchgram_search_sessions", "Search sessions kept for paging", lambda: len(search_sessions.data))
 
 setup_logger()
 app = get_client(TOKEN)
 chat_types = [i for i in dir(enums.ChatType) if not i.startswith("_")]
 parser = argparse.ArgumentParser()
 parser.add_argument("keyword", help="the keyword to be searched")
-parser.add_argument("-t", "--type", help="the type of message", default=None)
-parser.add_argument("-u", "--user", help="the user who sent the message", default=None)
-parser.add_argument("-m", "--mode", help="match mode, e: exact match, other value is fuzzy search", default=None)
+add_filter_arguments(parser)
+export_parser = build_export_parser()
 
 
 def private_use(func):
@@ -83,10 +109,13 @@ Sync Management Commands (Admin only):
 
 Other Commands:
 17. `/ping`: Check bot and database status
+18. `/stats`: Show indexing and search metrics
+19. `/export [-f=csv] [search options] [keyword]`: Export all matching messages as a gzip file, e.g. `/export -u=chat_id` exports a whole chat
 
 Search Tips:
 - You can combine different search options for more precise results
 - Use quotes for exact phrase matching
+- Limit the date range with `--since=2024-01-01 --until=2024-01-31 keyword` (dates or Unix timestamps)
 - For chat type search, available types are: {', '.join(chat_types)}
 
 Note: Some commands are restricted to admin use only.
@@ -100,9 +129,25 @@ Note: Some commands are restricted to admin use only.
 def ping_handler(client: Client, message: types.Message):
     client.send_chat_action(message.chat.id, enums.ChatAction.TYPING)
     text = tgdb.ping()
+    text += f"Search cache: {search_cache.hits} hits, {search_cache.misses} misses, {len(search_cache.data)} entries\n"
     client.send_message(message.chat.id, text, parse_mode=enums.ParseMode.MARKDOWN)
 
 
+@app.on_message(filters.command(["stats"]))
+@private_use
+@rate_limit(10)
+def stats_handler(client: Client, message: types.Message):
+    client.send_chat_action(message.chat.id, enums.ChatAction.TYPING)
+    snapshot = metrics.REGISTRY.snapshot()
+    note = ""
+    try:
+        snapshot.update(metrics.fetch_snapshot(CLIENT_METRICS_PORT, METRICS_HOST))
+    except Exception as e:
+        note = f"\n\nClient metrics unavailable: {str(e)}"
+    message.reply_text(f"```\n{metrics.summarize(snapshot)}\n```{note}", quote=True,
+                       parse_mode=enums.ParseMode.MARKDOWN)
+
+
 @app.on_message(filters.command(["delete"]))
 @private_use
 @rate_limit(10)
@@ -145,25 +190,81 @@ def delete_messages_handler(client: Client, message: types.Message):
         message.reply_text("Usage: /delete [chat|user] [id]")
 
 
+def forget_fingerprints(chat_id=None):
+    try:
+        fingerprints.forget(chat_id)
+    except redis.RedisError as e:
+        logging.warning(f"Failed to clear document fingerprints: {str(e)}")
+
+
+@app.on_message(filters.command(["export"]))
+@private_use
+def export_handler(client: Client, message: types.Message):
+    try:
+        args = export_parser.parse_args(message.text.split()[1:])
+    except SystemExit:
+        message.reply_text("Usage: /export [-f=jsonl|csv] [-t=type] [-u=chat_id] [-m=e] [--since=date] "
+                           "[--until=date] [keyword]", quote=True)
+        return
+
+    status = message.reply_text("Exporting...", quote=True)
+
+    def progress(count):
+        try:
+            status.edit_text(f"Exported {count} messages...")
+        except Exception as e:
+            logging.warning(f"Failed to report export progress: {str(e)}")
+
+    path = None
+    try:
+        path, count = export_to_tempfile(tgdb, args.format, progress, args.keyword, args.type, args.user, args.mode,
+                                         args.since, args.until)
+        if not count:
+            status.edit_text("No results found.")
+            return
+        status.edit_text(f"Exported {count} messages ({sizeof_fmt(os.path.getsize(path))}), uploading...")
+        client.send_chat_action(message.chat.id, enums.ChatAction.UPLOAD_DOCUMENT)
+        message.reply_document(path, quote=True, file_name=f"searchgram-export.{args.format}.gz",
+                               caption=f"{count} messages")
+        status.delete()
+    except Exception as e:
+        logging.error(f"Error exporting messages: {str(e)}", exc_info=True)
+        status.edit_text(f"An error occurred while exporting messages: {str(e)}")
+    finally:
+        if path:
+            os.unlink(path)
+
+
 @app.on_callback_query(filters.regex(r"^delete_"))
 @private_use
 def delete_callback_handler(client: Client, callback_query: types.CallbackQuery):
     data = callback_query.data
 
+    def progress(text):
+        try:
+            callback_query.edit_message_text(text)
+        except Exception as e:
+            logging.warning(f"Failed to report delete progress: {str(e)}")
+
     try:
         if data == "delete_all_confirm":
-            result = tgdb.delete_messages()
+            result = tgdb.delete_messages(progress=progress)
+            forget_fingerprints()
         elif data.startswith("delete_chat_confirm_"):
             chat_id = int(data.split("_")[-1])
-            result = tgdb.delete_messages(chat_id=chat_id)
+            result = tgdb.delete_messages(chat_id=chat_id, progress=progress)
+            forget_fingerprints(chat_id)
         elif data.startswith("delete_user_confirm_"):
             user_id = int(data.split("_")[-1])
-            result = tgdb.delete_messages(user_id=user_id)
+            result = tgdb.delete_messages(user_id=user_id, progress=progress)
+            # 指纹不按用户存储，只能全部清除
+            forget_fingerprints()
         elif data == "delete_cancel":
             result = "Delete operation cancelled."
         else:
             result = "Invalid operation"
 
+        search_cache.clear()
         callback_query.edit_message_text(result)
     except Exception as e:
         error_message = f"An error occurred while deleting messages: {str(e)}"
@@ -249,8 +350,7 @@ def view_client_log(client: Client, message: types.Message):
 def manage_sync(client: Client, message: types.Message):
     command = message.text.split()[0][1:]
     args = message.text.split()[1:]
-    config = configparser.ConfigParser(allow_no_value=True)
-    config.read("./sync.ini")
+    config = load_config()
     
     if command == "add_sync":
         if len(args) != 1:
@@ -260,8 +360,7 @@ def manage_sync(client: Client, message: types.Message):
         if "sync" not in config:
             config["sync"] = {}
         config["sync"][chat_id] = None
-        with open("./sync.ini", "w") as configfile:
-            config.write(configfile)
+        save_config(config)
         message.reply_text(f"已将 {chat_id} 添加到同步列表。")
     
     elif command == "remove_sync":
@@ -271,8 +370,7 @@ def manage_sync(client: Client, message: types.Message):
         chat_id = args[0]
         if "sync" in config and chat_id in config["sync"]:
             config.remove_option("sync", chat_id)
-            with open("./sync.ini", "w") as configfile:
-                config.write(configfile)
+            save_config(config)
             message.reply_text(f"已从同步列表中移除 {chat_id}。")
         else:
             message.reply_text(f"在同步列表中未找到 {chat_id}。")
@@ -285,15 +383,15 @@ def manage_sync(client: Client, message: types.Message):
             message.reply_text("同步列表为空。")
 
 
-def generate_navigation(page, total_pages):
+def generate_navigation(token, page, total_pages):
     if total_pages <= 1:
         return None
 
     buttons = []
     if page > 1:
-        buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"p|{page - 1}"))
+        buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"p|{token}|{page - 1}"))
     if page < total_pages:
-        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"n|{page + 1}"))
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"n|{token}|{page + 1}"))
 
     return InlineKeyboardMarkup([buttons])
 
@@ -301,20 +399,22 @@ def generate_navigation(page, total_pages):
 def parse_search_results(data: dict) -> str:
     result = ""
     hits = data.get("hits", [])
-    total_hits = data.get("estimatedTotalHits", 0)
+    total_hits = data.get("totalHits", data.get("estimatedTotalHits", 0))
     result += f"Total Hits: {total_hits}\n\n"
 
     if not hits:
         return result + "No results found."
 
     for hit in hits:
-        text = hit.get("text") or hit.get("caption")
+        # 优先使用 MeiliSearch 截取的匹配片段
+        formatted = hit.get("_formatted") or hit
+        text = formatted.get("text") or formatted.get("caption")
         if not text:
             continue
 
         chat_id = hit["chat"]["id"]
         chat_type = hit["chat"]["type"]
-        from_user = hit.get("from_user", {})
+        from_user = hit.get("from_user") or {}
 
         if chat_type == "ChatType.CHANNEL":
             chat_username = hit["chat"].get("title", "Channel")
@@ -343,25 +443,80 @@ def parse_search_results(data: dict) -> str:
             text_link = f"https://t.me/{chat_username}/{message_id}"
 
         result += f"{from_username} -> [{chat_username}]({deep_link}) on {date}:\n"
-        result += f"`{text[:100]}{'...' if len(text) > 100 else ''}`\n"
+        result += f"`{text[:SNIPPET_MAX_LENGTH]}{'...' if len(text) > SNIPPET_MAX_LENGTH else ''}`\n"
         result += f"[Quick Jump]({text_link})\n\n"
 
     return result
 
 
-def parse_and_search(text, page=1) -> Tuple[str, InlineKeyboardMarkup | None]:
+def cached_search(keyword, _type=None, user=None, page=1, mode=None, page_size=PAGE_SIZE, since=None,
+                  until=None) -> dict:
+    global index_last_update, index_last_check
+    now = time.time()
+    if now - index_last_check >= SEARCH_CACHE_CHECK_INTERVAL:
+        index_last_check = now
+        last_update = tgdb.last_update()
+        if last_update != index_last_update:
+            index_last_update = last_update
+            search_cache.clear()
+
+    key = (keyword, _type, user, page, mode, page_size, since, until)
+    results = search_cache.get(key)
+    if results is None:
+        results = tgdb.search(keyword, _type, user, page, mode, page_size, since, until)
+        search_cache.set(key, results)
+    return results
+
+
+def refine_query(text):
+    # 把 /group [username] keyword 形式的命令转换为搜索参数
+    if not text.startswith("/"):
+        return text
+    parts = text.split(maxsplit=2)
+    user_filter = f"-u={parts[1]}" if len(parts) > 2 else ""
+    keyword = parts[2] if len(parts) > 2 else parts[1]
+    return f"-t={parts[0][1:].upper()} {user_filter} {keyword}"
+
+
+def create_search_session(text):
     args = parser.parse_args(text.split())
-    logging.info("Search keyword: %s, type: %s, user: %s, page: %s, mode: %s", args.keyword, args.type, args.user, page,
-                 args.mode)
-    results = tgdb.search(args.keyword, args.type, args.user, page, args.mode)
-    text = parse_search_results(results)
-
-    total_hits = results.get("estimatedTotalHits", 0)
-    total_pages = (total_hits - 1) // 10 + 1  # Assuming 10 results per page
-    markup = generate_navigation(page, total_pages)
+    session = {"query": (args.keyword, args.type, args.user, args.mode, args.since, args.until), "windows": {},
+               "total_hits": 0}
+    token = secrets.token_urlsafe(6)
+    search_sessions.set(token, session)
+    return token, session
+
+
+def get_search_page(session, page) -> dict:
+    window, index = divmod(page - 1, PAGES_PER_WINDOW)
+    if window not in session["windows"]:
+        keyword, _type, user, mode, since, until = session["query"]
+        results = cached_search(keyword, _type, user, window + 1, mode, PAGES_PER_WINDOW * PAGE_SIZE, since, until)
+        session["windows"][window] = results.get("hits", [])
+        session["total_hits"] = results.get("totalHits", 0)
+    hits = session["windows"][window][index * PAGE_SIZE:(index + 1) * PAGE_SIZE]
+    return {"hits": hits, "totalHits": session["total_hits"]}
+
+
+def render_search_page(token, session, page) -> Tuple[str, InlineKeyboardMarkup | None]:
+    search_requests.inc()
+    with bot_search_latency.time():
+        results = get_search_page(session, page)
+        text = parse_search_results(results)
+
+    total_pages = (results["totalHits"] - 1) // PAGE_SIZE + 1
+    markup = generate_navigation(token, page, total_pages)
     return text, markup
 
 
+def parse_and_search(text, page=1) -> Tuple[str, InlineKeyboardMarkup | None]:
+    token, session = create_search_session(text)
+    keyword, _type, user, mode, since, until = session["query"]
+    logging.info("Search keyword: %s, type: %s, user: %s, page: %s, mode: %s, since: %s, until: %s", keyword, _type,
+                 user, page, mode, since, until)
+    return render_search_page(token, session, page)
+
+
 @app.on_message(filters.command(chat_types) & filters.text & filters.incoming)
 @private_use
 @rate_limit(3)
@@ -371,12 +526,9 @@ def type_search_handler(client: Client, message: types.Message):
     if len(parts) == 1:
         message.reply_text(f"/{chat_type} [username] keyword", quote=True, parse_mode=enums.ParseMode.MARKDOWN)
         return
-    user_filter = f"-u={parts[1]}" if len(parts) > 2 else ""
-    keyword = parts[2] if len(parts) > 2 else parts[1]
 
-    refined_text = f"-t={chat_type} {user_filter} {keyword}"
     client.send_chat_action(message.chat.id, enums.ChatAction.TYPING)
-    text, markup = parse_and_search(refined_text)
+    text, markup = parse_and_search(refine_query(message.text))
     send_search_result(client, message, text, markup)
 
 
@@ -412,26 +564,24 @@ def send_search_result(client: Client, message: types.Message, text: str, markup
         )
 
 
-@app.on_callback_query(filters.regex(r"n|p"))
+@app.on_callback_query(filters.regex(r"^[np]\|"))
 @rate_limit(1)
 def send_method_callback(client: Client, callback_query: types.CallbackQuery):
-    direction, page = callback_query.data.split("|")
-    new_page = int(page) + (1 if direction == "n" else -1)
+    parts = callback_query.data.split("|")
+    token = parts[1] if len(parts) == 3 else None
+    new_page = int(parts[-1])
     message = callback_query.message
-    user_query = message.reply_to_message.text
 
-    parts = user_query.split(maxsplit=2)
-    if user_query.startswith("/"):
-        user_filter = f"-u={parts[1]}" if len(parts) > 2 else ""
-        keyword = parts[2] if len(parts) > 2 else parts[1]
-        refined_text = f"-t={parts[0][1:].upper()} {user_filter} {keyword}"
-    else:
-        refined_text = user_query
+    session = search_sessions.get(token) if token else None
+    if session is None:
+        # 查询已过期，从原消息重新构建
+        client.send_chat_action(message.chat.id, enums.ChatAction.TYPING)
+        token, session = create_search_session(refine_query(message.reply_to_message.text))
 
-    client.send_chat_action(message.chat.id, enums.ChatAction.TYPING)
-    new_text, new_markup = parse_and_search(refined_text, new_page)
+    new_text, new_markup = render_search_page(token, session, new_page)
     message.edit_text(new_text, reply_markup=new_markup, disable_web_page_preview=True)
 
 
 if __name__ == "__main__":
+    metrics.start_http_server(BOT_METRICS_PORT, METRICS_HOST)
     app.run()
\ No newline at end of file
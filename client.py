@@ -1,22 +1,30 @@
 #!/usr/local/bin/python3
 # coding: utf-8
 
-import configparser
 import logging
 import random
 import threading
 import time
-import json
 import os
 import sys
 import re
+import signal
 import redis
 from pyrogram import Client, filters, types
 
-from search_engine import SearchEngine
-from config import BOT_ID, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD
+import metrics
+from engine import SearchEngine
+from sync_config import ChatFilter, load_config, load_sync_status, get_chat_id, SYNC_STATUS_FILE
+from sync_checkpoint import Checkpoint, CheckpointStore, LiveMarks, legacy_checkpoint
+from fingerprint import FingerprintIndex
+from message_queue import get_queue, get_spilling_queue, is_coalescing, ShardedQueue, SpillingQueue, DEAD_LETTER_KEY
+from queue_codec import decode_message, serialize_message, get_doc_id
+from sync_scheduler import SyncScheduler, ChatSync, GapFill
+from rate_control import AdaptiveRateLimiter
+from config import BOT_ID, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, BATCH_SIZE, BATCH_FLUSH_INTERVAL, \
+    MAX_INDEX_LAG, METRICS_HOST, CLIENT_METRICS_PORT, INDEX_TARGET_LAG, INDEX_WORKERS, SPILL_DIR, SKIP_UNCHANGED
 from init_client import get_client
-from utils import setup_logger, TokenBucket
+from utils import setup_logger
 
 setup_logger()
 
@@ -24,47 +32,102 @@ app = get_client()
 tgdb = SearchEngine()
 
 r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD)
+message_queue = get_queue(r)
+# 已写入文档的内容指纹
+fingerprints = FingerprintIndex(r) if SKIP_UNCHANGED else None
+# 每个聊天的同步检查点，实时收到的消息也会推进检查点
+checkpoints = CheckpointStore(r)
+live_marks = LiveMarks(checkpoints)
+
+# 按批次限流，速率根据 MeiliSearch 的任务积压和延迟自动调整，所有写入线程共享
+limiter = AdaptiveRateLimiter()
+# 设置后写入线程提交手上的批次后退出
+index_stop = threading.Event()
+
+messages_received = metrics.counter("searchgram_messages_received_total", "New and edited messages received")
+messages_skipped = metrics.counter("searchgram_messages_skipped_total", "Messages skipped by whitelist/blacklist")
+upsert_batches = metrics.counter("searchgram_upsert_batches_total", "Batches written to the search engine")
+upsert_documents = metrics.counter("searchgram_upsert_documents_total", "Documents written to the search engine")
+documents_unchanged = metrics.counter("searchgram_documents_unchanged_total",
+                                      "Documents skipped because their content has not changed")
+upsert_failures = metrics.counter("searchgram_upsert_failed_batches_total", "Batches put back into the queue")
+rate_limit_wait = metrics.histogram("searchgram_rate_limit_wait_seconds", "Time a batch waits for the rate limiter")
+upsert_latency = metrics.histogram("searchgram_upsert_seconds", "Time spent submitting a batch")
+# 在读取指标时才查询，不影响消息处理
+metrics.gauge("searchgram_queue_depth", "Messages waiting in the queue", lambda: message_queue.length())
+metrics.gauge("searchgram_queue_spilled", "Messages waiting in the on-disk spill log",
+              lambda: len(message_queue.spill) if isinstance(message_queue, SpillingQueue) else 0)
+metrics.gauge("searchgram_index_lag", "Search engine tasks not yet processed", lambda: tgdb.tasks.lag())
+metrics.gauge("searchgram_index_rate", "Current indexing rate limit in batches per second", lambda: limiter.rate)
+metrics.gauge("searchgram_index_rate_min", "Lower bound of the indexing rate", lambda: limiter.min_rate)
+metrics.gauge("searchgram_index_rate_max", "Upper bound of the indexing rate", lambda: limiter.max_rate)
+
+
+chat_filter = ChatFilter()
 
-# 创建一个令牌桶，每秒允许5个操作
-bucket = TokenBucket(tokens=5, fill_rate=5)
 
-SYNC_STATUS_FILE = "sync_status.json"
-
-
-def load_config():
-    config = configparser.ConfigParser(allow_no_value=True)
-    config.optionxform = lambda option: option
-    config.read("sync.ini")
-    return config
+def is_allowed(chat_id, chat_type):
+    return chat_filter.is_allowed(chat_id, chat_type)
+
+
+def rate_limited_upsert(messages):
+    # 每个批次占用一个时间片
+    with rate_limit_wait.time():
+        limiter.acquire()
+        wait_for_index_lag()
+    with upsert_latency.time():
+        task = tgdb.upsert_many(messages)
+    # 积压接近目标时每个批次都查询任务状态，避免用过期的积压数降速
+    tgdb.tasks.poll(force=tgdb.tasks.lag() > INDEX_TARGET_LAG)
+    limiter.feedback(tgdb.tasks.lag(), tgdb.tasks.latency, error=task is None)
+    return task
+
+
+def upsert_changed(messages):
+    # 跳过内容没有变化的消息，返回提交的条数，提交失败时返回 None
+    changed = messages
+    if fingerprints:
+        try:
+            changed = fingerprints.changed(messages)
+        except redis.RedisError as e:
+            logging.warning(f"Cannot check document fingerprints, writing all: {str(e)}")
+        documents_unchanged.inc(len(messages) - len(changed))
+    if not changed:
+        return 0
+    if rate_limited_upsert(changed) is None:
+        return None
+    return len(changed)
 
 
-def is_allowed(chat_id, chat_type):
-    config = load_config()
-    whitelist = config.options("whitelist") if config.has_section("whitelist") else []
-    blacklist = config.options("blacklist") if config.has_section("blacklist") else []
+def record_fingerprints(documents):
+    # 写入任务成功后才记录指纹，重试后仍失败而被丢弃的文档不会被当作已写入
+    try:
+        fingerprints.record(documents)
+    except redis.RedisError as e:
+        logging.warning(f"Cannot record document fingerprints: {str(e)}")
 
-    chat_id_str = str(chat_id)
-    chat_type_str = f"`{chat_type}`"
 
-    if whitelist:
-        return chat_id_str in whitelist or chat_type_str in whitelist
-    elif blacklist:
-        return chat_id_str not in blacklist and chat_type_str not in blacklist
-    return True
+if fingerprints:
+    tgdb.tasks.on_succeeded = record_fingerprints
 
 
-def rate_limited_upsert(message):
-    while not bucket.consume(1):
-        time.sleep(0.2)
-    tgdb.upsert(message)
+def wait_for_index_lag():
+    # MeiliSearch 未完成的任务过多时暂停写入，按任务处理速度计算等待时间
+    while tgdb.tasks.lag() > MAX_INDEX_LAG:
+        wait = tgdb.tasks.drain_time(tgdb.tasks.lag() - MAX_INDEX_LAG)
+        logging.info("MeiliSearch is %s tasks behind, waiting %.1fs", tgdb.tasks.lag(), wait)
+        time.sleep(wait)
+        tgdb.tasks.poll(force=True)
 
 
 @app.on_edited_message(~filters.chat(BOT_ID))
 def message_edit_handler(client, message):
+    messages_received.inc()
     if is_allowed(message.chat.id, message.chat.type):
         logging.info("Editing old message: %s-%s", message.chat.id, message.id)
-        r.lpush('message_queue', serialize_message(message))
+        message_queue.push(serialize_message(message), get_doc_id(message))
     else:
+        messages_skipped.inc()
         logging.info("Skipping edited message from chat %s (type: %s) due to whitelist/blacklist", message.chat.id,
                      message.chat.type)
 
@@ -76,173 +139,259 @@ def safe_edit(msg, new_text):
         msg.edit_text(new_text)
 
 
-def get_last_synced_id(uid):
-    return int(r.get(f"last_synced:{uid}") or 0)
-
-
-def update_last_synced_id(uid, message_id):
-    r.set(f"last_synced:{uid}", str(message_id))
-
-
-def load_sync_status():
-    if os.path.exists(SYNC_STATUS_FILE):
-        try:
-            with open(SYNC_STATUS_FILE, 'r') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            logging.warning(
-                f"Failed to load {SYNC_STATUS_FILE}. File might be empty or corrupted. Starting with empty sync status.")
-    return {}
-
-
-def save_sync_status(status):
-    with open(SYNC_STATUS_FILE, 'w') as f:
-        json.dump(status, f)
-
-
 def clear_redis_queue():
-    r.delete('message_queue')
+    message_queue.clear()
 
 
-def reset_token_bucket():
-    global bucket
-    bucket = TokenBucket(tokens=5, fill_rate=5)
+def reset_rate_limiter():
+    limiter.reset()
 
 
 def clear_all_sync_data():
-    # 清除同步状态文件
+    # 清除旧版本的同步状态文件，检查点保存在 Redis 中
     if os.path.exists(SYNC_STATUS_FILE):
         os.remove(SYNC_STATUS_FILE)
 
-    # 清除 Redis 中的所有数据
+    # 清除 Redis 中的所有数据和磁盘上暂存的消息
     r.flushdb()
+    if os.path.isdir(SPILL_DIR):
+        from spill import SpillLog
+        SpillLog(SPILL_DIR).clear()
 
-    # 重置令牌桶
-    reset_token_bucket()
+    # 重置写入速率
+    reset_rate_limiter()
 
     # 清除 MeiliSearch 中的所有数据
     # tgdb.clean_db()
 
 
-def get_chat_id(chat):
-    if isinstance(chat, int):
-        return chat
-    if isinstance(chat, str):
-        if chat.startswith('-100'):
-            return int(chat)
-        elif chat.startswith('-'):
-            return int(chat)
-        else:
-            return int(chat)
-    return chat.id
+def enqueue_message(msg):
+    message_queue.push(serialize_message(msg), get_doc_id(msg))
 
 
-def sync_history():
-    global msg
-    time.sleep(30)
-    config = load_config()
+def gap_fill(sync_chat_ids, budget):
+    # 补齐离线期间所有允许的聊天中的新消息，完成后实时消息才推进检查点
+    since = checkpoints.load_last_seen()
+    filler = GapFill(app, enqueue_message, checkpoints, is_allowed, budget, skip=sync_chat_ids)
+    try:
+        # 留一分钟余量，上次在线时间最多每 10 秒更新一次
+        filler.run(since - 60 if since else 0)
+        logging.info(filler.summary())
+    except Exception as e:
+        logging.error(f"Error filling gaps since last run: {str(e)}")
+    live_marks.release_all(blocked=sync_chat_ids)
+    return filler
 
-    sync_status = load_sync_status()
 
-    if config.has_section("sync"):
-        saved = app.send_message("me", "Starting to sync history...")
+def migrate_legacy_checkpoint(uid, chat_id, sync_status, budget):
+    # 聊天还没有检查点时，把旧版本的同步进度迁移过来，只执行一次
+    status = sync_status.get(uid, {})
+    legacy_id = checkpoints.load_legacy(uid)
+    if not status and not legacy_id:
+        return Checkpoint()
+    budget.acquire()
+    head_id = next((msg.id for msg in app.get_chat_history(chat_id, limit=1)), 0)
+    checkpoint = legacy_checkpoint(legacy_id, status, head_id) or Checkpoint()
+    logging.info(f"Migrated the legacy sync progress of {uid} to {checkpoint}")
+    checkpoints.save(chat_id, checkpoint)
+    return checkpoint
 
-        for uid in list(sync_status.keys()):
-            if uid not in config.options("sync"):
-                del sync_status[uid]
 
-        for uid in config.options("sync"):
-            if uid not in sync_status or not sync_status[uid].get('completed', False):
-                try:
-                    chat_id = get_chat_id(uid)
-                    chat = app.get_chat(chat_id)
-                    if not is_allowed(chat.id, chat.type):
-                        logging.info(f"Skipping sync for chat {uid} due to whitelist/blacklist")
-                        continue
-
-                    last_synced_id = get_last_synced_id(uid)
-
-                    sync_status[uid] = {'completed': False, 'last_id': last_synced_id}
-                    save_sync_status(sync_status)
-
-                    for msg in app.get_chat_history(chat.id):
-                        if msg.id <= last_synced_id:
-                            break
-                        serialized_msg = serialize_message(msg)
-                        r.lpush('message_queue', serialized_msg)
-
-                        if msg.id % 100 == 0:
-                            log = f"Synced messages up to ID {msg.id} for {uid}"
-                            logging.info(log)
-                            safe_edit(saved, log)
-                            sync_status[uid]['last_id'] = msg.id
-                            save_sync_status(sync_status)
-                            time.sleep(1)
-
-                    update_last_synced_id(uid, msg.id)
-                    sync_status[uid]['completed'] = True
-                    save_sync_status(sync_status)
-                except Exception as e:
-                    logging.error(f"Error syncing history for {uid}: {str(e)}")
-                    safe_edit(saved, f"Error syncing {uid}: {str(e)}")
-                    time.sleep(5)
+def sync_history():
+    # 等待客户端登录完成
+    while not app.is_initialized:
+        time.sleep(1)
+    config = load_config()
+    sync_uids = config.options("sync") if config.has_section("sync") else []
+    sync_status = load_sync_status()
+
+    def on_progress(chat_sync):
+        log = f"Synced {chat_sync.synced} messages for {chat_sync.uid} ({chat_sync.phase}), {chat_sync.checkpoint}"
+        logging.info(log)
+        # [sync] 中的聊天补齐阶段结束后，实时消息才推进检查点
+        if chat_sync.phase == ChatSync.BACKFILL:
+            live_marks.release(chat_sync.chat_id)
+        safe_edit(saved, f"Syncing history...\n{scheduler.summary()}")
+
+    scheduler = SyncScheduler(app, enqueue_message, checkpoints, on_progress)
+    filler = gap_fill({get_chat_id(uid) for uid in sync_uids}, scheduler.budget)
+
+    if sync_uids:
+        saved = app.send_message("me", f"Starting to sync history...\n{filler.summary()}")
+
+        for uid in sync_uids:
+            try:
+                chat_id = get_chat_id(uid)
+                scheduler.budget.acquire()
+                chat = app.get_chat(chat_id)
+                if not is_allowed(chat.id, chat.type):
+                    logging.info(f"Skipping sync for chat {uid} due to whitelist/blacklist")
+                    continue
+
+                if checkpoints.exists(chat.id):
+                    checkpoint = checkpoints.load(chat.id)
+                else:
+                    checkpoint = migrate_legacy_checkpoint(uid, chat.id, sync_status, scheduler.budget)
+                total = 0
+                if not checkpoint.backfilled and not checkpoint.low:
+                    # 用消息总数排序，小聊天优先同步；继续回填的聊天由 ChatSync 按 low 估算
+                    scheduler.budget.acquire()
+                    total = app.get_chat_history_count(chat.id)
+
+                scheduler.add(ChatSync(uid, chat.id, checkpoint, total))
+            except Exception as e:
+                logging.error(f"Error syncing history for {uid}: {str(e)}")
+                safe_edit(saved, f"Error syncing {uid}: {str(e)}")
+
+        scheduler.run()
 
         log = "Sync history complete"
         logging.info(log)
-        safe_edit(saved, log)
-
-
-def serialize_message(message):
-    chat = message.chat
-    return json.dumps({
-        'id': message.id,
-        'chat': {
-            'id': chat.id,
-            'type': str(chat.type),
-            'title': getattr(chat, 'title', None),
-            'username': getattr(chat, 'username', None)
-        },
-        'date': message.date.isoformat(),
-        'text': message.text,
-        'caption': message.caption,
-        'from_user': {
-            'id': message.from_user.id if message.from_user else None,
-            'first_name': message.from_user.first_name if message.from_user else None,
-            'last_name': message.from_user.last_name if message.from_user else None,
-            'username': message.from_user.username if message.from_user else None
-        } if message.from_user else None
-    })
+        safe_edit(saved, f"{log}\n{scheduler.summary()}")
 
 
 @app.on_message((filters.outgoing | filters.incoming) & ~filters.chat(BOT_ID))
 def message_handler(client: Client, message: types.Message):
+    messages_received.inc()
     if is_allowed(message.chat.id, message.chat.type):
         logging.info("Adding new message: %s-%s", message.chat.id, message.id)
-        r.lpush('message_queue', serialize_message(message))
+        message_queue.push(serialize_message(message), get_doc_id(message))
+        live_marks.seen(message.chat.id, message.id)
     else:
+        messages_skipped.inc()
         logging.info("Skipping message from chat %s (type: %s) due to whitelist/blacklist", message.chat.id,
                      message.chat.type)
 
 
-def process_queue():
+def process_queue(source=None, stop=index_stop):
+    source = source or message_queue
+    batch = []
+    handles = []
+    deadline = 0
     while True:
-        message_json = r.rpop('message_queue')
-        if message_json:
-            message_dict = json.loads(message_json)
-            rate_limited_upsert(message_dict)
-        else:
+        stopping = stop.is_set()
+        if stopping and not batch:
+            return
+        try:
+            tgdb.tasks.poll()
+        except Exception as e:
+            # 查询任务或任务完成后的回调（如记录指纹）失败不应中断索引循环，下次再查询
+            logging.error(f"Error polling index tasks: {str(e)}")
+        # 一次最多取出凑满当前批次所需的消息数（列表队列需要 Redis >= 6.2）
+        timeout = max(deadline - time.time(), 0.1) if batch else 1
+        try:
+            entries = source.pop(BATCH_SIZE - len(batch), timeout) if not stopping else []
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            # Redis 短暂不可用时继续提交手上的批次，之后重试
+            logging.error(f"Error reading from the queue: {str(e)}")
+            entries = []
+            time.sleep(1)
+        if entries:
+            if not batch:
+                deadline = time.time() + BATCH_FLUSH_INTERVAL
+            for handle, payload in entries:
+                try:
+                    message = decode_message(payload)
+                except Exception as e:
+                    dead_letter(source, handle, payload, e)
+                    continue
+                handles.append(handle)
+                batch.append(message)
+
+        if batch and (len(batch) >= BATCH_SIZE or time.time() >= deadline or stopping):
+            # 写入成功后才确认，失败的消息放回队列或留在 Stream 中等待重新投递
+            written = upsert_changed(batch)
+            success = written is not None
+            try:
+                if success:
+                    source.ack(handles)
+                else:
+                    source.nack(handles)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                # 确认失败的消息之后会被重新投递，重复写入索引不影响结果
+                logging.error(f"Error acknowledging {len(handles)} messages: {str(e)}")
+            if written:
+                upsert_batches.inc()
+                upsert_documents.inc(written)
+            elif not success:
+                upsert_failures.inc()
+                if not stopping:
+                    time.sleep(1)
+            batch = []
+            handles = []
+
+
+def dead_letter(source, handle, payload, error):
+    # 无法解码的消息重新投递也会失败，移到死信列表后确认
+    logging.error(f"Cannot decode queued message, moving it to {DEAD_LETTER_KEY}: {str(error)}")
+    try:
+        r.rpush(DEAD_LETTER_KEY, payload)
+        source.ack([handle])
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        logging.error(f"Error moving message to {DEAD_LETTER_KEY}: {str(e)}")
+
+
+def get_payload_doc_id(payload):
+    message = decode_message(payload)
+    return f"{message['chat']['id']}-{message['id']}"
+
+
+def start_index_workers(count=INDEX_WORKERS):
+    # 合并队列中同一文档同时只有一个引用，可以直接并行消费；否则按文档 ID 分片，旧版本不会覆盖新版本
+    if count > 1 and not is_coalescing(message_queue):
+        source = ShardedQueue(message_queue, count, get_payload_doc_id)
+        sources = source.shards
+    else:
+        source = message_queue
+        sources = [message_queue] * count
+    workers = [threading.Thread(target=process_queue, args=(shard, index_stop), name=f"indexer-{i}")
+               for i, shard in enumerate(sources)]
+    for worker in workers:
+        worker.start()
+    logging.info("Started %s index workers", count)
+    return workers, source
+
+
+def stop_index_workers(workers, source):
+    logging.info("Stopping index workers, flushing in-flight batches")
+    index_stop.set()
+    for worker in workers:
+        worker.join()
+    if isinstance(source, ShardedQueue):
+        source.close()
+    logging.info("Index workers stopped")
+
+
+def wait_for_index_workers(workers, source):
+    # 收到 SIGTERM 或 Ctrl+C 后等待写入线程处理完手上的批次
+    signal.signal(signal.SIGTERM, lambda signum, frame: index_stop.set())
+    try:
+        while any(worker.is_alive() for worker in workers) and not index_stop.is_set():
             time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    stop_index_workers(workers, source)
 
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
-        if sys.argv[1] == "--clear-sync":
+        if sys.argv[1] == "--consumer":
+            metrics.start_http_server(CLIENT_METRICS_PORT, METRICS_HOST)
+            # 只消费队列写入索引，不登录 Telegram，可在多台机器上同时运行（需要 QUEUE_TRANSPORT=stream）
+            wait_for_index_workers(*start_index_workers())
+        elif sys.argv[1] == "--clear-sync":
             clear_all_sync_data()
             print("All sync data, Redis queue, and ~~MeiliSearch~~ data have been cleared.")
         elif sys.argv[1] == "--reset-sync":
             clear_all_sync_data()
             print("All sync data has been reset, and MeiliSearch data has been cleared.")
     else:
+        # 只在接收消息的进程中使用磁盘缓冲，--consumer 进程不会写入
+        message_queue = get_spilling_queue(message_queue)
+        metrics.start_http_server(CLIENT_METRICS_PORT, METRICS_HOST)
         threading.Thread(target=sync_history).start()
-        threading.Thread(target=process_queue, daemon=True).start()
+        index_workers = start_index_workers()
         app.run()
+        stop_index_workers(*index_workers)
+        if isinstance(message_queue, SpillingQueue):
+            message_queue.close()
@@ -0,0 +1,15 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+# 根据 config.ENGINE 选择搜索引擎，只导入所选引擎的依赖
+
+from config import ENGINE
+
+AVAILABLE_ENGINES = ["meili", "sqlite"]
+
+if ENGINE == "meili":
+    from search_engine import SearchEngine
+elif ENGINE == "sqlite":
+    from sqlite_engine import SearchEngine
+else:
+    raise ValueError(f"Unsupported engine {ENGINE}, available engines are {AVAILABLE_ENGINES}")
@@ -0,0 +1,102 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+# 导出搜索结果或整个聊天：从搜索引擎逐批读取文档，边读边写入 gzip 压缩的 JSONL 或 CSV，内存占用与结果数无关。
+# 命令行用法：python export.py [-u=chat_id] [-t=GROUP] [--since=2024-01-01] [-f=csv] [-o=out.csv.gz] [keyword]
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from utils import parse_date
+
+EXPORT_FORMATS = ["jsonl", "csv"]
+CSV_FIELDS = ["ID", "message_id", "date", "timestamp", "chat.id", "chat.type", "chat.title", "chat.username",
+              "from_user.id", "from_user.first_name", "from_user.last_name", "from_user.username", "text", "caption"]
+
+
+def add_filter_arguments(parser):
+    # bot 的搜索和导出使用相同的筛选参数
+    parser.add_argument("-t", "--type", help="the type of message", default=None)
+    parser.add_argument("-u", "--user", help="the user who sent the message", default=None)
+    parser.add_argument("-m", "--mode", help="match mode, e: exact match, other value is fuzzy search", default=None)
+    parser.add_argument("--since", help="only messages sent at or after this date", type=parse_date, default=None)
+    parser.add_argument("--until", help="only messages sent at or before this date",
+                        type=lambda value: parse_date(value, end_of_day=True), default=None)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Export matching messages as gzip-compressed JSONL or CSV")
+    parser.add_argument("keyword", nargs="?", default="", help="the keyword to be searched, empty for all messages")
+    add_filter_arguments(parser)
+    parser.add_argument("-f", "--format", choices=EXPORT_FORMATS, default="jsonl")
+    parser.add_argument("-o", "--output", help="output file, defaults to stdout", default=None)
+    return parser
+
+
+def _csv_row(document):
+    row = []
+    for field in CSV_FIELDS:
+        value = document
+        for key in field.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        row.append("" if value is None else value)
+    return row
+
+
+def write_export(documents, fileobj, fmt="jsonl", progress=None, progress_interval=10):
+    # 返回写入的文档数；progress 每 progress_interval 秒调用一次
+    count = 0
+    last_report = time.time()
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as compressed, \
+            io.TextIOWrapper(compressed, encoding="utf-8", newline="") as out:
+        writer = csv.writer(out) if fmt == "csv" else None
+        if writer:
+            writer.writerow(CSV_FIELDS)
+        for document in documents:
+            if writer:
+                writer.writerow(_csv_row(document))
+            else:
+                out.write(json.dumps(document, ensure_ascii=False))
+                out.write("\n")
+            count += 1
+            if progress and time.time() - last_report >= progress_interval:
+                last_report = time.time()
+                progress(count)
+    return count
+
+
+def export_to_tempfile(engine, fmt="jsonl", progress=None, keyword="", _type=None, user=None, mode=None,
+                       since=None, until=None):
+    # 返回 (临时文件路径, 文档数)，由调用方上传后删除
+    fd, path = tempfile.mkstemp(prefix="searchgram-export-", suffix=f".{fmt}.gz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            documents = engine.iter_documents(keyword, _type, user, mode, since, until)
+            count = write_export(documents, f, fmt, progress)
+    except Exception:
+        os.unlink(path)
+        raise
+    return path, count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = build_parser().parse_args()
+    from engine import SearchEngine
+
+    documents = SearchEngine().iter_documents(args.keyword, args.type, args.user, args.mode, args.since, args.until)
+    report = lambda count: logging.info(f"Exported {count} messages...")
+    if args.output:
+        with open(args.output, "wb") as f:
+            total = write_export(documents, f, args.format, report)
+    else:
+        total = write_export(documents, sys.stdout.buffer, args.format, report)
+    logging.info(f"Exported {total} messages")
@@ -0,0 +1,98 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+# 已写入索引的文档内容指纹：重复入队、重新同步时内容没有变化的消息不再写入搜索引擎。
+# 指纹在写入任务成功后才记录，任务失败时不会留下没有文档的指纹。
+# 指纹是 64 位 blake2b，按 (聊天, 消息 ID >> 7) 分到不同的 Redis 哈希表，每个哈希表最多 128 个字段，
+# 保持 Redis 的 listpack 紧凑编码（hash-max-listpack-entries 默认为 128），每条消息约 15~20 字节。
+
+import hashlib
+import json
+
+FINGERPRINT_PREFIX = "doc_hash:"
+BUCKET_BITS = 7
+BUCKET_MASK = (1 << BUCKET_BITS) - 1
+
+
+def fingerprint(message):
+    # 只包含会被编辑或影响搜索结果的字段
+    chat = message["chat"]
+    user = message.get("from_user") or {}
+    fields = [
+        message.get("text"), message.get("caption"),
+        chat["id"], chat.get("type"), chat.get("title"), chat.get("username"),
+        user.get("id"), user.get("first_name"), user.get("last_name"), user.get("username"),
+    ]
+    return hashlib.blake2b(json.dumps(fields, ensure_ascii=False).encode(), digest_size=8).digest()
+
+
+def fingerprint_location(chat_id, message_id):
+    return f"{FINGERPRINT_PREFIX}{chat_id}:{message_id >> BUCKET_BITS}", message_id & BUCKET_MASK
+
+
+class FingerprintIndex:
+    """用一次 pipeline 查出一批消息中内容有变化的消息，写入任务成功后再记录这些文档的指纹"""
+
+    def __init__(self, r):
+        self.r = r
+
+    @staticmethod
+    def _locations(messages):
+        return [fingerprint_location(message["chat"]["id"], message["id"]) for message in messages]
+
+    @staticmethod
+    def _select(messages, stored):
+        return [message for message, old in zip(messages, stored) if fingerprint(message) != old]
+
+    @staticmethod
+    def _entries(documents):
+        # 索引文档与队列中的消息有相同的内容字段
+        return [(fingerprint_location(document["chat"]["id"], document["message_id"]), fingerprint(document))
+                for document in documents]
+
+    def changed(self, messages):
+        locations = self._locations(messages)
+        pipe = self.r.pipeline(transaction=False)
+        for key, field in locations:
+            pipe.hget(key, field)
+        return self._select(messages, pipe.execute())
+
+    def record(self, documents):
+        # documents 是已经确认写入索引的文档
+        if not documents:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for (key, field), value in self._entries(documents):
+            pipe.hset(key, field, value)
+        pipe.execute()
+
+    def forget(self, chat_id=None):
+        # 索引中的文档被删除后需要清除对应的指纹，否则重新同步时会被跳过
+        pattern = f"{FINGERPRINT_PREFIX}{chat_id}:*" if chat_id is not None else f"{FINGERPRINT_PREFIX}*"
+        keys = []
+        for key in self.r.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                self.r.unlink(*keys)
+                keys = []
+        if keys:
+            self.r.unlink(*keys)
+
+
+class AsyncFingerprintIndex(FingerprintIndex):
+    """FingerprintIndex 的 asyncio 版本，r 为 redis.asyncio 客户端"""
+
+    async def changed(self, messages):
+        locations = self._locations(messages)
+        pipe = self.r.pipeline(transaction=False)
+        for key, field in locations:
+            pipe.hget(key, field)
+        return self._select(messages, await pipe.execute())
+
+    async def record(self, documents):
+        if not documents:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for (key, field), value in self._entries(documents):
+            pipe.hset(key, field, value)
+        await pipe.execute()
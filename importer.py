@@ -0,0 +1,329 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+# 导入 Telegram Desktop 导出的 result.json：逐块解析，不把整个文件读入内存，按大批次直接写入搜索引擎，
+# 并更新每个聊天的同步检查点，client.py 之后只需同步导出之后的新消息。
+# 支持单个聊天的导出和整个账号的导出。导入时最好先停止 client.py，避免同时更新检查点。
+# 命令行用法：python importer.py [--chat=chat_id] result.json [result.json ...]
+
+import argparse
+import json
+import logging
+import re
+import time
+from datetime import datetime
+
+from sync_checkpoint import Checkpoint
+from utils import to_epoch
+
+CHUNK_SIZE = 1024 * 1024
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+# Telegram Desktop 导出中的聊天类型对应的 Pyrogram ChatType
+CHAT_TYPES = {
+    "personal_chat": "ChatType.PRIVATE",
+    "saved_messages": "ChatType.PRIVATE",
+    "bot_chat": "ChatType.BOT",
+    "private_group": "ChatType.GROUP",
+    "private_supergroup": "ChatType.SUPERGROUP",
+    "public_supergroup": "ChatType.SUPERGROUP",
+    "private_channel": "ChatType.CHANNEL",
+    "public_channel": "ChatType.CHANNEL",
+}
+# 有这些字段的消息带有媒体，文字是媒体的说明
+MEDIA_FIELDS = ("photo", "file", "media_type", "location_information", "poll", "contact_information")
+
+
+class JsonStream:
+    """按需读取的 JSON 解析器：对象和数组逐个成员地遍历，其余的值用 json.JSONDecoder.raw_decode 整体解码，
+    内存中只保留当前的值"""
+
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # 丢弃已经解析的部分并读入下一块，文件结束时返回 False
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos}, found {self.buffer[self.pos]!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # 值被块边界截断，读入更多数据后重试
+                if not self._fill():
+                    raise
+                continue
+            # 数字在块的末尾时可能还没有读完（如 "-1." 后面的 "5e3" 还在下一块中）
+            if len(self.buffer) - end < 3 and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _members(self, close):
+        if self.peek() == close:
+            self.pos += 1
+            return
+        while True:
+            yield
+            separator = self.peek()
+            self.pos += 1
+            if separator == close:
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or {close!r} at offset {self.pos - 1}, found {separator!r}")
+
+    def items(self):
+        # 逐个返回对象的键，调用方必须用 value()、items() 或 elements() 读完对应的值
+        self.expect("{")
+        for _ in self._members("}"):
+            key = self.value()
+            self.expect(":")
+            yield key
+
+    def elements(self):
+        # 数组的每个元素返回一次，调用方必须读完该元素
+        self.expect("[")
+        for _ in self._members("]"):
+            yield
+
+
+def to_chat_id(export_id, export_type):
+    # 导出文件中的 ID 没有 Bot API 的前缀：超级群组和频道加上 -100，普通群组取负数
+    chat_type = CHAT_TYPES.get(export_type, "ChatType.PRIVATE")
+    if chat_type in ("ChatType.SUPERGROUP", "ChatType.CHANNEL"):
+        return -1000000000000 - export_id, chat_type
+    if chat_type == "ChatType.GROUP":
+        return -export_id, chat_type
+    return export_id, chat_type
+
+
+def flatten_text(text):
+    # 带格式的文字是字符串和 {"type": ..., "text": ...} 组成的列表
+    if isinstance(text, str):
+        return text
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+
+
+def to_message(record, chat):
+    # 转换为与 serialize_message 相同结构的消息
+    if record.get("date_unixtime"):
+        timestamp = int(record["date_unixtime"])
+        date = datetime.fromtimestamp(timestamp).isoformat()
+    else:
+        date = record["date"]
+        timestamp = to_epoch(date)
+    text = flatten_text(record.get("text", "")) or None
+    has_media = any(field in record for field in MEDIA_FIELDS)
+    from_id = record.get("from_id") or ""
+    from_user = None
+    if from_id.startswith("user"):
+        from_user = {"id": int(from_id[4:]), "first_name": record.get("from"), "last_name": None, "username": None}
+    return {
+        "id": record["id"],
+        "chat": chat,
+        "date": date,
+        "timestamp": timestamp,
+        "text": None if has_media else text,
+        "caption": text if has_media else None,
+        "from_user": from_user,
+    }
+
+
+def merge_checkpoint(checkpoint, low, high):
+    # 导入的消息与已同步的区间相连时才合并，否则中间的缺口会被当作已经同步
+    if not checkpoint.high:
+        return Checkpoint(high, low, False)
+    if not checkpoint.low and not checkpoint.backfilled:
+        # 只有实时消息推进过 high，还没有同步过的区间：导入的消息之后到 high 之间可能有缺口，
+        # 保存时 high 又只增不减，只有导入的消息覆盖到 high 才能保存
+        if high < checkpoint.high:
+            return None
+        return Checkpoint(high, low, False)
+    if low > checkpoint.high or high < checkpoint.low:
+        return None
+    return Checkpoint(max(checkpoint.high, high), min(checkpoint.low, low), checkpoint.backfilled)
+
+
+class ExportImporter:
+    """把导出文件中的消息按批次写入搜索引擎，所有写入任务成功后再保存各聊天的检查点"""
+
+    def __init__(self, engine, checkpoints, fingerprints=None, is_allowed=None, batch_size=5000, max_lag=20,
+                 chat_ids=None):
+        self.engine = engine
+        self.checkpoints = checkpoints
+        self.fingerprints = fingerprints
+        self.is_allowed = is_allowed
+        self.batch_size = batch_size
+        self.max_lag = max_lag
+        self.chat_ids = chat_ids
+        if fingerprints:
+            engine.tasks.on_succeeded = fingerprints.record
+        engine.tasks.on_dropped = self._dropped
+        self.batch = []
+        # 已读完的聊天 (chat_id, low, high)，等待写入任务完成后保存检查点
+        self.finished = []
+        # 有文档写入失败的聊天，不保存检查点，之后由 client.py 重新同步
+        self.failed_chats = set()
+        self.chats = self.imported = self.unchanged = 0
+
+    def import_file(self, path):
+        with open(path, encoding="utf-8-sig") as f:
+            self._import_object(JsonStream(f))
+        self.flush()
+        self.wait_for_index()
+        self._save_checkpoints()
+
+    def _import_object(self, stream):
+        # 单个聊天的导出本身就是一个聊天对象，整个账号的导出中聊天在 chats.list 和 left_chats.list 中
+        info = {}
+        for key in stream.items():
+            if key == "messages":
+                self._import_messages(stream, info)
+            elif key in ("chats", "left_chats"):
+                for list_key in stream.items():
+                    if list_key != "list":
+                        stream.value()
+                        continue
+                    for _ in stream.elements():
+                        self._import_object(stream)
+            elif key in ("name", "type", "id"):
+                info[key] = stream.value()
+            else:
+                stream.value()
+
+    def _skip_messages(self, stream):
+        for _ in stream.elements():
+            stream.value()
+
+    def _import_messages(self, stream, info):
+        if "id" not in info:
+            logging.warning(f"Skipping chat {info.get('name')} without an id")
+            return self._skip_messages(stream)
+        chat_id, chat_type = to_chat_id(info["id"], info.get("type"))
+        if (self.chat_ids and chat_id not in self.chat_ids) or \
+                (self.is_allowed and not self.is_allowed(chat_id, chat_type)):
+            logging.info(f"Skipping chat {chat_id} ({info.get('name')})")
+            return self._skip_messages(stream)
+
+        # 与 Pyrogram 一致，私聊没有标题
+        title = None if chat_type in ("ChatType.PRIVATE", "ChatType.BOT") else info.get("name")
+        chat = {"id": chat_id, "type": chat_type, "title": title, "username": None}
+        low = high = count = 0
+        for _ in stream.elements():
+            record = stream.value()
+            # 服务消息不写入索引，但也属于已同步的区间
+            low = min(low, record["id"]) if low else record["id"]
+            high = max(high, record["id"])
+            if record.get("type") != "message":
+                continue
+            self.batch.append(to_message(record, chat))
+            count += 1
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        self.chats += 1
+        logging.info(f"Read {count} messages from chat {chat_id} ({info.get('name')})")
+        if high:
+            self.finished.append((chat_id, low, high))
+
+    def flush(self):
+        if self.batch:
+            messages, self.batch = self.batch, []
+            changed = messages
+            if self.fingerprints:
+                changed = self.fingerprints.changed(messages)
+                self.unchanged += len(messages) - len(changed)
+            if changed:
+                self._upsert(changed)
+                self.imported += len(changed)
+
+    def _upsert(self, messages, retries=3):
+        self.wait_for_index(self.max_lag)
+        for attempt in range(retries):
+            if self.engine.upsert_many(messages) is not None:
+                return
+            time.sleep(2 ** attempt)
+        raise RuntimeError(f"Cannot write {len(messages)} messages to the search engine")
+
+    def wait_for_index(self, max_lag=0):
+        # 未完成的任务保存着文档内容，积压过多会占用大量内存
+        tasks = self.engine.tasks
+        while tasks.lag() > max_lag:
+            time.sleep(tasks.drain_time(tasks.lag() - max_lag))
+            tasks.poll(force=True)
+
+    def _dropped(self, documents):
+        self.failed_chats.update(document["chat"]["id"] for document in documents)
+
+    def _save_checkpoints(self):
+        finished, self.finished = self.finished, []
+        for chat_id, low, high in finished:
+            if chat_id in self.failed_chats:
+                logging.error(f"Some messages of chat {chat_id} could not be indexed, keeping its sync checkpoint")
+                continue
+            checkpoint = merge_checkpoint(self.checkpoints.load(chat_id), low, high)
+            if checkpoint is None:
+                logging.warning(f"Messages {low}-{high} of chat {chat_id} are not adjacent to the synced range, "
+                                f"keeping its sync checkpoint")
+                continue
+            self.checkpoints.save(chat_id, checkpoint)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Import Telegram Desktop result.json exports")
+    parser.add_argument("files", nargs="+", help="result.json files exported by Telegram Desktop")
+    parser.add_argument("--chat", type=int, action="append", dest="chat_ids",
+                        help="only import this chat id, can be repeated")
+    parser.add_argument("--ignore-filter", action="store_true", help="ignore the whitelist/blacklist in sync.ini")
+    return parser
+
+
+if __name__ == "__main__":
+    import redis
+
+    from config import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, IMPORT_BATCH_SIZE, MAX_INDEX_LAG, \
+        SKIP_UNCHANGED
+    from engine import SearchEngine
+    from fingerprint import FingerprintIndex
+    from sync_checkpoint import CheckpointStore
+    from sync_config import ChatFilter
+    from utils import setup_logger
+
+    setup_logger()
+    args = build_parser().parse_args()
+    r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD)
+    importer = ExportImporter(SearchEngine(), CheckpointStore(r), FingerprintIndex(r) if SKIP_UNCHANGED else None,
+                              None if args.ignore_filter else ChatFilter().is_allowed, IMPORT_BATCH_SIZE,
+                              MAX_INDEX_LAG, set(args.chat_ids or ()))
+    for path in args.files:
+        logging.info(f"Importing {path}")
+        importer.import_file(path)
+    logging.info(f"Imported {importer.imported} messages from {importer.chats} chats, "
+                 f"{importer.unchanged} unchanged")
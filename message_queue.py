@@ -0,0 +1,455 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+
+import redis
+
+from config import QUEUE_TRANSPORT, STREAM_CONSUMER_NAME, STREAM_CLAIM_IDLE, QUEUE_COALESCE, QUEUE_HIGH_WATER, \
+    QUEUE_LOW_WATER
+
+QUEUE_KEY = "message_queue"
+STREAM_KEY = "message_stream"
+STREAM_GROUP = "indexer"
+PENDING_KEY = "message_pending"
+# 无法解码的消息移到这里，不再重新投递
+DEAD_LETTER_KEY = "message_dead_letter"
+# 合并模式下队列中保存的是文档 ID 的引用，消息内容保存在 PENDING_KEY 哈希表中
+REF_PREFIX = b"@"
+
+# 只有内容未被更新时才删除，否则说明处理期间又写入了新版本
+COMPARE_AND_DELETE = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return redis.call('HEXISTS', KEYS[1], ARGV[1]) * -1
+"""
+# 写入消息内容，只有新加入的文档才把引用推入队列，两步在同一个脚本中完成，不会留下没有引用的内容
+COALESCE_PUSH = """
+if redis.call('HSET', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+if ARGV[4] == 'stream' then
+    redis.call('XADD', KEYS[2], '*', 'm', ARGV[3])
+else
+    redis.call('LPUSH', KEYS[2], ARGV[3])
+end
+return 1
+"""
+
+
+class ListQueue:
+    """基于 Redis 列表的队列，取出即删除，只适合单个消费者"""
+
+    kind = "list"
+
+    def __init__(self, r, key=QUEUE_KEY):
+        self.r = r
+        self.key = key
+
+    def push(self, payload, doc_id=None):
+        self.r.lpush(self.key, payload)
+
+    def pop(self, count, timeout=0):
+        # 返回 [(handle, payload)]，列表队列的 handle 就是消息本身，失败时可以放回队列
+        payloads = self.r.rpop(self.key, count)
+        if not payloads and timeout:
+            item = self.r.brpop(self.key, timeout=timeout)
+            payloads = [item[1]] if item else []
+        return [(payload, payload) for payload in payloads or []]
+
+    def ack(self, handles):
+        pass
+
+    def nack(self, handles):
+        # 放回队列的出队端，下一次最先被取出
+        if handles:
+            self.r.rpush(self.key, *reversed(handles))
+
+    def length(self):
+        return self.r.llen(self.key)
+
+    def clear(self):
+        self.r.delete(self.key)
+
+
+class StreamQueue:
+    """基于 Redis Streams 消费者组的队列，写入索引成功后才确认，崩溃的消费者留下的消息会被其他消费者接管"""
+
+    kind = "stream"
+
+    def __init__(self, r, key=STREAM_KEY, group=STREAM_GROUP, consumer=STREAM_CONSUMER_NAME,
+                 claim_idle=STREAM_CLAIM_IDLE):
+        self.r = r
+        self.key = key
+        self.group = group
+        self.consumer = consumer
+        self.claim_idle_ms = int(claim_idle * 1000)
+        self.claim_start = "0-0"
+        self.last_claim = 0
+        # 启动时先处理本消费者上次未确认的消息
+        self.read_id = "0"
+        self.ensure_group()
+
+    def ensure_group(self):
+        try:
+            self.r.xgroup_create(self.key, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def push(self, payload, doc_id=None):
+        self.r.xadd(self.key, {"m": payload})
+
+    def pop(self, count, timeout=0):
+        entries = self.reclaim(count)
+        if entries:
+            return entries
+
+        # block=0 表示一直阻塞，不足 1 毫秒的超时按 1 毫秒处理
+        block = max(int(timeout * 1000), 1) if timeout and self.read_id == ">" else None
+        try:
+            response = self.r.xreadgroup(self.group, self.consumer, {self.key: self.read_id}, count=count, block=block)
+        except redis.ResponseError as e:
+            if "NOGROUP" not in str(e):
+                raise
+            self.ensure_group()
+            return []
+
+        messages = response[0][1] if response else []
+        if self.read_id != ">":
+            if messages:
+                self.read_id = messages[-1][0]
+            else:
+                logging.info("Consumer %s has no pending entries left, reading new entries", self.consumer)
+                self.read_id = ">"
+        return self._payloads(messages)
+
+    def reclaim(self, count):
+        # 定期接管空闲时间过长的未确认消息
+        now = time.time()
+        if now - self.last_claim < self.claim_idle_ms / 1000:
+            return []
+        self.last_claim = now
+        response = self.r.xautoclaim(self.key, self.group, self.consumer, self.claim_idle_ms,
+                                     start_id=self.claim_start, count=count)
+        self.claim_start = response[0]
+        entries = self._payloads(response[1])
+        if entries:
+            logging.warning("Reclaimed %s stale entries from %s", len(entries), self.key)
+        return entries
+
+    def _payloads(self, messages):
+        entries = []
+        deleted = []
+        for entry_id, fields in messages:
+            if fields:
+                entries.append((entry_id, fields[b"m"]))
+            else:
+                deleted.append(entry_id)
+        if deleted:
+            self.ack(deleted)
+        return entries
+
+    def ack(self, entry_ids):
+        if not entry_ids:
+            return
+        pipe = self.r.pipeline()
+        pipe.xack(self.key, self.group, *entry_ids)
+        pipe.xdel(self.key, *entry_ids)
+        pipe.execute()
+
+    def nack(self, entry_ids):
+        # 不确认，超过 STREAM_CLAIM_IDLE 后会被重新投递
+        pass
+
+    def length(self):
+        return self.r.xlen(self.key)
+
+    def clear(self):
+        self.r.delete(self.key)
+
+
+class CoalescingQueue:
+    """按文档 ID 合并消息：同一条消息在被处理前多次编辑或重复入队，只会写入最新的版本"""
+
+    def __init__(self, r, transport, key=PENDING_KEY):
+        self.r = r
+        self.transport = transport
+        self.key = key
+        self.compare_and_delete = r.register_script(COMPARE_AND_DELETE)
+        self.coalesce_push = r.register_script(COALESCE_PUSH)
+
+    def push(self, payload, doc_id=None):
+        if doc_id is None:
+            self.transport.push(payload)
+            return
+        # 只有新加入的文档才需要入队，已在队列中的文档只更新内容
+        self.coalesce_push(keys=[self.key, self.transport.key],
+                           args=[doc_id, payload, REF_PREFIX + doc_id.encode(), self.transport.kind])
+
+    def pop(self, count, timeout=0):
+        entries = self.transport.pop(count, timeout)
+        doc_ids = [payload[len(REF_PREFIX):].decode() for _, payload in entries if payload.startswith(REF_PREFIX)]
+        payloads = dict(zip(doc_ids, self.r.hmget(self.key, doc_ids))) if doc_ids else {}
+
+        result = []
+        processed = []
+        for handle, payload in entries:
+            if not payload.startswith(REF_PREFIX):
+                # 升级前入队的消息
+                result.append(((handle, None, None), payload))
+                continue
+            doc_id = payload[len(REF_PREFIX):].decode()
+            latest = payloads.get(doc_id)
+            if latest is None:
+                # 重复的引用，该文档已经被处理
+                processed.append(handle)
+                continue
+            result.append(((handle, doc_id, latest), latest))
+        self.transport.ack(processed)
+        return result
+
+    def ack(self, handles):
+        repush = []
+        for _, doc_id, payload in handles:
+            if doc_id is not None and self.compare_and_delete(keys=[self.key], args=[doc_id, payload]) < 0:
+                repush.append(doc_id)
+        # 处理期间写入了新版本，重新入队
+        for doc_id in repush:
+            self.transport.push(REF_PREFIX + doc_id.encode())
+        self.transport.ack([handle for handle, _, _ in handles])
+
+    def nack(self, handles):
+        self.transport.nack([handle for handle, _, _ in handles])
+
+    def length(self):
+        return self.transport.length()
+
+    def clear(self):
+        self.transport.clear()
+        self.r.delete(self.key)
+
+
+class ShardedQueue:
+    """把一个队列按文档 ID 分给多个工作线程，同一文档的消息总是由同一个线程按入队顺序写入。
+    取出的消息先放在内存中，任一分片为空时由它从底层队列取一批分发给所有分片"""
+
+    def __init__(self, queue, shards, key, max_buffered=None):
+        self.queue = queue
+        self.key = key
+        self.buffers = [deque() for _ in range(shards)]
+        self.shards = [QueueShard(self, index) for index in range(shards)]
+        self.max_buffered = max_buffered
+        self.filling = False
+        self.cond = threading.Condition()
+
+    def _shard(self, payload):
+        try:
+            return zlib.crc32(self.key(payload).encode()) % len(self.buffers)
+        except Exception as e:
+            logging.warning(f"Cannot read document ID from queued message: {str(e)}")
+            return 0
+
+    def _buffered(self):
+        return sum(len(buffer) for buffer in self.buffers)
+
+    def pop(self, index, count, timeout=0):
+        deadline = time.time() + timeout
+        buffer = self.buffers[index]
+        with self.cond:
+            while not buffer:
+                remaining = deadline - time.time()
+                max_buffered = self.max_buffered or count * len(self.buffers) * 2
+                if not self.filling and self._buffered() < max_buffered:
+                    self.filling = True
+                    # 超时已到时不阻塞；剩余时间不足 1 毫秒时底层队列会把它当作 0，即一直阻塞
+                    wait = max(remaining, 0.001) if remaining > 0 else 0
+                    self.cond.release()
+                    try:
+                        entries = self.queue.pop(count * len(self.buffers), wait)
+                    finally:
+                        self.cond.acquire()
+                        self.filling = False
+                    for handle, payload in entries:
+                        self.buffers[self._shard(payload)].append((handle, payload))
+                    self.cond.notify_all()
+                elif remaining > 0:
+                    self.cond.wait(remaining)
+                if remaining <= 0:
+                    break
+            entries = [buffer.popleft() for _ in range(min(count, len(buffer)))]
+            if entries:
+                # 缓冲区有空间了，唤醒等待的分片
+                self.cond.notify_all()
+            return entries
+
+    def ack(self, handles):
+        self.queue.ack(handles)
+
+    def nack(self, handles):
+        self.queue.nack(handles)
+
+    def requeue(self, index, entries):
+        # 处理失败的消息放回所属分片缓冲区的最前面，之后仍先于同一文档较新的消息写入；
+        # 放回底层队列的话，缓冲区中的新版本会先被写入，再被旧版本覆盖
+        if not entries:
+            return
+        with self.cond:
+            self.buffers[index].extendleft(reversed(entries))
+            self.cond.notify_all()
+
+    def length(self):
+        with self.cond:
+            return self.queue.length() + self._buffered()
+
+    def clear(self):
+        with self.cond:
+            for buffer in self.buffers:
+                buffer.clear()
+        self.queue.clear()
+
+    def close(self):
+        # 停止后把还没有被处理的消息还给底层队列
+        with self.cond:
+            handles = [handle for buffer in self.buffers for handle, _ in buffer]
+            for buffer in self.buffers:
+                buffer.clear()
+        if handles:
+            logging.info(f"Returning {len(handles)} buffered messages to the queue")
+            self.queue.nack(handles)
+
+
+class SpillingQueue:
+    """给队列加上高低水位：队列长度超过 high_water 或 Redis 不可用时，新消息写入本地的 SpillLog；
+    磁盘上还有消息时新消息也写入磁盘，保持顺序，消费者在队列低于 low_water 后按顺序把它们放回队列"""
+
+    def __init__(self, queue, spill, high_water=QUEUE_HIGH_WATER, low_water=QUEUE_LOW_WATER,
+                 check_interval=1, refill_batch=1000):
+        self.queue = queue
+        self.spill = spill
+        self.high_water = high_water
+        self.low_water = low_water
+        self.check_interval = check_interval
+        self.refill_batch = refill_batch
+        # 估算的队列长度，每 check_interval 秒从 Redis 更新一次，其间按写入的条数累加
+        self.depth = 0
+        self.last_check = 0
+        self.lock = threading.Lock()
+
+    def push(self, payload, doc_id=None):
+        with self.lock:
+            if not len(self.spill):
+                try:
+                    if time.time() - self.last_check >= self.check_interval:
+                        self.depth = self.queue.length()
+                        self.last_check = time.time()
+                    if self.depth < self.high_water:
+                        self.queue.push(payload, doc_id)
+                        self.depth += 1
+                        return
+                    logging.warning(f"Queue has {self.depth} messages, spilling to {self.spill.directory}")
+                except (redis.ConnectionError, redis.TimeoutError) as e:
+                    logging.error(f"Redis is unavailable, spilling to {self.spill.directory}: {str(e)}")
+            self.spill.append(payload, doc_id)
+
+    def refill(self):
+        # 由消费者调用，队列低于低水位时把磁盘上的消息按顺序放回，最多补到高水位
+        if not len(self.spill):
+            return 0
+        with self.lock:
+            depth = self.queue.length()
+            if depth >= self.low_water:
+                return 0
+            records, position = self.spill.read(min(self.high_water - depth, self.refill_batch))
+            # 中途失败时不提交读取位置，已放回的消息之后会重复入队，重复写入索引不影响结果
+            for doc_id, payload in records:
+                self.queue.push(payload, doc_id)
+            self.spill.commit(position, len(records))
+            self.depth = depth + len(records)
+            self.last_check = time.time()
+        if not len(self.spill):
+            logging.info("Spilled messages have been drained back into the queue")
+        return len(records)
+
+    def pop(self, count, timeout=0):
+        try:
+            self.refill()
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            logging.warning(f"Cannot drain spilled messages yet: {str(e)}")
+        return self.queue.pop(count, timeout)
+
+    def ack(self, handles):
+        self.queue.ack(handles)
+
+    def nack(self, handles):
+        self.queue.nack(handles)
+
+    def length(self):
+        return self.queue.length() + len(self.spill)
+
+    def clear(self):
+        with self.lock:
+            self.spill.clear()
+            self.queue.clear()
+
+    def close(self):
+        self.spill.close()
+
+
+class QueueShard:
+    """ShardedQueue 中一个工作线程看到的队列"""
+
+    def __init__(self, sharded, index):
+        self.sharded = sharded
+        self.index = index
+        # 已取出、尚未确认的消息，nack 时需要连同内容放回缓冲区
+        self.inflight = []
+
+    def pop(self, count, timeout=0):
+        entries = self.sharded.pop(self.index, count, timeout)
+        self.inflight.extend(entries)
+        return entries
+
+    def _release(self, handles):
+        released = [entry for entry in self.inflight if entry[0] in handles]
+        self.inflight = [entry for entry in self.inflight if entry[0] not in handles]
+        return released
+
+    def ack(self, handles):
+        self._release(handles)
+        self.sharded.ack(handles)
+
+    def nack(self, handles):
+        self.sharded.requeue(self.index, self._release(handles))
+
+    def length(self):
+        return len(self.sharded.buffers[self.index])
+
+
+def get_queue(r):
+    if QUEUE_TRANSPORT == "stream":
+        transport = StreamQueue(r)
+    else:
+        transport = ListQueue(r)
+    if QUEUE_COALESCE:
+        return CoalescingQueue(r, transport)
+    return transport
+
+
+def get_spilling_queue(queue):
+    # QUEUE_HIGH_WATER 为 0 时不使用磁盘缓冲；每个写入进程需要单独的 SPILL_DIR
+    if not QUEUE_HIGH_WATER:
+        return queue
+    from spill import SpillLog
+    return SpillingQueue(queue, SpillLog())
+
+
+def is_coalescing(queue):
+    if isinstance(queue, SpillingQueue):
+        queue = queue.queue
+    return isinstance(queue, CoalescingQueue)
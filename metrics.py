@@ -0,0 +1,229 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import bisect
+import json
+import logging
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 延迟直方图默认的桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Counter:
+    """只增不减的计数"""
+
+    type = "counter"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, "", self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """当前值；设置了 function 时在读取时才计算，不占用消息处理路径"""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception as e:
+            logging.warning(f"Failed to read gauge {self.name}: {str(e)}")
+            return float("nan")
+
+    def samples(self):
+        return [(self.name, "", self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram:
+    """按固定的桶统计分布，quantile 由桶的上界估算"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # 最后一个是 +Inf 桶
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return 0
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, total_sum = self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            samples.append((f"{self.name}_bucket", f'{{le="{le}"}}', cumulative))
+        samples.append((f"{self.name}_count", "", total))
+        samples.append((f"{self.name}_sum", "", total_sum))
+        return samples
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum, "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            # 重复注册时返回已有的指标，模块可以被多次导入
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation):
+    return REGISTRY.register(Counter(name, documentation))
+
+
+def gauge(name, documentation, function=None):
+    metric = REGISTRY.register(Gauge(name, documentation))
+    if function is not None:
+        metric.function = function
+    return metric
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, buckets))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = REGISTRY.render().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/stats.json":
+            body = json.dumps(REGISTRY.snapshot()).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="127.0.0.1"):
+    # 端口为 0 时不启动
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logging.error(f"Failed to start metrics endpoint on {host}:{port}: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def fetch_snapshot(port, host="127.0.0.1", timeout=2):
+    # 读取另一个进程（例如 client.py）的指标
+    with urllib.request.urlopen(f"http://{host}:{port}/stats.json", timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def summarize(snapshot):
+    # /stats 命令使用的简短文本，直方图显示估算的 p50/p99
+    lines = []
+    for name, value in sorted(snapshot.items()):
+        name = name.replace("searchgram_", "", 1)
+        if isinstance(value, dict):
+            if value["count"]:
+                lines.append(f"{name}: {value['count']} samples, avg {value['sum'] / value['count'] * 1000:.1f}ms, "
+                             f"p50 <= {value['p50'] * 1000:g}ms, p99 <= {value['p99'] * 1000:g}ms")
+            else:
+                lines.append(f"{name}: no samples")
+        elif isinstance(value, float):
+            lines.append(f"{name}: {value:.2f}")
+        else:
+            lines.append(f"{name}: {value}")
+    return "\n".join(lines)
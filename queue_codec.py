@@ -0,0 +1,138 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import json
+import logging
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from config import QUEUE_CODEC, QUEUE_COMPRESS_THRESHOLD
+
+# 旧格式为 JSON，第一个字节总是 "{"；新格式第一个字节为版本号
+VERSION_MSGPACK = 1
+VERSION_MSGPACK_ZLIB = 2
+VERSION_MSGPACK_ZSTD = 3
+
+CHAT_TYPES = ["ChatType.PRIVATE", "ChatType.BOT", "ChatType.GROUP", "ChatType.SUPERGROUP", "ChatType.CHANNEL"]
+CHAT_TYPE_INDEX = {chat_type: index for index, chat_type in enumerate(CHAT_TYPES)}
+
+if zstandard:
+    _zstd_compressor = zstandard.ZstdCompressor()
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+
+
+def _pack(message):
+    # 按位置存储字段，不重复写入键名
+    chat = message["chat"]
+    from_user = message.get("from_user")
+    return [
+        message["id"],
+        chat["id"],
+        CHAT_TYPE_INDEX.get(chat["type"], chat["type"]),
+        chat.get("title"),
+        chat.get("username"),
+        message["date"],
+        message.get("text"),
+        message.get("caption"),
+        [from_user["id"], from_user["first_name"], from_user["last_name"], from_user["username"]]
+        if from_user else None,
+        message.get("timestamp"),
+    ]
+
+
+def _unpack(fields):
+    message_id, chat_id, chat_type, title, username, date, text, caption, from_user = fields[:9]
+    # 新增的字段追加在末尾，旧消息中没有
+    timestamp = fields[9] if len(fields) > 9 else None
+    return {
+        "id": message_id,
+        "chat": {
+            "id": chat_id,
+            "type": CHAT_TYPES[chat_type] if isinstance(chat_type, int) else chat_type,
+            "title": title,
+            "username": username,
+        },
+        "date": date,
+        "timestamp": timestamp,
+        "text": text,
+        "caption": caption,
+        "from_user": {
+            "id": from_user[0],
+            "first_name": from_user[1],
+            "last_name": from_user[2],
+            "username": from_user[3],
+        } if from_user else None,
+    }
+
+
+def encode_message(message, codec=QUEUE_CODEC):
+    if codec not in ("msgpack", "zstd") or msgpack is None:
+        return json.dumps(message)
+
+    body = msgpack.packb(_pack(message), use_bin_type=True)
+    if len(body) < QUEUE_COMPRESS_THRESHOLD:
+        return bytes([VERSION_MSGPACK]) + body
+    if codec == "zstd" and zstandard:
+        return bytes([VERSION_MSGPACK_ZSTD]) + _zstd_compressor.compress(body)
+    return bytes([VERSION_MSGPACK_ZLIB]) + zlib.compress(body)
+
+
+def decode_message(payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    version = payload[0]
+    if version == ord("{"):
+        return json.loads(payload)
+
+    body = payload[1:]
+    if version == VERSION_MSGPACK_ZLIB:
+        body = zlib.decompress(body)
+    elif version == VERSION_MSGPACK_ZSTD:
+        if zstandard is None:
+            raise ValueError("Queued message is compressed with zstd but the zstandard package is not installed")
+        body = _zstd_decompressor.decompress(body)
+    elif version != VERSION_MSGPACK:
+        raise ValueError(f"Unknown queue payload version {version}")
+    return _unpack(msgpack.unpackb(body, raw=False))
+
+
+def get_doc_id(message):
+    return f"{message.chat.id}-{message.id}"
+
+
+def serialize_message(message):
+    chat = message.chat
+    return encode_message({
+        'id': message.id,
+        'chat': {
+            'id': chat.id,
+            'type': str(chat.type),
+            'title': getattr(chat, 'title', None),
+            'username': getattr(chat, 'username', None)
+        },
+        'date': message.date.isoformat(),
+        'timestamp': int(message.date.timestamp()),
+        'text': message.text,
+        'caption': message.caption,
+        'from_user': {
+            'id': message.from_user.id if message.from_user else None,
+            'first_name': message.from_user.first_name if message.from_user else None,
+            'last_name': message.from_user.last_name if message.from_user else None,
+            'username': message.from_user.username if message.from_user else None
+        } if message.from_user else None
+    })
+
+
+if QUEUE_CODEC in ("msgpack", "zstd") and msgpack is None:
+    logging.warning("msgpack is not installed, queued messages will be encoded as JSON")
+if QUEUE_CODEC == "zstd" and zstandard is None:
+    logging.warning("zstandard is not installed, queued messages will be compressed with zlib")
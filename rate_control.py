@@ -0,0 +1,72 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import threading
+import time
+
+from config import INDEX_RATE, INDEX_RATE_MIN, INDEX_RATE_MAX, INDEX_RATE_INCREASE, INDEX_RATE_DECREASE, \
+    INDEX_TARGET_LAG, INDEX_TARGET_LATENCY
+
+
+class AdaptiveRateLimiter:
+    """按批次限流的 AIMD 控制器：搜索引擎空闲时每秒线性提高速率，任务积压、延迟升高或写入失败时按比例降低"""
+
+    def __init__(self, rate=INDEX_RATE, min_rate=INDEX_RATE_MIN, max_rate=INDEX_RATE_MAX,
+                 increase=INDEX_RATE_INCREASE, decrease=INDEX_RATE_DECREASE, target_lag=INDEX_TARGET_LAG,
+                 target_latency=INDEX_TARGET_LATENCY):
+        self.initial_rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.target_lag = target_lag
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.rate = min(max(self.initial_rate, self.min_rate), self.max_rate)
+            # 下一个批次最早可以开始的时间
+            self.next_time = 0
+            self.last_decrease = 0
+            self.increases = 0
+            self.decreases = 0
+
+    def reserve(self):
+        # 预约下一个时间片，返回距离该时间片的秒数
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + 1 / self.rate
+        return start - now
+
+    def acquire(self):
+        # 直接睡到预约的时间片，不轮询；返回等待的秒数
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def feedback(self, lag, latency=0, error=False):
+        with self.lock:
+            now = time.monotonic()
+            if error or lag > self.target_lag or latency > self.target_latency:
+                # 一次拥塞可能被多个批次观察到，两次降速之间至少间隔一个时间片和一秒
+                if now - self.last_decrease >= max(1 / self.rate, 1):
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.last_decrease = now
+                    self.decreases += 1
+            elif self.rate < self.max_rate:
+                # 每个批次增加 increase / rate，即每秒增加 increase
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+                self.increases += 1
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "min_rate": self.min_rate,
+            "max_rate": self.max_rate,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
@@ -2,83 +2,436 @@
 # coding: utf-8
 
 import logging
+import re
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
 import meilisearch
-from meilisearch.errors import MeiliSearchApiError
-from config import MEILI_HOST, MEILI_PASS
-from utils import sizeof_fmt
+from meilisearch.errors import MeiliSearchApiError, MeiliSearchError
+
+import metrics
+from config import MEILI_HOST, MEILI_PASS, TASK_POLL_INTERVAL, TASK_MAX_RETRIES, SEARCH_CROP_LENGTH, \
+    SEARCH_HIGHLIGHT_TAGS
+from utils import sizeof_fmt, build_document, to_epoch
+
+# 搜索结果只返回 bot 渲染需要的字段，正文由 MeiliSearch 截取匹配位置附近的片段放在 _formatted 中
+RESULT_ATTRIBUTES = [
+    "ID", "message_id", "date", "chat.id", "chat.type", "chat.title",
+    "from_user.first_name", "from_user.last_name", "from_user.username",
+]
+SNIPPET_ATTRIBUTES = ["text", "caption"]
+
+INDEX_NAME = "telegram"
+# 搜索结果 offset + limit 的上限（MeiliSearch pagination.maxTotalHits 的默认值）
+MAX_TOTAL_HITS = 1000
+# 记录已应用的索引设置版本
+META_INDEX = "searchgram_meta"
+REBUILD_INDEX = f"{INDEX_NAME}_rebuild"
+
+# 索引设置，修改后需要增加版本号；启动时只应用与线上不同的部分
+INDEX_SETTINGS_VERSION = 2
+INDEX_SETTINGS = {
+    "filterableAttributes": ["chat.id", "chat.type", "from_user.id", "timestamp"],
+    "sortableAttributes": ["timestamp"],
+    "rankingRules": ["timestamp:desc", "words", "typo", "proximity", "attribute", "sort", "exactness"],
+}
+# 这些设置与顺序无关
+UNORDERED_SETTINGS = {"filterableAttributes", "sortableAttributes", "searchableAttributes", "displayedAttributes"}
+
+task_latency = metrics.histogram("searchgram_index_task_seconds", "MeiliSearch task latency from enqueue to finish")
+tasks_failed = metrics.counter("searchgram_index_tasks_failed_total", "MeiliSearch document tasks that failed")
+upsert_errors = metrics.counter("searchgram_upsert_errors_total", "add_documents requests rejected by MeiliSearch")
+search_latency = metrics.histogram("searchgram_search_seconds", "MeiliSearch search request latency")
+search_errors = metrics.counter("searchgram_search_errors_total", "MeiliSearch search requests that failed")
+
+
+def parse_task_time(value):
+    # MeiliSearch 返回纳秒精度的时间，datetime 只支持到微秒
+    return datetime.fromisoformat(re.sub(r"(\.\d{6})\d+", r"\1", value.replace("Z", "+00:00")))
+
+
+def document_fields(document):
+    # meilisearch-python 的 Document 迭代时还会返回保存原始字典的私有属性 _Document__doc
+    return {key: value for key, value in dict(document).items() if not key.startswith("_Document")}
+
+
+class TaskTracker:
+    """记录 add_documents 返回的任务，定期批量查询任务状态，失败的任务会重新提交文档"""
+
+    def __init__(self, client, resubmit, poll_interval=TASK_POLL_INTERVAL, max_retries=TASK_MAX_RETRIES):
+        self.client = client
+        self.resubmit = resubmit
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        # task_uid -> (documents, enqueued_at, retries, sequence)
+        self.pending = {}
+        # 文档 ID -> 最后一次提交它的任务序号，失败任务重试时跳过之后又提交过新版本的文档
+        self.versions = {}
+        self.sequence = 0
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=1000)
+        # 最近任务的平均延迟（入队到完成）和处理时间（开始到完成），用于调整写入速率
+        self.latency = 0
+        self.processing_time = 0
+        self.last_poll = 0
+        self.lock = threading.Lock()
+        # 任务成功后、或重试多次仍失败而放弃时以其文档调用，在调用 poll 的线程中执行
+        self.on_succeeded = None
+        self.on_dropped = None
+
+    def track(self, task, documents, retries=0):
+        with self.lock:
+            self.sequence += 1
+            self.pending[task.task_uid] = (documents, time.time(), retries, self.sequence)
+            for document in documents:
+                self.versions[document["ID"]] = self.sequence
+            self.enqueued += 1
+
+    def lag(self):
+        return len(self.pending)
+
+    def poll(self, force=False):
+        now = time.time()
+        if not self.pending or (not force and now - self.last_poll < self.poll_interval):
+            return
+        self.last_poll = now
+
+        with self.lock:
+            uids = list(self.pending)
+        failed = []
+        # 每次最多查询 1000 个任务
+        for i in range(0, len(uids), 1000):
+            chunk = uids[i:i + 1000]
+            try:
+                tasks = self.client.get_tasks({"uids": [str(uid) for uid in chunk], "limit": len(chunk)})
+            except MeiliSearchError as e:
+                logging.error(f"Error polling MeiliSearch tasks: {str(e)}")
+                return
+            # meilisearch-python 0.25 返回的任务是字典
+            for task in tasks["results"]:
+                if task["status"] not in ("succeeded", "failed", "canceled"):
+                    continue
+                with self.lock:
+                    documents, enqueued_at, retries, sequence = self.pending.pop(task["uid"], (None, now, 0, 0))
+                if documents is None:
+                    continue
+                if task.get("startedAt") and task.get("finishedAt"):
+                    processing_time = (parse_task_time(task["finishedAt"]) -
+                                       parse_task_time(task["startedAt"])).total_seconds()
+                    self.processing_time = self._ewma(self.processing_time, processing_time)
+                if task["status"] == "succeeded":
+                    self.processed += 1
+                    latency = self._latency(task, enqueued_at)
+                    self.latencies.append(latency)
+                    self.latency = self._ewma(self.latency, latency)
+                    task_latency.observe(latency)
+                    if self.on_succeeded:
+                        self.on_succeeded(documents)
+                else:
+                    self.failed += 1
+                    tasks_failed.inc()
+                    failed.append((task, documents, retries, sequence))
+
+        for task, documents, retries, sequence in failed:
+            with self.lock:
+                latest = [document for document in documents if self.versions.get(document["ID"], 0) <= sequence]
+            if len(latest) < len(documents):
+                logging.info(f"Task {task['uid']}: {len(documents) - len(latest)} documents have newer versions, "
+                             f"not re-enqueueing them")
+                documents = latest
+                if not documents:
+                    continue
+            if retries >= self.max_retries:
+                logging.error(f"Task {task['uid']} failed {retries + 1} times, dropping {len(documents)} documents: "
+                              f"{task.get('error')}")
+                if self.on_dropped:
+                    self.on_dropped(documents)
+                continue
+            logging.warning(f"Task {task['uid']} {task['status']}, re-enqueueing {len(documents)} documents: "
+                            f"{task.get('error')}")
+            if self.resubmit(documents, retries + 1) is None and self.on_dropped:
+                self.on_dropped(documents)
+        self._prune_versions()
+
+    def _prune_versions(self):
+        # 只有未完成的任务需要比较版本，早于最旧的未完成任务的记录不再需要
+        with self.lock:
+            oldest = min((entry[3] for entry in self.pending.values()), default=None)
+            if oldest is None:
+                self.versions.clear()
+            else:
+                self.versions = {key: value for key, value in self.versions.items() if value >= oldest}
+
+    def drain_time(self, count):
+        # 按最近的任务处理时间估算处理完 count 个任务需要的秒数
+        if not self.processing_time:
+            return self.poll_interval
+        return min(max(count * self.processing_time, 0.1), self.poll_interval)
+
+    @staticmethod
+    def _ewma(average, value, alpha=0.2):
+        return value if not average else average + alpha * (value - average)
+
+    @staticmethod
+    def _latency(task, enqueued_at):
+        if task.get("enqueuedAt") and task.get("finishedAt"):
+            return (parse_task_time(task["finishedAt"]) - parse_task_time(task["enqueuedAt"])).total_seconds()
+        return time.time() - enqueued_at
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "lag": self.lag(),
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0,
+        }
 
 
 class SearchEngine:
     def __init__(self):
         try:
             self.client = meilisearch.Client(MEILI_HOST, MEILI_PASS)
+            self.tasks = TaskTracker(self.client, self._add_documents)
             self.ensure_index_exists()
+            self.reconcile_settings()
         except Exception as e:
             logging.critical(f"Failed to connect to MeiliSearch: {str(e)}")
             raise
 
-    def ensure_index_exists(self):
+    def ensure_index_exists(self, uid=INDEX_NAME):
+        if self._create_index(uid):
+            self.reconcile_settings(uid)
+
+    def _create_index(self, uid):
         try:
-            self.client.get_index("telegram")
+            self.client.get_index(uid)
+            return False
         except MeiliSearchApiError:
-            logging.info("Creating new 'telegram' index")
-            self.client.create_index("telegram", {"primaryKey": "ID"})
-            self.client.index("telegram").update_filterable_attributes(["chat.id", "chat.type"])
-            self.client.index("telegram").update_ranking_rules(
-                ["timestamp:desc", "words", "typo", "proximity", "attribute", "sort", "exactness"]
+            logging.info(f"Creating new '{uid}' index")
+            self.wait_for_task(self.client.create_index(uid, {"primaryKey": "ID"}).task_uid)
+            return True
+
+    def reconcile_settings(self, uid=INDEX_NAME):
+        index = self.client.index(uid)
+        current = index.get_settings()
+        changes = {
+            key: value for key, value in INDEX_SETTINGS.items()
+            if not self._same_setting(key, current.get(key), value)
+        }
+        if changes:
+            logging.info(f"Applying index settings v{INDEX_SETTINGS_VERSION} to '{uid}': {changes}")
+            task = self.wait_for_task(index.update_settings(changes).task_uid)
+            if task["status"] != "succeeded":
+                logging.error(f"Failed to apply index settings to '{uid}': {task.get('error')}")
+                return False
+        if self.settings_version(uid) != INDEX_SETTINGS_VERSION:
+            self._create_index(META_INDEX)
+            task = self.client.index(META_INDEX).add_documents(
+                [{"ID": uid, "settings_version": INDEX_SETTINGS_VERSION}], primary_key="ID"
             )
-            self.client.index("telegram").update_sortable_attributes(["timestamp"])
+            self.wait_for_task(task.task_uid)
+        return True
 
-    def upsert(self, message):
+    @staticmethod
+    def _same_setting(key, current, expected):
+        if key in UNORDERED_SETTINGS:
+            return set(current or []) == set(expected)
+        return current == expected
+
+    def settings_version(self, uid=INDEX_NAME):
         try:
-            data = {
-                "ID": f"{message['chat']['id']}-{message['id']}",
-                "message_id": message['id'],
-                "chat": message['chat'],
-                "date": message['date'],
-                "text": message.get('text', ''),
-                "caption": message.get('caption', ''),
-                "from_user": message.get('from_user', {}),
-                "timestamp": message['date']
-            }
+            return getattr(self.client.index(META_INDEX).get_document(uid), "settings_version", 0)
+        except MeiliSearchApiError:
+            return 0
 
-            self.client.index("telegram").add_documents([data], primary_key="ID")
-        except MeiliSearchApiError as e:
-            logging.error(f"Error upserting document: {str(e)}")
-            self.ensure_index_exists()
+    def backfill_timestamps(self, progress=None, batch_size=1000):
+        """把旧文档中字符串形式的 timestamp 更新为数字"""
+        index = self.client.index(INDEX_NAME)
+        offset = 0
+        updated = 0
+        task = None
+        while True:
+            documents = index.get_documents(
+                {"offset": offset, "limit": batch_size, "fields": ["ID", "date", "timestamp"]}
+            ).results
+            if not documents:
+                break
+            offset += len(documents)
+            changes = [
+                {"ID": document.ID, "timestamp": to_epoch(document.date)}
+                for document in documents if isinstance(getattr(document, "timestamp", None), str)
+            ]
+            if changes:
+                task = index.update_documents(changes, primary_key="ID")
+                updated += len(changes)
+            if progress:
+                progress(f"Scanned {offset} documents, updated {updated}")
+        if task:
+            self.wait_for_task(task.task_uid)
+        return updated
+
+    def rebuild_index(self, transform=None, progress=None, batch_size=1000):
+        """把线上索引的文档复制到新建的索引中（可用 transform 修改文档），完成后交换，搜索不会中断。
+        重建期间新写入线上索引的文档不会被复制，最好先停止 client.py"""
+        self.wait_for_task(self.client.index(REBUILD_INDEX).delete().task_uid)
+        self.ensure_index_exists(REBUILD_INDEX)
+
+        source = self.client.index(INDEX_NAME)
+        target = self.client.index(REBUILD_INDEX)
+        offset = 0
+        task = None
+        while True:
+            documents = source.get_documents({"offset": offset, "limit": batch_size}).results
+            if not documents:
+                break
+            documents = [document_fields(document) for document in documents]
+            if transform:
+                documents = [transform(document) for document in documents]
+            task = target.add_documents(documents, primary_key="ID")
+            offset += len(documents)
+            if progress:
+                progress(f"Copied {offset} documents to '{REBUILD_INDEX}'")
+        if task:
+            task = self.wait_for_task(task.task_uid)
+            if task["status"] != "succeeded":
+                raise RuntimeError(f"Failed to rebuild index: {task.get('error')}")
+
+        task = self.wait_for_task(self.client.swap_indexes([{"indexes": [INDEX_NAME, REBUILD_INDEX]}]).task_uid)
+        if task["status"] != "succeeded":
+            raise RuntimeError(f"Failed to swap indexes: {task.get('error')}")
+        # 交换后 REBUILD_INDEX 是旧索引
+        self.wait_for_task(self.client.index(REBUILD_INDEX).delete().task_uid)
+        self.reconcile_settings()
+        return offset
+
+    def upsert(self, message):
+        return self.upsert_many([message])
+
+    def upsert_many(self, messages):
+        # 一次性构建所有文档，通过单个 add_documents 请求写入
+        if not messages:
+            return None
+        return self._add_documents([build_document(message) for message in messages])
+
+    def _add_documents(self, documents, retries=0):
+        try:
+            task = self.client.index(INDEX_NAME).add_documents(documents, primary_key="ID")
+            self.tasks.track(task, documents, retries)
+            return task
+        except MeiliSearchError as e:
+            # 连接错误或超时时同样返回 None，由调用方 nack 消息
+            upsert_errors.inc()
+            logging.error(f"Error upserting {len(documents)} documents: {str(e)}")
+            if isinstance(e, MeiliSearchApiError):
+                self.ensure_index_exists()
+            return None
 
-    def search(self, keyword, _type=None, user=None, page=1, mode=None) -> dict:
+    def search(self, keyword, _type=None, user=None, page=1, mode=None, page_size=10, since=None,
+               until=None) -> dict:
         try:
             if mode:
                 keyword = f'"{keyword}"'
             user = self._clean_user(user)
+            # 使用 page/hitsPerPage 分页，返回精确的 totalHits
             params = {
-                "limit": 10,
-                "offset": (page - 1) * 10,
+                "hitsPerPage": page_size,
+                "page": page,
                 "sort": ["timestamp:desc"],
                 "matchingStrategy": "all" if mode else "last",
                 "filter": None,
+                "attributesToRetrieve": RESULT_ATTRIBUTES,
+                "attributesToCrop": SNIPPET_ATTRIBUTES,
+                "cropLength": SEARCH_CROP_LENGTH,
             }
-            if user or _type:
-                filter_conditions = []
-                if user:
-                    filter_conditions.append(f"chat.id = {user}")
-                if _type:
-                    filter_conditions.append(f"chat.type = {_type}")
+            if SEARCH_HIGHLIGHT_TAGS:
+                params["attributesToHighlight"] = SNIPPET_ATTRIBUTES
+                params["highlightPreTag"], params["highlightPostTag"] = SEARCH_HIGHLIGHT_TAGS
+            filter_conditions = self._filter_conditions(user, _type, since, until)
+            if filter_conditions:
                 params["filter"] = " AND ".join(filter_conditions)
 
             logging.info(f"Search params: {params}")
-            result = self.client.index("telegram").search(keyword, params)
-            logging.info(f"Search result: {result}")
+            with search_latency.time():
+                result = self.client.index(INDEX_NAME).search(keyword, params)
+            logging.debug(f"Search result: {result}")
             return result
         except MeiliSearchApiError as e:
+            search_errors.inc()
             if e.error_code == "index_not_found":
                 logging.warning("Index not found during search, attempting to recreate")
                 self.ensure_index_exists()
-                return {"hits": [], "estimatedTotalHits": 0}
+                return {"hits": [], "totalHits": 0}
             logging.error(f"Error during search: {str(e)}")
             raise
 
+    @staticmethod
+    def _filter_conditions(user=None, _type=None, since=None, until=None):
+        conditions = []
+        if user:
+            conditions.append(f"chat.id = {user}")
+        if _type:
+            conditions.append(f"chat.type = {_type}")
+        if since:
+            conditions.append(f"timestamp >= {since}")
+        if until:
+            conditions.append(f"timestamp <= {until}")
+        return conditions
+
+    def iter_documents(self, keyword="", _type=None, user=None, mode=None, since=None, until=None, batch_size=500):
+        # 按时间从新到旧逐批返回所有匹配的完整文档。每批的条件是 timestamp <= 上一批最后的时间戳，
+        # offset 只跳过该时间戳上已经返回的文档，不受 maxTotalHits 对 offset + limit 的限制
+        if mode and keyword:
+            keyword = f'"{keyword}"'
+        base_conditions = self._filter_conditions(self._clean_user(user), _type, since, until)
+        cursor = None
+        # 时间戳等于 cursor、已经返回的文档
+        seen = set()
+        while True:
+            conditions = list(base_conditions)
+            limit = min(batch_size, MAX_TOTAL_HITS - len(seen))
+            if cursor is not None:
+                if limit > 0:
+                    conditions.append(f"timestamp <= {cursor}")
+                else:
+                    logging.warning(f"More than {MAX_TOTAL_HITS} messages at timestamp {cursor}, skipping the rest")
+                    conditions.append(f"timestamp < {cursor}")
+                    seen = set()
+                    limit = batch_size
+            params = {
+                "limit": limit,
+                "offset": len(seen),
+                "sort": ["timestamp:desc"],
+                "matchingStrategy": "all" if mode else "last",
+                "filter": " AND ".join(conditions) or None,
+            }
+            with search_latency.time():
+                hits = self.client.index(INDEX_NAME).search(keyword, params)["hits"]
+            for hit in hits:
+                if hit["ID"] in seen:
+                    continue
+                if hit.get("timestamp") != cursor:
+                    cursor = hit.get("timestamp")
+                    seen = set()
+                seen.add(hit["ID"])
+                yield hit
+            if len(hits) < limit or cursor is None:
+                return
+
+    def last_update(self):
+        try:
+            return self.client.get_all_stats()["lastUpdate"]
+        except MeiliSearchApiError as e:
+            logging.error(f"Error reading MeiliSearch stats: {str(e)}")
+            return None
+
     def ping(self):
         try:
             text = "Pong!\n"
@@ -95,19 +448,22 @@ class SearchEngine:
 
     def clean_db(self):
         try:
-            self.client.delete_index("telegram")
+            self.wait_for_task(self.client.delete_index(INDEX_NAME).task_uid)
             self.ensure_index_exists()
             return "Database cleaned and index recreated"
         except MeiliSearchApiError as e:
             logging.error(f"Error cleaning database: {str(e)}")
             return "Error: Unable to clean database"
 
-    def delete_messages(self, chat_id=None, user_id=None):
+    def delete_messages(self, chat_id=None, user_id=None, progress=None):
         if chat_id is None and user_id is None:
             # 删除所有消息
             try:
-                self.client.index("telegram").delete_all_documents()
-                return "All messages have been deleted."
+                task = self.client.index(INDEX_NAME).delete_all_documents()
+                task = self.wait_for_task(task.task_uid, progress)
+                if task["status"] != "succeeded":
+                    return f"Error occurred while deleting all messages: {task.get('error')}"
+                return f"All {self._task_detail(task, 'deletedDocuments')} messages have been deleted."
             except MeiliSearchApiError as e:
                 logging.error(f"Error deleting all messages: {str(e)}")
                 return f"Error occurred while deleting all messages: {str(e)}"
@@ -119,26 +475,43 @@ class SearchEngine:
             filter_conditions.append(f"from_user.id = {user_id}")
 
         filter_string = " AND ".join(filter_conditions)
-        params = {
-            "filter": filter_string,
-            "limit": 1000,
-        }
-
-        deleted_count = 0
         try:
-            while True:
-                results = self.client.index("telegram").search("", params)
-                if not results["hits"]:
-                    break
-
-                ids_to_delete = [hit["ID"] for hit in results["hits"]]
-                self.client.index("telegram").delete_documents(ids_to_delete)
-                deleted_count += len(ids_to_delete)
-
-            return f"Deleted {deleted_count} messages"
+            estimated = self.client.index(INDEX_NAME).search("", {"filter": filter_string, "limit": 0})
+            if progress:
+                progress(f"Deleting about {estimated['estimatedTotalHits']} messages...")
+            # 在服务端通过一个任务按条件删除
+            response = self.client.http.post(
+                f"{self.client.config.paths.index}/{INDEX_NAME}/{self.client.config.paths.document}/delete",
+                {"filter": filter_string},
+            )
+            task = self.wait_for_task(response["taskUid"], progress)
+            if task["status"] != "succeeded":
+                return f"Error occurred while deleting messages: {task.get('error')}"
+            return f"Deleted {self._task_detail(task, 'deletedDocuments')} messages"
         except MeiliSearchApiError as e:
             logging.error(f"Error deleting messages: {str(e)}")
-            return f"Error occurred. Deleted {deleted_count} messages before error: {str(e)}"
+            return f"Error occurred while deleting messages: {str(e)}"
+
+    def wait_for_task(self, task_uid, progress=None, timeout=3600, interval=1):
+        start = time.time()
+        status = None
+        last_report = 0
+        while True:
+            task = self.client.get_task(task_uid)
+            if task["status"] in ("succeeded", "failed", "canceled"):
+                return task
+            # 状态变化或每 10 秒报告一次进度
+            if progress and (task["status"] != status or time.time() - last_report >= 10):
+                progress(f"Task {task_uid} is {task['status']}, {int(time.time() - start)}s elapsed...")
+                last_report = time.time()
+            status = task["status"]
+            if time.time() - start > timeout:
+                raise TimeoutError(f"Task {task_uid} did not finish in {timeout}s")
+            time.sleep(interval)
+
+    @staticmethod
+    def _task_detail(task, key):
+        return (task.get("details") or {}).get(key, 0)
 
     @staticmethod
     def _clean_user(user):
@@ -150,4 +523,9 @@ class SearchEngine:
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     search_engine = SearchEngine()
-    print(search_engine.ping())
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "--rebuild":
+        print(f"Rebuilt index with {search_engine.rebuild_index(progress=logging.info)} documents")
+    elif len(sys.argv) > 1 and sys.argv[1] == "--backfill-timestamps":
+        print(f"Updated timestamp of {search_engine.backfill_timestamps(progress=logging.info)} documents")
+    else:
+        print(search_engine.ping())
\ No newline at end of file
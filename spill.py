@@ -0,0 +1,201 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from config import SPILL_DIR, SPILL_SEGMENT_SIZE, SPILL_FSYNC_INTERVAL
+
+# 每条记录：长度、CRC32、文档 ID 长度（0xFFFF 表示没有），然后是文档 ID 和消息内容
+HEADER = struct.Struct(">IIH")
+NO_DOC_ID = 0xFFFF
+SEGMENT_PREFIX = "spill-"
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor"
+
+
+class SpillLog:
+    """按段存储的只追加磁盘日志，队列过长或 Redis 不可用时暂存消息，之后按写入顺序读回。
+    每次追加都写入操作系统，进程被杀死也不会丢失；每 fsync_interval 秒最多 fsync 一次（空闲时由定时器补上），
+    机器崩溃时最多丢失这段时间内写入的记录"""
+
+    def __init__(self, directory=SPILL_DIR, segment_size=SPILL_SEGMENT_SIZE, fsync_interval=SPILL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.writer = None
+        self.write_segment = 0
+        self.last_fsync = 0
+        self.dirty = False
+        self.timer = None
+        os.makedirs(directory, exist_ok=True)
+        # 读取位置：(段号, 偏移)
+        self.read_segment, self.read_offset = self._load_cursor()
+        self.pending = self._recover()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{segment:010d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)]
+        return sorted(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for name in names)
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (FileNotFoundError, ValueError):
+            return 0, 0
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{self.read_segment} {self.read_offset}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _read_record(f):
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        length, crc, doc_id_length = HEADER.unpack(header)
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body) != crc:
+            return None
+        if doc_id_length == NO_DOC_ID:
+            return None, body, HEADER.size + length
+        return body[:doc_id_length].decode(), body[doc_id_length:], HEADER.size + length
+
+    def _recover(self):
+        # 统计未读的记录数，并截掉最后一段末尾写了一半的记录
+        segments = self._segments()
+        pending = 0
+        for segment in segments:
+            if segment < self.read_segment:
+                os.remove(self._path(segment))
+                continue
+            offset = self.read_offset if segment == self.read_segment else 0
+            with open(self._path(segment), "rb") as f:
+                f.seek(offset)
+                while record := self._read_record(f):
+                    offset += record[2]
+                    pending += 1
+            if segment == segments[-1] and offset < os.path.getsize(self._path(segment)):
+                logging.warning(f"Truncating torn record at {self._path(segment)}:{offset}")
+                os.truncate(self._path(segment), offset)
+        self.write_segment = max(segments[-1] if segments else 0, self.read_segment)
+        if pending:
+            logging.info(f"Spill log {self.directory} has {pending} messages to drain")
+        return pending
+
+    def append(self, payload, doc_id=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        doc_id_bytes = doc_id.encode() if doc_id is not None else b""
+        body = doc_id_bytes + payload
+        record = HEADER.pack(len(body), zlib.crc32(body), len(doc_id_bytes) if doc_id is not None else NO_DOC_ID)
+        with self.lock:
+            if self.writer is None:
+                self.writer = open(self._path(self.write_segment), "ab")
+            elif self.writer.tell() >= self.segment_size:
+                self._sync()
+                self.writer.close()
+                self.write_segment += 1
+                self.writer = open(self._path(self.write_segment), "ab")
+            self.writer.write(record + body)
+            self.writer.flush()
+            self.pending += 1
+            self.dirty = True
+            elapsed = time.time() - self.last_fsync
+            if elapsed >= self.fsync_interval:
+                self._sync()
+            elif self.timer is None:
+                # 之后没有新的写入时，由定时器 fsync 这段时间写入的记录
+                self.timer = threading.Timer(self.fsync_interval - elapsed, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _sync(self):
+        if self.writer and self.dirty:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.dirty = False
+        self.last_fsync = time.time()
+
+    def _cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def sync(self):
+        with self.lock:
+            self.timer = None
+            self._sync()
+
+    def read(self, count):
+        # 从读取位置开始读出最多 count 条 [(doc_id, payload)]，提交后才移动读取位置
+        with self.lock:
+            if self.writer:
+                self.writer.flush()
+            records = []
+            segment, offset = self.read_segment, self.read_offset
+            while len(records) < count and segment <= self.write_segment:
+                try:
+                    f = open(self._path(segment), "rb")
+                except FileNotFoundError:
+                    f = None
+                if f:
+                    with f:
+                        f.seek(offset)
+                        while len(records) < count and (record := self._read_record(f)):
+                            records.append(record[:2])
+                            offset += record[2]
+                if len(records) < count and segment < self.write_segment:
+                    segment, offset = segment + 1, 0
+                else:
+                    break
+            return records, (segment, offset)
+
+    def commit(self, position, count):
+        # 删除已经读完的段，保存读取位置
+        with self.lock:
+            segment, offset = position
+            for old in range(self.read_segment, segment):
+                if os.path.exists(self._path(old)):
+                    os.remove(self._path(old))
+            self.read_segment, self.read_offset = segment, offset
+            self.pending = max(self.pending - count, 0)
+            self._save_cursor()
+
+    def __len__(self):
+        return self.pending
+
+    def clear(self):
+        with self.lock:
+            self._cancel_timer()
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            for segment in self._segments():
+                os.remove(self._path(segment))
+            self.write_segment = self.read_segment = self.write_segment + 1
+            self.read_offset = 0
+            self.pending = 0
+            self._save_cursor()
+
+    def close(self):
+        with self.lock:
+            self._cancel_timer()
+            self._sync()
+            if self.writer:
+                self.writer.close()
+                self.writer = None
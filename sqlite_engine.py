@@ -0,0 +1,302 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+from config import SQLITE_PATH, SEARCH_CROP_LENGTH, SEARCH_HIGHLIGHT_TAGS
+from utils import sizeof_fmt, build_document
+
+# 中日韩字符逐字分开，交给 unicode61 分词后每个字都是一个词，搜索时按短语匹配相邻的字
+CJK_PATTERN = re.compile(r"([぀-ヿ㐀-䶿一-鿿豈-﫿가-힯])")
+CJK_RUN_PATTERN = re.compile(r"^[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]+$")
+TOKEN_PATTERN = re.compile(r"\w+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    ID TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    chat_type TEXT,
+    user_id INTEGER,
+    timestamp INTEGER NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat ON messages (chat_id, timestamp);
+CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, tokenize = 'unicode61');
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def segment(text):
+    return CJK_PATTERN.sub(r" \1 ", text or "")
+
+
+class NullTaskTracker:
+    """SQLite 同步写入，没有需要跟踪的异步任务"""
+
+    enqueued = processed = failed = 0
+    latency = processing_time = 0
+    on_succeeded = on_dropped = None
+
+    def poll(self, force=False):
+        pass
+
+    def drain_time(self, count):
+        return 0
+
+    def lag(self):
+        return 0
+
+    def stats(self):
+        return {"enqueued": 0, "processed": 0, "failed": 0, "lag": 0, "latency_avg": 0, "latency_p95": 0}
+
+
+class SearchEngine:
+    """基于 SQLite FTS5 的搜索引擎，接口与 MeiliSearch 版本相同，不需要额外的服务"""
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.tasks = NullTaskTracker()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        # WAL 模式下 bot 读取时不会阻塞 client 写入
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.ensure_index_exists()
+
+    def ensure_index_exists(self):
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+
+    def upsert(self, message):
+        return self.upsert_many([message])
+
+    def upsert_many(self, messages):
+        if not messages:
+            return None
+        documents = [build_document(message) for message in messages]
+        try:
+            with self.lock, self.conn:
+                for document in documents:
+                    self._upsert_document(document)
+                self._touch()
+        except sqlite3.Error as e:
+            logging.error(f"Error upserting {len(documents)} documents: {str(e)}")
+            return None
+        # 事务提交后文档即已写入
+        if self.tasks.on_succeeded:
+            self.tasks.on_succeeded(documents)
+        return len(documents)
+
+    def _upsert_document(self, document):
+        chat = document["chat"]
+        from_user = document["from_user"] or {}
+        self.conn.execute(
+            "INSERT INTO messages (ID, chat_id, chat_type, user_id, timestamp, document) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(ID) DO UPDATE SET chat_type = excluded.chat_type, user_id = excluded.user_id, "
+            "timestamp = excluded.timestamp, document = excluded.document",
+            (document["ID"], chat["id"], chat["type"], from_user.get("id"), document["timestamp"],
+             json.dumps(document, ensure_ascii=False)),
+        )
+        # 不使用 RETURNING，它需要 SQLite 3.35
+        row = self.conn.execute("SELECT rowid FROM messages WHERE ID = ?", (document["ID"],)).fetchone()
+        body = segment(f"{document['text'] or ''} {document['caption'] or ''}")
+        self.conn.execute("DELETE FROM messages_fts WHERE rowid = ?", (row[0],))
+        self.conn.execute("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)", (row[0], body))
+
+    def _touch(self):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_update', ?)",
+                          (datetime.now().isoformat(),))
+
+    @staticmethod
+    def _match_query(keyword, mode):
+        # 关键词中没有可搜索的词时返回空字符串
+        if mode:
+            if not TOKEN_PATTERN.search(keyword):
+                return ""
+            # 精确匹配：整个关键词作为一个短语
+            return '"' + segment(keyword).replace('"', '""') + '"'
+        terms = []
+        for term in keyword.split():
+            tokens = TOKEN_PATTERN.findall(segment(term))
+            if not tokens:
+                continue
+            if len(tokens) == 1 and not CJK_RUN_PATTERN.match(tokens[0]):
+                terms.append(f'"{tokens[0]}"*')
+            else:
+                terms.append('"' + " ".join(tokens) + '"')
+        return " AND ".join(terms)
+
+    @staticmethod
+    def _filters(chat_id=None, _type=None, user_id=None, since=None, until=None):
+        conditions = []
+        params = []
+        if chat_id and str(chat_id).lstrip("-").isdigit():
+            conditions.append("m.chat_id = ?")
+            params.append(int(chat_id))
+        elif chat_id:
+            conditions.append("json_extract(m.document, '$.chat.username') = ?")
+            params.append(chat_id)
+        if _type:
+            conditions.append("m.chat_type IN (?, ?)")
+            params.extend([_type, f"ChatType.{_type}"])
+        if user_id:
+            conditions.append("m.user_id = ?")
+            params.append(int(user_id))
+        if since:
+            conditions.append("m.timestamp >= ?")
+            params.append(since)
+        if until:
+            conditions.append("m.timestamp <= ?")
+            params.append(until)
+        return conditions, params
+
+    def search(self, keyword, _type=None, user=None, page=1, mode=None, page_size=10, since=None,
+               until=None) -> dict:
+        conditions, params = self._filters(self._clean_user(user), _type, since=since, until=until)
+        match = self._match_query(keyword, mode) if keyword else ""
+        if keyword.strip() and not match:
+            # 只有标点等无法搜索的字符，不能当作空关键词返回所有消息
+            return {"hits": [], "totalHits": 0, "totalPages": 0, "page": page, "hitsPerPage": page_size}
+        if match:
+            source = "messages_fts f JOIN messages m ON m.rowid = f.rowid"
+            conditions.insert(0, "messages_fts MATCH ?")
+            params.insert(0, match)
+        else:
+            source = "messages m"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self.lock:
+            total = self.conn.execute(f"SELECT count(*) FROM {source} {where}", params).fetchone()[0]
+            rows = self.conn.execute(
+                f"SELECT m.document FROM {source} {where} ORDER BY m.timestamp DESC LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size],
+            ).fetchall()
+
+        hits = []
+        for row in rows:
+            hit = json.loads(row["document"])
+            hit["_formatted"] = {key: self._crop(hit.get(key), keyword) for key in ("text", "caption")}
+            hits.append(hit)
+        return {
+            "hits": hits,
+            "totalHits": total,
+            "totalPages": (total - 1) // page_size + 1 if total else 0,
+            "page": page,
+            "hitsPerPage": page_size,
+        }
+
+    def iter_documents(self, keyword="", _type=None, user=None, mode=None, since=None, until=None,
+                       batch_size=1000):
+        # 按 (timestamp, rowid) 从新到旧逐批返回所有匹配的完整文档，每批从上一批的最后一行之后继续
+        conditions, params = self._filters(self._clean_user(user), _type, since=since, until=until)
+        match = self._match_query(keyword, mode) if keyword else ""
+        if keyword.strip() and not match:
+            return
+        if match:
+            source = "messages_fts f JOIN messages m ON m.rowid = f.rowid"
+            conditions.insert(0, "messages_fts MATCH ?")
+            params.insert(0, match)
+        else:
+            source = "messages m"
+        cursor = None
+        while True:
+            page_conditions = list(conditions)
+            page_params = list(params)
+            if cursor:
+                page_conditions.append("(m.timestamp < ? OR (m.timestamp = ? AND m.rowid < ?))")
+                page_params.extend([cursor[0], cursor[0], cursor[1]])
+            where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ""
+            with self.lock:
+                rows = self.conn.execute(
+                    f"SELECT m.rowid, m.timestamp, m.document FROM {source} {where} "
+                    f"ORDER BY m.timestamp DESC, m.rowid DESC LIMIT ?",
+                    page_params + [batch_size],
+                ).fetchall()
+            for row in rows:
+                yield json.loads(row["document"])
+            if len(rows) < batch_size:
+                return
+            cursor = (rows[-1]["timestamp"], rows[-1]["rowid"])
+
+    @staticmethod
+    def _crop(text, keyword):
+        # 截取第一个匹配位置附近的内容，与 MeiliSearch 的 cropLength 类似（按字符计算）
+        if not text:
+            return text
+        length = SEARCH_CROP_LENGTH * 4
+        position = -1
+        for term in (keyword or "").split():
+            position = text.lower().find(term.lower())
+            if position >= 0:
+                if SEARCH_HIGHLIGHT_TAGS:
+                    pre, post = SEARCH_HIGHLIGHT_TAGS
+                    text = f"{text[:position]}{pre}{text[position:position + len(term)]}{post}" \
+                           f"{text[position + len(term):]}"
+                break
+        start = max(0, position - length // 2) if position >= 0 else 0
+        snippet = text[start:start + length]
+        return f"{'…' if start else ''}{snippet}{'…' if start + length < len(text) else ''}"
+
+    def last_update(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'last_update'").fetchone()
+        return row[0] if row else None
+
+    def ping(self):
+        try:
+            with self.lock:
+                count = self.conn.execute("SELECT count(*) FROM messages").fetchone()[0]
+            size = sum(os.path.getsize(path) for path in (self.path, f"{self.path}-wal") if os.path.exists(path))
+            return (f"Pong!\nSQLite database {self.path} has {count} documents\n"
+                    f"\nDatabase size: {sizeof_fmt(size)}\nLast update: {self.last_update()}\n")
+        except sqlite3.Error as e:
+            logging.error(f"Error pinging SQLite: {str(e)}")
+            return "Error: Unable to ping SQLite"
+
+    def clean_db(self):
+        try:
+            with self.lock, self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS messages_fts")
+                self.conn.execute("DROP TABLE IF EXISTS messages")
+            self.ensure_index_exists()
+            return "Database cleaned and index recreated"
+        except sqlite3.Error as e:
+            logging.error(f"Error cleaning database: {str(e)}")
+            return "Error: Unable to clean database"
+
+    def delete_messages(self, chat_id=None, user_id=None, progress=None):
+        conditions, params = self._filters(chat_id, user_id=user_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    f"DELETE FROM messages_fts WHERE rowid IN (SELECT m.rowid FROM messages m {where})", params
+                )
+                deleted = self.conn.execute(f"DELETE FROM messages AS m {where}", params).rowcount
+                self._touch()
+            if chat_id is None and user_id is None:
+                return f"All {deleted} messages have been deleted."
+            return f"Deleted {deleted} messages"
+        except sqlite3.Error as e:
+            logging.error(f"Error deleting messages: {str(e)}")
+            return f"Error occurred while deleting messages: {str(e)}"
+
+    @staticmethod
+    def _clean_user(user):
+        if user:
+            return user.strip().replace("@", "")
+        return None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(SearchEngine().ping())
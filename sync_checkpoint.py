@@ -0,0 +1,165 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import threading
+import time
+
+CHECKPOINT_PREFIX = "sync_checkpoint:"
+# 旧版本在聊天同步完成后保存的消息 ID，旧版本从最新的消息向前同步，这是到达的最旧消息
+LEGACY_PREFIX = "last_synced:"
+# 客户端最近一次在线收到消息的时间，启动补齐时用来判断哪些对话可能有缺口
+LAST_SEEN_KEY = "sync_last_seen"
+
+# high 只增不减：同步任务和实时消息可能同时更新同一个聊天的检查点，不能用较小的值覆盖较大的值
+SAVE_CHECKPOINT = """
+local high = tonumber(redis.call('HGET', KEYS[1], 'high') or 0)
+if tonumber(ARGV[1]) > high then
+    high = ARGV[1]
+end
+redis.call('HSET', KEYS[1], 'high', high, 'low', ARGV[2], 'backfilled', ARGV[3])
+"""
+SET_HIGH = """
+if tonumber(ARGV[1]) > tonumber(redis.call('HGET', KEYS[1], 'high') or 0) then
+    redis.call('HSET', KEYS[1], 'high', ARGV[1])
+end
+"""
+
+
+class Checkpoint:
+    """一个聊天的同步检查点：low 到 high 之间的消息都已入队，backfilled 表示 low 之前的历史也已同步完"""
+
+    def __init__(self, high=0, low=0, backfilled=False):
+        self.high = high
+        self.low = low
+        self.backfilled = backfilled
+
+    @classmethod
+    def from_redis(cls, fields):
+        return cls(int(fields.get(b"high", 0)), int(fields.get(b"low", 0)), fields.get(b"backfilled") == b"1")
+
+    def to_redis(self):
+        return {"high": self.high, "low": self.low, "backfilled": int(self.backfilled)}
+
+    def __repr__(self):
+        return f"Checkpoint(high={self.high}, low={self.low}, backfilled={self.backfilled})"
+
+
+def checkpoint_key(chat_id):
+    return f"{CHECKPOINT_PREFIX}{chat_id}"
+
+
+def legacy_checkpoint(legacy_id, status, head_id=0):
+    """把旧版本的 last_synced:<uid> 和 sync_status.json 中的记录转换为检查点，没有旧记录时返回 None。
+    旧版本只记录了到达的最旧消息：已完成的聊天以当前最新的消息 head_id 作为 high；
+    未完成的聊天以最旧消息作为 low，high 也设为 low，启动时先补齐 low 之后的所有消息再继续回填"""
+    # last_synced 只在同步完成时写入，没有 sync_status.json 记录时也说明已经完成
+    if status.get("completed") or (legacy_id and not status):
+        return Checkpoint(head_id, legacy_id or status.get("last_id", 0), True)
+    low = status.get("last_id") or legacy_id
+    if not low:
+        return None
+    return Checkpoint(low, low, False)
+
+
+class CheckpointStore:
+    """每个聊天的检查点保存在一个 Redis 哈希表中，由 Lua 脚本原子地更新所有字段"""
+
+    def __init__(self, r):
+        self.r = r
+        self.save_script = r.register_script(SAVE_CHECKPOINT)
+        self.set_high_script = r.register_script(SET_HIGH)
+
+    def load(self, chat_id):
+        fields = self.r.hgetall(checkpoint_key(chat_id))
+        return Checkpoint.from_redis(fields) if fields else Checkpoint()
+
+    def exists(self, chat_id):
+        return bool(self.r.exists(checkpoint_key(chat_id)))
+
+    def load_legacy(self, uid):
+        return int(self.r.get(f"{LEGACY_PREFIX}{uid}") or 0)
+
+    @staticmethod
+    def _save_args(checkpoint):
+        fields = checkpoint.to_redis()
+        return [fields["high"], fields["low"], fields["backfilled"]]
+
+    def save(self, chat_id, checkpoint):
+        self.save_script(keys=[checkpoint_key(chat_id)], args=self._save_args(checkpoint))
+
+    def set_high(self, chat_id, message_id):
+        self.set_high_script(keys=[checkpoint_key(chat_id)], args=[message_id])
+
+    def load_last_seen(self):
+        return float(self.r.get(LAST_SEEN_KEY) or 0)
+
+    def save_last_seen(self, timestamp):
+        self.r.set(LAST_SEEN_KEY, timestamp)
+
+
+class LiveMarks:
+    """实时收到的消息推进各聊天检查点的 high。重启后聊天的离线缺口补齐之前只记在内存中，补齐后才写入，
+    否则补齐中断时缺口中的消息会被当作已经同步"""
+
+    def __init__(self, store, last_seen_interval=10):
+        self.store = store
+        self.last_seen_interval = last_seen_interval
+        self.marks = {}
+        self.released = set()
+        self.blocked = set()
+        self.all_released = False
+        self.last_seen = 0
+        self.lock = threading.Lock()
+
+    def _is_released(self, chat_id):
+        return chat_id in self.released or (self.all_released and chat_id not in self.blocked)
+
+    def seen(self, chat_id, message_id):
+        with self.lock:
+            if message_id > self.marks.get(chat_id, 0):
+                self.marks[chat_id] = message_id
+                if self._is_released(chat_id):
+                    self.store.set_high(chat_id, message_id)
+            if self.all_released and time.time() - self.last_seen >= self.last_seen_interval:
+                self.last_seen = time.time()
+                self.store.save_last_seen(self.last_seen)
+
+    def release(self, chat_id):
+        # 该聊天的缺口已经补齐
+        with self.lock:
+            self.blocked.discard(chat_id)
+            if chat_id not in self.released:
+                self.released.add(chat_id)
+                if chat_id in self.marks:
+                    self.store.set_high(chat_id, self.marks[chat_id])
+
+    def release_all(self, blocked=()):
+        # 启动补齐完成，除 blocked 中仍在补齐的聊天外都可以写入
+        with self.lock:
+            self.all_released = True
+            self.blocked = set(blocked) - self.released
+            for chat_id, message_id in self.marks.items():
+                if self._is_released(chat_id):
+                    self.store.set_high(chat_id, message_id)
+            self.last_seen = time.time()
+            self.store.save_last_seen(self.last_seen)
+
+
+class AsyncCheckpointStore(CheckpointStore):
+    """CheckpointStore 的 asyncio 版本，r 为 redis.asyncio 客户端"""
+
+    async def load(self, chat_id):
+        fields = await self.r.hgetall(checkpoint_key(chat_id))
+        return Checkpoint.from_redis(fields) if fields else Checkpoint()
+
+    async def exists(self, chat_id):
+        return bool(await self.r.exists(checkpoint_key(chat_id)))
+
+    async def load_legacy(self, uid):
+        return int(await self.r.get(f"{LEGACY_PREFIX}{uid}") or 0)
+
+    async def save(self, chat_id, checkpoint):
+        await self.save_script(keys=[checkpoint_key(chat_id)], args=self._save_args(checkpoint))
+
+    async def set_high(self, chat_id, message_id):
+        await self.set_high_script(keys=[checkpoint_key(chat_id)], args=[message_id])
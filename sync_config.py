@@ -0,0 +1,109 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import configparser
+import json
+import logging
+import os
+import stat
+import tempfile
+
+SYNC_CONFIG_FILE = "sync.ini"
+# 旧版本的同步进度文件，现在由 Redis 中的检查点代替
+SYNC_STATUS_FILE = "sync_status.json"
+
+
+def load_config(path=SYNC_CONFIG_FILE):
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.optionxform = lambda option: option
+    config.read(path)
+    return config
+
+
+def load_sync_status(path=SYNC_STATUS_FILE):
+    # 旧版本按 sync.ini 中的 uid 记录 {"completed": ..., "last_id": ...}，只在迁移检查点时读取
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        logging.warning(f"Cannot parse {path}, ignoring the legacy sync status")
+        return {}
+
+
+def save_config(config, path=SYNC_CONFIG_FILE):
+    # 先写临时文件再替换，inode 改变后其他进程的 ChatFilter 会立即重新加载
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".sync.", suffix=".ini")
+    try:
+        with os.fdopen(fd, "w") as f:
+            config.write(f)
+        # mkstemp 创建的文件权限是 0600，保留原文件的权限
+        if os.path.exists(path):
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class ChatFilter:
+    """sync.ini 中白名单/黑名单的内存缓存，只在文件发生变化时重新解析"""
+
+    def __init__(self, path=SYNC_CONFIG_FILE):
+        self.path = path
+        self.signature = None
+        self.config = None
+        # (whitelist_ids, whitelist_types, blacklist_ids, blacklist_types)
+        self.rules = (frozenset(), frozenset(), frozenset(), frozenset())
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_ino, st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        signature = self._stat()
+        if signature is not None and signature == self.signature:
+            return
+        config = load_config(self.path)
+        self.rules = self._compile(config, "whitelist") + self._compile(config, "blacklist")
+        self.config = config
+        self.signature = signature
+        logging.info("Loaded chat filter from %s", self.path)
+
+    @staticmethod
+    def _compile(config, section):
+        options = config.options(section) if config.has_section(section) else []
+        # 聊天类型以 `ChatType.GROUP` 的形式写在配置中
+        types = frozenset(option.strip("`") for option in options if option.startswith("`"))
+        ids = frozenset(option for option in options if not option.startswith("`"))
+        return ids, types
+
+    def is_allowed(self, chat_id, chat_type):
+        self.refresh()
+        whitelist_ids, whitelist_types, blacklist_ids, blacklist_types = self.rules
+        chat_id_str = str(chat_id)
+        chat_type_str = str(chat_type)
+
+        if whitelist_ids or whitelist_types:
+            return chat_id_str in whitelist_ids or chat_type_str in whitelist_types
+        elif blacklist_ids or blacklist_types:
+            return chat_id_str not in blacklist_ids and chat_type_str not in blacklist_types
+        return True
+
+
+def get_chat_id(chat):
+    if isinstance(chat, int):
+        return chat
+    if isinstance(chat, str):
+        if chat.startswith('-100'):
+            return int(chat)
+        elif chat.startswith('-'):
+            return int(chat)
+        else:
+            return int(chat)
+    return chat.id
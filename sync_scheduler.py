@@ -0,0 +1,336 @@
+#!/usr/local/bin/python3
+# coding: utf-8
+
+import asyncio
+import heapq
+import logging
+import threading
+import time
+
+from pyrogram.errors import FloodWait
+
+from sync_checkpoint import Checkpoint
+from config import SYNC_CONCURRENCY, SYNC_REQUEST_RATE, SYNC_CHUNK_SIZE, GAP_FILL_DIALOGS, GAP_FILL_MAX_MESSAGES
+from utils import TokenBucket
+
+# get_chat_history 每次请求最多返回 100 条消息
+HISTORY_PAGE_SIZE = 100
+# get_dialogs 每次请求最多返回 100 个对话
+DIALOG_PAGE_SIZE = 100
+
+
+class RequestBudget:
+    """所有同步任务共享的 Telegram 请求预算，遇到 FloodWait 时全局暂停"""
+
+    def __init__(self, rate=SYNC_REQUEST_RATE):
+        self.bucket = TokenBucket(tokens=max(1, rate), fill_rate=rate)
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        # 成功时返回 0，否则返回需要等待的秒数
+        with self.lock:
+            wait = self.paused_until - time.time()
+            if wait <= 0:
+                if self.bucket.consume(1):
+                    return 0
+                wait = (1 - self.bucket.tokens) / self.bucket.fill_rate
+            return wait
+
+    def acquire(self):
+        while wait := self.try_acquire():
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while wait := self.try_acquire():
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+class ChatSync:
+    """单个聊天的同步进度。先补齐检查点 high 之后的新消息，再从 low 继续向前回填历史，
+    两个阶段都从较新的消息向较旧的消息同步"""
+
+    CATCH_UP = "catching up"
+    BACKFILL = "backfilling"
+
+    def __init__(self, uid, chat_id, checkpoint=None, total=0):
+        self.uid = uid
+        self.chat_id = chat_id
+        self.checkpoint = checkpoint or Checkpoint()
+        # 继续回填时消息 ID 是 low 之前剩余消息数的估计，用于排序，不需要再请求消息总数
+        self.total = total or (0 if self.checkpoint.backfilled else self.checkpoint.low)
+        if self.checkpoint.high:
+            self.phase = self.CATCH_UP
+            # 下一次请求从该 ID 之前的消息开始，0 表示从最新的消息开始
+            self.offset_id = 0
+        else:
+            self.phase = self.BACKFILL
+            self.offset_id = self.checkpoint.low
+        # 补齐阶段看到的最新消息，完成后成为新的 high
+        self.top_id = self.checkpoint.high
+        self.synced = 0
+        self.completed = False
+        self.error = None
+
+    def remaining(self):
+        # 补齐阶段通常只有少量新消息，优先处理
+        if self.phase == self.CATCH_UP:
+            return 0
+        return max(self.total - self.synced, 0)
+
+    def add(self, msg):
+        # 每条取到的消息都调用一次，返回 False 表示当前阶段已经结束，不再需要更旧的消息
+        if self.phase == self.CATCH_UP:
+            if msg.id <= self.checkpoint.high:
+                self.finish_catch_up()
+                return False
+            self.top_id = max(self.top_id, msg.id)
+        else:
+            if not self.checkpoint.high:
+                self.checkpoint.high = msg.id
+            self.checkpoint.low = msg.id
+        self.offset_id = msg.id
+        self.synced += 1
+        return True
+
+    def is_new(self, msg):
+        return self.phase == self.BACKFILL or msg.id > self.checkpoint.high
+
+    def finish_catch_up(self):
+        # high 之后的消息都已入队，检查点才能前移；否则中断后会漏掉中间的消息
+        self.checkpoint.high = max(self.checkpoint.high, self.top_id)
+        self.phase = self.BACKFILL
+        if self.checkpoint.backfilled:
+            self.completed = True
+        else:
+            self.offset_id = self.checkpoint.low
+
+    def end_of_history(self):
+        if self.phase == self.CATCH_UP:
+            self.finish_catch_up()
+        else:
+            self.checkpoint.backfilled = True
+            self.completed = True
+
+    def __lt__(self, other):
+        return self.remaining() < other.remaining()
+
+
+class SyncScheduler:
+    """并发同步多个聊天的历史消息，每次只同步一个分块，小聊天先完成，大聊天轮流继续"""
+
+    def __init__(self, app, enqueue, checkpoints, on_progress=None, on_complete=None, budget=None,
+                 concurrency=SYNC_CONCURRENCY, chunk_size=SYNC_CHUNK_SIZE):
+        self.app = app
+        self.enqueue = enqueue
+        # 每请求一页消息保存一次检查点，中断后最多重复入队一页
+        self.checkpoints = checkpoints
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.budget = budget or RequestBudget()
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.chats = []
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def add(self, chat_sync):
+        with self.lock:
+            self.chats.append(chat_sync)
+            heapq.heappush(self.heap, chat_sync)
+
+    def run(self):
+        workers = [threading.Thread(target=self._worker, name=f"sync-{i}") for i in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                if not self.heap:
+                    return
+                chat_sync = heapq.heappop(self.heap)
+
+            try:
+                self._sync_chunk(chat_sync)
+            except FloodWait as e:
+                logging.warning(f"FloodWait while syncing {chat_sync.uid}, pausing sync for {e.value}s")
+                self.budget.pause(e.value)
+            except Exception as e:
+                logging.error(f"Error syncing history for {chat_sync.uid}: {str(e)}")
+                chat_sync.error = str(e)
+
+            if self.on_progress:
+                self.on_progress(chat_sync)
+            if chat_sync.completed:
+                if self.on_complete:
+                    self.on_complete(chat_sync)
+            elif chat_sync.error is None:
+                self.add_back(chat_sync)
+
+    def add_back(self, chat_sync):
+        with self.lock:
+            heapq.heappush(self.heap, chat_sync)
+
+    def _sync_chunk(self, chat_sync):
+        count = 0
+        self.budget.acquire()
+        try:
+            for msg in self.app.get_chat_history(chat_sync.chat_id, limit=self.chunk_size,
+                                                 offset_id=chat_sync.offset_id):
+                count += 1
+                if chat_sync.is_new(msg):
+                    self.enqueue(msg)
+                if not chat_sync.add(msg):
+                    return
+                # 下一页会在继续迭代时请求
+                if count % HISTORY_PAGE_SIZE == 0:
+                    self.checkpoints.save(chat_sync.chat_id, chat_sync.checkpoint)
+                    if count < self.chunk_size:
+                        self.budget.acquire()
+
+            if count < self.chunk_size:
+                chat_sync.end_of_history()
+        finally:
+            self.checkpoints.save(chat_sync.chat_id, chat_sync.checkpoint)
+
+    def summary(self):
+        lines = []
+        for chat_sync in self.chats:
+            if chat_sync.error:
+                state = f"error: {chat_sync.error}"
+            elif chat_sync.completed:
+                state = "done"
+            else:
+                state = chat_sync.phase
+            total = f"/{chat_sync.total}" if chat_sync.total else ""
+            lines.append(f"{chat_sync.uid}: {chat_sync.synced}{total} ({state})")
+        return "\n".join(lines)
+
+
+class GapFill:
+    """启动时按最近活跃的顺序遍历对话，同步每个聊天检查点 high 之后的新消息，补齐客户端离线期间漏掉的消息。
+    遍历的对话数和每个聊天补齐的消息数都有上限，请求与历史同步共享预算"""
+
+    def __init__(self, app, enqueue, checkpoints, is_allowed, budget=None, skip=(),
+                 max_dialogs=GAP_FILL_DIALOGS, max_messages=GAP_FILL_MAX_MESSAGES):
+        self.app = app
+        self.enqueue = enqueue
+        self.checkpoints = checkpoints
+        self.is_allowed = is_allowed
+        self.budget = budget or RequestBudget()
+        # [sync] 中的聊天由 SyncScheduler 的补齐阶段处理，不受消息数上限限制
+        self.skip = set(skip)
+        self.max_dialogs = max_dialogs
+        self.max_messages = max_messages
+        self.dialogs = 0
+        self.chats = 0
+        self.synced = 0
+
+    def run(self, since=0):
+        # since 为上次在线的时间，最后一条消息早于它的对话没有缺口，置顶对话之后遇到第一个这样的对话就停止
+        if not self.max_dialogs:
+            return
+        self.budget.acquire()
+        for dialog in self.app.get_dialogs(limit=self.max_dialogs):
+            self.dialogs += 1
+            if self.dialogs % DIALOG_PAGE_SIZE == 0:
+                self.budget.acquire()
+            top = dialog.top_message
+            if top is None:
+                continue
+            if since and not dialog.is_pinned and top.date.timestamp() < since:
+                break
+            chat = dialog.chat
+            if chat.id in self.skip or not self.is_allowed(chat.id, chat.type):
+                continue
+            # 没有检查点的聊天没有被同步过，不知道从哪里开始补齐
+            checkpoint = self.checkpoints.load(chat.id)
+            if not checkpoint.high or top.id <= checkpoint.high:
+                continue
+            try:
+                self._fill(chat.id, checkpoint, top.id)
+            except FloodWait as e:
+                logging.warning(f"FloodWait while filling gap of {chat.id}, pausing sync for {e.value}s")
+                self.budget.pause(e.value)
+                self._fill(chat.id, checkpoint, top.id)
+
+    def _fill(self, chat_id, checkpoint, top_id):
+        count = 0
+        self.budget.acquire()
+        for msg in self.app.get_chat_history(chat_id, limit=self.max_messages):
+            if msg.id <= checkpoint.high:
+                break
+            self.enqueue(msg)
+            count += 1
+            if count % HISTORY_PAGE_SIZE == 0 and count < self.max_messages:
+                self.budget.acquire()
+        else:
+            if count >= self.max_messages:
+                logging.warning(f"Chat {chat_id} has more than {self.max_messages} new messages since "
+                                f"{checkpoint.high}, only the newest ones were synced")
+        checkpoint.high = max(checkpoint.high, top_id)
+        self.checkpoints.save(chat_id, checkpoint)
+        self.chats += 1
+        self.synced += count
+
+    def summary(self):
+        return f"Gap fill: {self.synced} messages in {self.chats} chats, {self.dialogs} dialogs checked"
+
+
+class AsyncSyncScheduler(SyncScheduler):
+    """SyncScheduler 的 asyncio 版本，每个并发的同步任务是事件循环中的一个 task；app 需要是 async 模式的 Client"""
+
+    async def run(self):
+        await asyncio.gather(*(self._worker() for _ in range(self.concurrency)))
+
+    async def _worker(self):
+        while True:
+            with self.lock:
+                if not self.heap:
+                    return
+                chat_sync = heapq.heappop(self.heap)
+
+            try:
+                await self._sync_chunk(chat_sync)
+            except FloodWait as e:
+                logging.warning(f"FloodWait while syncing {chat_sync.uid}, pausing sync for {e.value}s")
+                self.budget.pause(e.value)
+            except Exception as e:
+                logging.error(f"Error syncing history for {chat_sync.uid}: {str(e)}")
+                chat_sync.error = str(e)
+
+            if self.on_progress:
+                await self.on_progress(chat_sync)
+            if chat_sync.completed:
+                if self.on_complete:
+                    await self.on_complete(chat_sync)
+            elif chat_sync.error is None:
+                self.add_back(chat_sync)
+
+    async def _sync_chunk(self, chat_sync):
+        count = 0
+        await self.budget.acquire_async()
+        try:
+            async for msg in self.app.get_chat_history(chat_sync.chat_id, limit=self.chunk_size,
+                                                       offset_id=chat_sync.offset_id):
+                count += 1
+                if chat_sync.is_new(msg):
+                    self.enqueue(msg)
+                if not chat_sync.add(msg):
+                    return
+                if count % HISTORY_PAGE_SIZE == 0:
+                    await self.checkpoints.save(chat_sync.chat_id, chat_sync.checkpoint)
+                    if count < self.chunk_size:
+                        await self.budget.acquire_async()
+
+            if count < self.chunk_size:
+                chat_sync.end_of_history()
+        finally:
+            await self.checkpoints.save(chat_sync.chat_id, chat_sync.checkpoint)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_async_queue.py
+
+import asyncio
+import unittest
+
+from async_queue import AsyncCoalescingQueue, AsyncListQueue
+from benchmarks.fake_redis import MemoryRedis, MemoryPipeline
+from message_queue import PENDING_KEY
+
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    async def execute(self):
+        return super().execute()
+
+
+class AsyncMemoryRedis:
+    """把 MemoryRedis 的命令包装成协程，模拟 redis.asyncio 客户端"""
+
+    def __init__(self):
+        self.redis = MemoryRedis()
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return AsyncMemoryPipeline(self.redis)
+
+    def register_script(self, script):
+        run = self.redis.register_script(script)
+
+        async def call(keys, args, client=None):
+            if client is not None:
+                client.commands.append((run, (keys, args), {}))
+                return client
+            return run(keys, args)
+        return call
+
+
+class TestAsyncCoalescingQueue(unittest.TestCase):
+    def setUp(self):
+        self.redis = AsyncMemoryRedis()
+        self.queue = AsyncCoalescingQueue(self.redis, AsyncListQueue(self.redis))
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    async def payloads(self):
+        return [payload for _, payload in await self.queue.pop(10)]
+
+    def test_keep_latest_version(self):
+        async def run():
+            await self.queue.push_many([(b"v1", "-100-1"), (b"v2", "-100-1"), (b"plain", None)])
+            self.assertEqual(await self.queue.length(), 2)
+            self.assertEqual(await self.payloads(), [b"v2", b"plain"])
+        self.run_async(run())
+
+    def test_newer_version_after_ack(self):
+        async def run():
+            await self.queue.push_many([(b"v1", "-100-1")])
+            handles = [handle for handle, _ in await self.queue.pop(10)]
+            await self.queue.push_many([(b"v2", "-100-1")])
+            await self.queue.ack(handles)
+            self.assertEqual(await self.payloads(), [b"v2"])
+        self.run_async(run())
+
+    def test_newer_version_after_nack(self):
+        async def run():
+            await self.queue.push_many([(b"v1", "-100-1")])
+            handles = [handle for handle, _ in await self.queue.pop(10)]
+            await self.queue.push_many([(b"v2", "-100-1")])
+            await self.queue.nack(handles)
+            entries = await self.queue.pop(10)
+            self.assertEqual([payload for _, payload in entries], [b"v2"])
+            await self.queue.ack([handle for handle, _ in entries])
+            self.assertEqual(await self.queue.pop(10), [])
+            self.assertFalse(self.redis.redis.hexists(PENDING_KEY, "-100-1"))
+        self.run_async(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_export.py
+
+import csv
+import gzip
+import io
+import json
+import unittest
+
+from export import write_export, build_parser, CSV_FIELDS
+from tests.test_sqlite_engine import make_message
+from utils import build_document
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.documents = [build_document(make_message(i, -100, f"text {i}")) for i in range(3)]
+
+    def test_jsonl(self):
+        buffer = io.BytesIO()
+        self.assertEqual(write_export(iter(self.documents), buffer), 3)
+        lines = gzip.decompress(buffer.getvalue()).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], self.documents)
+
+    def test_csv(self):
+        buffer = io.BytesIO()
+        write_export(iter(self.documents), buffer, "csv")
+        rows = list(csv.reader(io.StringIO(gzip.decompress(buffer.getvalue()).decode())))
+        self.assertEqual(rows[0], CSV_FIELDS)
+        self.assertEqual(rows[1][:2], ["-100-0", "0"])
+        self.assertEqual(rows[1][CSV_FIELDS.index("text")], "text 0")
+
+    def test_parser(self):
+        args = build_parser().parse_args(["-u=-100", "-f=csv", "--since=2024-01-01"])
+        self.assertEqual((args.keyword, args.user, args.format), ("", "-100", "csv"))
+        self.assertIsNotNone(args.since)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_fingerprint.py
+
+import unittest
+from types import SimpleNamespace
+
+from benchmarks.fake_redis import MemoryRedis
+from fingerprint import FingerprintIndex, fingerprint_location
+from search_engine import TaskTracker
+from sqlite_engine import SearchEngine
+from tests.test_sqlite_engine import make_message
+from utils import build_document
+
+
+class TestFingerprintIndex(unittest.TestCase):
+    def setUp(self):
+        self.redis = MemoryRedis()
+        self.index = FingerprintIndex(self.redis)
+
+    def test_skip_unchanged(self):
+        messages = [make_message(1, -100, "hello"), make_message(2, -100, "world")]
+        changed = self.index.changed(messages)
+        self.assertEqual(changed, messages)
+        self.index.record([build_document(message) for message in changed])
+
+        edited = make_message(2, -100, "world, edited")
+        self.assertEqual(self.index.changed([make_message(1, -100, "hello"), edited]), [edited])
+
+    def test_not_recorded_until_written(self):
+        messages = [make_message(1, -100, "hello")]
+        self.index.changed(messages)
+        self.assertEqual(self.index.changed(messages), messages)
+
+    def test_recorded_when_task_succeeds(self):
+        statuses = {}
+        client = SimpleNamespace(get_tasks=lambda query: {
+            "results": [{"uid": int(uid), "status": statuses[int(uid)]} for uid in query["uids"]]})
+        tracker = TaskTracker(client, lambda documents, retries: None, max_retries=0)
+        tracker.on_succeeded = self.index.record
+        messages = [make_message(1, -100, "hello"), make_message(2, -100, "world")]
+        for uid, message in enumerate(messages):
+            tracker.track(SimpleNamespace(task_uid=uid), [build_document(message)])
+        statuses.update({0: "succeeded", 1: "failed"})
+        tracker.poll(force=True)
+
+        # 失败后被丢弃的文档没有指纹，重新入队时仍会写入
+        self.assertEqual(self.index.changed(messages), messages[1:])
+
+    def test_recorded_when_sqlite_commits(self):
+        # SQLite 同步写入，提交后立即记录指纹
+        engine = SearchEngine(":memory:")
+        engine.tasks.on_succeeded = self.index.record
+        messages = [make_message(1, -100, "hello")]
+        engine.upsert_many(self.index.changed(messages))
+        self.assertEqual(self.index.changed(messages), [])
+
+    def test_bucket_location(self):
+        self.assertEqual(fingerprint_location(-100, 5), ("doc_hash:-100:0", 5))
+        self.assertEqual(fingerprint_location(-100, 300), ("doc_hash:-100:2", 44))
+
+
+if __name__ == '__main__':
+    unittest.main()
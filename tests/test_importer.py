@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_importer.py
+
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from importer import JsonStream, ExportImporter, merge_checkpoint
+from sync_checkpoint import Checkpoint
+from sqlite_engine import SearchEngine
+from tests.test_sync_scheduler import MemoryCheckpoints
+from utils import build_document
+
+
+def make_record(message_id, text, **fields):
+    return dict({"id": message_id, "type": "message", "date": "2024-01-01T12:00:00",
+                 "date_unixtime": str(1704110400 + message_id), "from": "Alice", "from_id": "user42",
+                 "text": text}, **fields)
+
+
+SUPERGROUP = {
+    "name": "group", "type": "private_supergroup", "id": 1234567890,
+    "messages": [
+        {"id": 1, "type": "service", "date": "2024-01-01T12:00:00", "actor": "Alice", "action": "create_group"},
+        make_record(2, "hello world"),
+        make_record(3, ["see ", {"type": "link", "text": "https://example.com"}, " 你好"]),
+        make_record(4, "a photo", photo="photos/1.jpg"),
+        make_record(5, "posted", from_id="channel1234567890"),
+    ],
+}
+
+
+class TestJsonStream(unittest.TestCase):
+    def test_small_chunks(self):
+        data = {"a": [1, 23456, {"b": "字符串"}, [True, None]], "c": -1.5e3}
+        stream = JsonStream(io.StringIO(json.dumps(data, ensure_ascii=False)), chunk_size=3)
+        parsed = {}
+        for key in stream.items():
+            if key == "a":
+                parsed[key] = [stream.value() for _ in stream.elements()]
+            else:
+                parsed[key] = stream.value()
+        self.assertEqual(parsed, data)
+
+
+class TestExportImporter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = SearchEngine(os.path.join(self.tmpdir.name, "test.db"))
+        self.checkpoints = MemoryCheckpoints()
+        self.importer = ExportImporter(self.engine, self.checkpoints, batch_size=2)
+
+    def tearDown(self):
+        self.engine.conn.close()
+        self.tmpdir.cleanup()
+
+    def write(self, data):
+        path = os.path.join(self.tmpdir.name, "result.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        return path
+
+    def test_single_chat(self):
+        self.importer.import_file(self.write(SUPERGROUP))
+        self.assertEqual(self.importer.imported, 4)
+        self.assertEqual(self.checkpoints.saved[-1001234567890], (5, 1, False))
+
+        hit = self.engine.search("example")["hits"][0]
+        self.assertEqual(hit["ID"], "-1001234567890-3")
+        self.assertEqual(hit["text"], "see https://example.com 你好")
+        self.assertEqual(hit["chat"]["type"], "ChatType.SUPERGROUP")
+        self.assertEqual(hit["from_user"]["first_name"], "Alice")
+        self.assertEqual(hit["timestamp"], 1704110403)
+        photo = self.engine.search("photo")["hits"][0]
+        self.assertEqual((photo["text"], photo["caption"]), (None, "a photo"))
+        self.assertIsNone(self.engine.search("posted")["hits"][0]["from_user"])
+
+    def test_account_export(self):
+        private = {"name": "Bob", "type": "personal_chat", "id": 777, "messages": [make_record(10, "private")]}
+        group = {"name": "old", "type": "private_group", "id": 555, "messages": [make_record(20, "basic group")]}
+        self.checkpoints.saved[-1001234567890] = (4, 3, True)
+        self.importer.import_file(self.write({
+            "about": "export", "personal_information": {"user_id": 42},
+            "chats": {"about": "chats", "list": [private, SUPERGROUP]},
+            "left_chats": {"about": "left", "list": [group]},
+        }))
+        self.assertEqual(self.importer.chats, 3)
+        self.assertEqual(self.checkpoints.saved[777], (10, 10, False))
+        self.assertEqual(self.checkpoints.saved[-555], (20, 20, False))
+        # 与已有检查点相连时合并
+        self.assertEqual(self.checkpoints.saved[-1001234567890], (5, 1, True))
+        self.assertEqual(self.engine.search("private")["hits"][0]["chat"]["title"], None)
+
+    def test_keep_checkpoint_with_gap(self):
+        self.checkpoints.saved[-1001234567890] = (100, 50, False)
+        self.importer.import_file(self.write(SUPERGROUP))
+        self.assertEqual(self.checkpoints.load(-1001234567890).high, 100)
+        self.assertEqual(self.checkpoints.saved[-1001234567890], (100, 50, False))
+
+    def test_keep_live_only_checkpoint(self):
+        # 只有实时消息推进过 high，导入的 1-5 与 100 之间可能有缺口
+        self.checkpoints.saved[-1001234567890] = (100, 0, False)
+        self.importer.import_file(self.write(SUPERGROUP))
+        self.assertEqual(self.checkpoints.saved[-1001234567890], (100, 0, False))
+
+    def test_merge_checkpoint(self):
+        def merge(checkpoint, low, high):
+            merged = merge_checkpoint(checkpoint, low, high)
+            return merged and (merged.high, merged.low, merged.backfilled)
+
+        self.assertEqual(merge(Checkpoint(), 1, 5), (5, 1, False))
+        self.assertEqual(merge(Checkpoint(100, 0, False), 1, 5), None)
+        self.assertEqual(merge(Checkpoint(3, 0, False), 1, 5), (5, 1, False))
+        self.assertEqual(merge(Checkpoint(10, 4, True), 1, 5), (10, 1, True))
+        self.assertEqual(merge(Checkpoint(100, 50, False), 1, 5), None)
+
+    def test_keep_checkpoint_when_documents_dropped(self):
+        def dropped(messages):
+            # 模拟 MeiliSearch 任务重试后仍然失败
+            self.engine.tasks.on_dropped([build_document(message) for message in messages])
+            return len(messages)
+        self.engine.upsert_many = dropped
+        self.importer.import_file(self.write(SUPERGROUP))
+        self.assertEqual(self.checkpoints.saved, {})
+
+    def test_chat_filter(self):
+        importer = ExportImporter(self.engine, self.checkpoints, is_allowed=lambda chat_id, chat_type: False)
+        importer.import_file(self.write(SUPERGROUP))
+        self.assertEqual(importer.imported, 0)
+        self.assertEqual(self.checkpoints.saved, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_message_queue.py
+
+import unittest
+
+from benchmarks.fake_redis import MemoryRedis
+from message_queue import CoalescingQueue, ListQueue, ShardedQueue, PENDING_KEY
+
+
+class TestCoalescingQueue(unittest.TestCase):
+    def setUp(self):
+        self.redis = MemoryRedis()
+        self.queue = CoalescingQueue(self.redis, ListQueue(self.redis))
+
+    def test_keep_latest_version(self):
+        self.queue.push(b"v1", "-100-1")
+        self.queue.push(b"v2", "-100-1")
+        self.queue.push(b"other", "-100-2")
+        self.assertEqual(self.queue.length(), 2)
+        self.assertEqual([payload for _, payload in self.queue.pop(10)], [b"v2", b"other"])
+
+    def test_newer_version_after_ack(self):
+        # 处理期间写入了新版本，确认旧版本后新版本重新入队
+        self.queue.push(b"v1", "-100-1")
+        handles = [handle for handle, _ in self.queue.pop(10)]
+        self.queue.push(b"v2", "-100-1")
+        self.queue.ack(handles)
+        self.assertEqual([payload for _, payload in self.queue.pop(10)], [b"v2"])
+
+    def test_newer_version_after_nack(self):
+        # 放回队列的是引用，再次取出时读到的是新版本而不是处理失败的旧版本
+        self.queue.push(b"v1", "-100-1")
+        handles = [handle for handle, _ in self.queue.pop(10)]
+        self.queue.push(b"v2", "-100-1")
+        self.queue.nack(handles)
+        entries = self.queue.pop(10)
+        self.assertEqual([payload for _, payload in entries], [b"v2"])
+        self.queue.ack([handle for handle, _ in entries])
+        self.assertEqual(self.queue.pop(10), [])
+        self.assertFalse(self.redis.hexists(PENDING_KEY, "-100-1"))
+
+    def test_without_doc_id(self):
+        self.queue.push(b"plain")
+        self.assertEqual([payload for _, payload in self.queue.pop(10)], [b"plain"])
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.timeouts = []
+
+    def pop(self, count, timeout=0):
+        self.timeouts.append(timeout)
+        return []
+
+
+class TestShardedQueue(unittest.TestCase):
+    def setUp(self):
+        self.redis = MemoryRedis()
+        self.list = ListQueue(self.redis)
+        self.queue = ShardedQueue(self.list, 2, lambda payload: payload.split(b":")[0].decode())
+
+    def test_same_document_same_shard(self):
+        for payload in (b"a:1", b"b:1", b"a:2", b"c:1"):
+            self.list.push(payload)
+        shard = self.queue._shard(b"a:1")
+        entries = self.queue.shards[shard].pop(10)
+        self.assertEqual([payload for _, payload in entries if payload.startswith(b"a:")], [b"a:1", b"a:2"])
+
+    def test_nack_keeps_order(self):
+        # 旧版本处理失败后放回分片缓冲区的最前面，不会在新版本之后再写入
+        self.list.push(b"a:1")
+        self.list.push(b"a:2")
+        shard = self.queue.shards[self.queue._shard(b"a:1")]
+        entries = shard.pop(1)
+        self.assertEqual([payload for _, payload in entries], [b"a:1"])
+        shard.nack([handle for handle, _ in entries])
+        self.assertEqual(self.list.length(), 0)
+        self.assertEqual([payload for _, payload in shard.pop(10)], [b"a:1", b"a:2"])
+
+    def test_never_block_forever(self):
+        # 传给底层队列的超时要么为 0（不阻塞），要么至少 1 毫秒
+        recording = RecordingQueue()
+        queue = ShardedQueue(recording, 2, lambda payload: "")
+        queue.shards[0].pop(1, 0.0005)
+        queue.shards[0].pop(1, 0)
+        self.assertTrue(all(timeout == 0 or timeout >= 0.001 for timeout in recording.timeouts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_metrics.py
+
+import math
+import unittest
+
+from metrics import Counter, Gauge, Histogram, Registry, summarize
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_render(self):
+        counter = self.registry.register(Counter("test_total", "Things counted"))
+        counter.inc()
+        counter.inc(2)
+        self.registry.register(Gauge("test_depth", "Queue depth", lambda: 7))
+        self.assertEqual(self.registry.render(),
+                         "# HELP test_total Things counted\n# TYPE test_total counter\ntest_total 3\n"
+                         "# HELP test_depth Queue depth\n# TYPE test_depth gauge\ntest_depth 7\n")
+
+    def test_register_returns_existing(self):
+        first = self.registry.register(Counter("test_total", "Things counted"))
+        self.assertIs(self.registry.register(Counter("test_total", "Things counted")), first)
+
+    def test_gauge_error(self):
+        def broken():
+            raise ConnectionError("redis is down")
+        self.assertTrue(math.isnan(Gauge("test_depth", "Queue depth", broken).get()))
+
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "Latency", buckets=(0.1, 1))
+        for value in (0.05, 0.05, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.samples(), [
+            ("test_seconds_bucket", '{le="0.1"}', 2),
+            ("test_seconds_bucket", '{le="1.0"}', 3),
+            ("test_seconds_bucket", '{le="+Inf"}', 4),
+            ("test_seconds_count", "", 4),
+            ("test_seconds_sum", "", 5.6),
+        ])
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.99), float("inf"))
+
+    def test_summarize(self):
+        histogram = self.registry.register(Histogram("searchgram_search_seconds", "Latency", buckets=(0.1, 1)))
+        histogram.observe(0.05)
+        self.registry.register(Counter("searchgram_upsert_errors_total", "Errors"))
+        self.assertEqual(summarize(self.registry.snapshot()),
+                         "search_seconds: 1 samples, avg 50.0ms, p50 <= 100ms, p99 <= 100ms\n"
+                         "upsert_errors_total: 0")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_queue_codec.py
+
+import json
+import unittest
+
+import queue_codec
+from queue_codec import encode_message, decode_message, VERSION_MSGPACK, VERSION_MSGPACK_ZLIB, VERSION_MSGPACK_ZSTD
+
+MESSAGE = {
+    "id": 42,
+    "chat": {"id": -1001234567890, "type": "ChatType.SUPERGROUP", "title": "group", "username": None},
+    "date": "2023-11-18T16:26:00",
+    "timestamp": 1700324760,
+    "text": "hello",
+    "caption": None,
+    "from_user": {"id": 1, "first_name": "Alice", "last_name": None, "username": "alice"},
+}
+
+
+def with_text(text):
+    return {**MESSAGE, "text": text}
+
+
+@unittest.skipIf(queue_codec.msgpack is None, "msgpack is not installed")
+class TestQueueCodec(unittest.TestCase):
+    def test_json(self):
+        payload = encode_message(MESSAGE, "json")
+        self.assertEqual(json.loads(payload), MESSAGE)
+        self.assertEqual(decode_message(payload), MESSAGE)
+        self.assertEqual(decode_message(payload.encode()), MESSAGE)
+
+    def test_msgpack(self):
+        payload = encode_message(MESSAGE, "msgpack")
+        self.assertEqual(payload[0], VERSION_MSGPACK)
+        self.assertEqual(decode_message(payload), MESSAGE)
+
+    def test_compress_long_messages(self):
+        message = with_text("long message " * 100)
+        payload = encode_message(message, "msgpack")
+        self.assertEqual(payload[0], VERSION_MSGPACK_ZLIB)
+        self.assertEqual(decode_message(payload), message)
+
+    @unittest.skipIf(queue_codec.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        message = with_text("long message " * 100)
+        payload = encode_message(message, "zstd")
+        self.assertEqual(payload[0], VERSION_MSGPACK_ZSTD)
+        self.assertEqual(decode_message(payload), message)
+
+    def test_zstd_falls_back_to_zlib(self):
+        zstandard, queue_codec.zstandard = queue_codec.zstandard, None
+        try:
+            message = with_text("long message " * 100)
+            payload = encode_message(message, "zstd")
+            self.assertEqual(payload[0], VERSION_MSGPACK_ZLIB)
+            self.assertEqual(decode_message(payload), message)
+            # 没有安装 zstandard 时无法解码，由调用方移到死信列表
+            with self.assertRaises(ValueError):
+                decode_message(bytes([VERSION_MSGPACK_ZSTD]) + b"\x28\xb5\x2f\xfd")
+        finally:
+            queue_codec.zstandard = zstandard
+
+    def test_message_without_optional_fields(self):
+        message = {**MESSAGE, "chat": {**MESSAGE["chat"], "type": "ChatType.UNKNOWN"}, "from_user": None}
+        self.assertEqual(decode_message(encode_message(message, "msgpack")), message)
+
+    def test_older_version_without_timestamp(self):
+        # 旧版本的消息没有末尾的 timestamp 字段
+        fields = queue_codec._pack(MESSAGE)[:9]
+        payload = bytes([VERSION_MSGPACK]) + queue_codec.msgpack.packb(fields, use_bin_type=True)
+        self.assertEqual(decode_message(payload), {**MESSAGE, "timestamp": None})
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            decode_message(b"\x7fdata")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_rate_control.py
+
+import threading
+import unittest
+
+from rate_control import AdaptiveRateLimiter
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    def make_limiter(self, rate=10):
+        return AdaptiveRateLimiter(rate=rate, min_rate=1, max_rate=20, increase=1, decrease=0.5, target_lag=5,
+                                   target_latency=2)
+
+    def test_additive_increase(self):
+        limiter = self.make_limiter()
+        for _ in range(10):
+            limiter.feedback(lag=0, latency=0.1)
+        # 10 个批次约为一秒，速率增加约 increase
+        self.assertAlmostEqual(limiter.rate, 11, delta=0.05)
+        for _ in range(10000):
+            limiter.feedback(lag=0)
+        self.assertEqual(limiter.rate, 20)
+
+    def test_multiplicative_decrease_once_per_interval(self):
+        limiter = self.make_limiter()
+        limiter.feedback(lag=10)
+        # 同一次拥塞被多个批次观察到，只降速一次
+        limiter.feedback(lag=10)
+        limiter.feedback(lag=0, latency=5)
+        limiter.feedback(lag=0, error=True)
+        self.assertEqual(limiter.rate, 5)
+        self.assertEqual(limiter.decreases, 1)
+
+        limiter.last_decrease -= 1
+        limiter.feedback(lag=0, error=True)
+        self.assertEqual(limiter.rate, 2.5)
+
+    def test_bounds(self):
+        limiter = self.make_limiter(rate=100)
+        self.assertEqual(limiter.rate, 20)
+        for _ in range(10):
+            limiter.last_decrease = 0
+            limiter.feedback(lag=10)
+        self.assertEqual(limiter.rate, 1)
+        limiter.reset()
+        self.assertEqual(limiter.rate, 20)
+        self.assertEqual(limiter.stats()["decreases"], 0)
+
+    def test_reserve_spaces_batches(self):
+        limiter = self.make_limiter()
+        waits = [limiter.reserve() for _ in range(5)]
+        self.assertLessEqual(waits[0], 0)
+        for previous, current in zip(waits, waits[1:]):
+            self.assertAlmostEqual(current - previous, 0.1, delta=0.01)
+
+    def test_reserve_from_threads(self):
+        # 多个写入线程共享同一个限流器，每个时间片只分配给一个批次
+        limiter = self.make_limiter(rate=20)
+        waits = []
+        lock = threading.Lock()
+
+        def reserve():
+            for _ in range(10):
+                wait = limiter.reserve()
+                with lock:
+                    waits.append(wait)
+
+        threads = [threading.Thread(target=reserve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(waits), 40)
+        self.assertGreaterEqual(max(waits), 39 / 20 - 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
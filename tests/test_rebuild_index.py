@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_rebuild_index.py
+
+import unittest
+from types import SimpleNamespace
+
+from meilisearch.models.document import Document, DocumentsResults
+
+from search_engine import SearchEngine, INDEX_NAME, REBUILD_INDEX, document_fields
+
+
+class FakeIndex:
+    def __init__(self, documents=None):
+        self.documents = documents or []
+        self.added = []
+
+    def get_documents(self, params):
+        results = self.documents[params["offset"]:params["offset"] + params["limit"]]
+        return DocumentsResults({"results": results, "offset": params["offset"], "limit": params["limit"],
+                                 "total": len(self.documents)})
+
+    def add_documents(self, documents, primary_key=None):
+        self.added.extend(documents)
+        return SimpleNamespace(task_uid=1)
+
+    def delete(self):
+        return SimpleNamespace(task_uid=1)
+
+
+class TestRebuildIndex(unittest.TestCase):
+    def test_copy_documents(self):
+        documents = [{"ID": "-100-1", "text": "hello", "chat": {"id": -100}}, {"ID": "-100-2", "text": "world"}]
+        indexes = {INDEX_NAME: FakeIndex(documents), REBUILD_INDEX: FakeIndex()}
+        engine = SearchEngine.__new__(SearchEngine)
+        engine.client = SimpleNamespace(
+            index=lambda uid: indexes[uid],
+            get_task=lambda uid: {"status": "succeeded"},
+            swap_indexes=lambda swaps: SimpleNamespace(task_uid=2),
+        )
+        engine.ensure_index_exists = lambda uid=INDEX_NAME: None
+        engine.reconcile_settings = lambda uid=INDEX_NAME: None
+
+        self.assertEqual(engine.rebuild_index(batch_size=1), 2)
+        # 复制的是原始字段，不包括 Document 的私有属性
+        self.assertEqual(indexes[REBUILD_INDEX].added, documents)
+
+    def test_document_fields(self):
+        self.assertEqual(document_fields(Document({"ID": "-100-1", "text": "hello"})),
+                         {"ID": "-100-1", "text": "hello"})
+
+
+if __name__ == '__main__':
+    unittest.main()
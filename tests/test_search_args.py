@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_search_args.py
+
+import argparse
+import unittest
+from datetime import datetime
+
+from export import add_filter_arguments
+from utils import parse_date
+
+
+def build_parser():
+    # 与 bot.py 中的搜索参数相同
+    parser = argparse.ArgumentParser()
+    parser.add_argument("keyword")
+    add_filter_arguments(parser)
+    return parser
+
+
+class TestSearchArgs(unittest.TestCase):
+    def test_since_until(self):
+        args = build_parser().parse_args("--since=2024-01-01 --until=2024-01-31 message".split())
+        self.assertEqual(args.since, int(datetime(2024, 1, 1).timestamp()))
+        self.assertEqual(args.until, int(datetime(2024, 2, 1).timestamp()) - 1)
+        self.assertEqual(args.keyword, "message")
+
+    def test_since_timestamp(self):
+        args = build_parser().parse_args("--since=1704067200 --until=2024-01-31T12:00 message".split())
+        self.assertEqual(args.since, 1704067200)
+        self.assertEqual(args.until, int(datetime(2024, 1, 31, 12, 0).timestamp()))
+
+    def test_invalid_date(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_date("yesterday")
+
+
+if __name__ == '__main__':
+    unittest.main()
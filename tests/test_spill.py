@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_spill.py
+
+import os
+import tempfile
+import time
+import unittest
+
+import redis
+
+from benchmarks.fake_redis import MemoryRedis
+from message_queue import ListQueue, SpillingQueue
+from spill import SpillLog
+
+
+class FlakyRedis(MemoryRedis):
+    down = False
+
+    def lpush(self, *args):
+        if self.down:
+            raise redis.ConnectionError("down")
+        return super().lpush(*args)
+
+    def llen(self, *args):
+        if self.down:
+            raise redis.ConnectionError("down")
+        return super().llen(*args)
+
+
+class TestSpillLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_read_in_order_across_segments(self):
+        log = SpillLog(self.tmpdir.name, segment_size=100, fsync_interval=0)
+        for i in range(20):
+            log.append(f"payload{i}".encode(), f"doc{i}" if i % 2 else None)
+        records, position = log.read(15)
+        self.assertEqual(records[0], (None, b"payload0"))
+        self.assertEqual(records[1], ("doc1", b"payload1"))
+        log.commit(position, len(records))
+        log.close()
+
+        log = SpillLog(self.tmpdir.name, segment_size=100)
+        self.assertEqual(len(log), 5)
+        records, _ = log.read(100)
+        self.assertEqual([payload for _, payload in records], [f"payload{i}".encode() for i in range(15, 20)])
+
+    def test_truncate_torn_record(self):
+        log = SpillLog(self.tmpdir.name, fsync_interval=0)
+        log.append(b"complete", "doc")
+        log.close()
+        with open(os.path.join(self.tmpdir.name, "spill-0000000000.log"), "ab") as f:
+            f.write(b"\x00\x00\x00\x10torn")
+
+        log = SpillLog(self.tmpdir.name)
+        self.assertEqual(len(log), 1)
+        log.append(b"next", "doc2")
+        records, _ = log.read(10)
+        self.assertEqual(records, [("doc", b"complete"), ("doc2", b"next")])
+
+    def test_records_survive_without_close(self):
+        # 进程被杀死时还没有 close，已追加的记录也要能读回
+        log = SpillLog(self.tmpdir.name, fsync_interval=60)
+        for i in range(20):
+            log.append(f"payload{i}".encode(), f"doc{i}")
+        self.assertEqual(len(SpillLog(self.tmpdir.name)), 20)
+        log.close()
+
+    def test_fsync_when_idle(self):
+        log = SpillLog(self.tmpdir.name, fsync_interval=0.05)
+        log.append(b"first", "doc1")
+        log.append(b"second", "doc2")
+        self.assertTrue(log.dirty)
+        time.sleep(0.3)
+        self.assertFalse(log.dirty)
+        log.close()
+
+
+class TestSpillingQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.redis = FlakyRedis()
+        self.queue = SpillingQueue(ListQueue(self.redis), SpillLog(self.tmpdir.name), high_water=10, low_water=5,
+                                   check_interval=0)
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmpdir.cleanup()
+
+    def drain(self):
+        payloads = []
+        while entries := self.queue.pop(3):
+            payloads.extend(int(payload) for _, payload in entries)
+        return payloads
+
+    def test_spill_above_high_water(self):
+        for i in range(30):
+            self.queue.push(str(i).encode())
+        self.assertEqual(self.redis.llen("message_queue"), 10)
+        self.assertEqual(len(self.queue.spill), 20)
+        self.assertEqual(self.drain(), list(range(30)))
+        self.assertEqual(len(self.queue.spill), 0)
+
+    def test_spill_while_redis_is_down(self):
+        self.redis.down = True
+        for i in range(5):
+            self.queue.push(str(i).encode())
+        self.redis.down = False
+        self.queue.push(b"5")
+        self.assertEqual(len(self.queue.spill), 6)
+        self.assertEqual(self.drain(), list(range(6)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_sqlite_engine.py
+
+import os
+import tempfile
+import unittest
+
+from sqlite_engine import SearchEngine
+
+
+def make_message(message_id, chat_id, text, user_id=1, chat_type="ChatType.GROUP"):
+    return {
+        "id": message_id,
+        "chat": {"id": chat_id, "type": chat_type, "title": "group", "username": None},
+        "date": "2024-01-01T12:00:00",
+        "timestamp": 1704110400 + message_id,
+        "text": text,
+        "caption": None,
+        "from_user": {"id": user_id, "first_name": "first", "last_name": None, "username": None},
+    }
+
+
+class TestSQLiteEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = SearchEngine(os.path.join(self.tmpdir.name, "test.db"))
+        self.engine.upsert_many([
+            make_message(1, -100, "你好世界 hello world"),
+            make_message(2, -100, "世界和平"),
+            make_message(3, -200, "hello there", user_id=2),
+        ])
+
+    def tearDown(self):
+        self.engine.conn.close()
+        self.tmpdir.cleanup()
+
+    def test_cjk(self):
+        result = self.engine.search("世界")
+        self.assertEqual(result["totalHits"], 2)
+        self.assertEqual([hit["ID"] for hit in result["hits"]], ["-100-2", "-100-1"])
+        self.assertEqual(self.engine.search("好世")["totalHits"], 1)
+
+    def test_prefix_and_filters(self):
+        self.assertEqual(self.engine.search("hel")["totalHits"], 2)
+        self.assertEqual(self.engine.search("hello", user="-200")["totalHits"], 1)
+        self.assertEqual(self.engine.search("hello", since=1704110403)["totalHits"], 1)
+
+    def test_exact(self):
+        self.assertEqual(self.engine.search("hello world", mode="e")["totalHits"], 1)
+        self.assertEqual(self.engine.search("world hello", mode="e")["totalHits"], 0)
+
+    def test_upsert_replaces(self):
+        self.engine.upsert(make_message(2, -100, "edited"))
+        self.assertEqual(self.engine.search("世界")["totalHits"], 1)
+        self.assertEqual(self.engine.search("edited")["totalHits"], 1)
+
+    def test_delete(self):
+        self.assertEqual(self.engine.delete_messages(user_id=2), "Deleted 1 messages")
+        self.assertEqual(self.engine.delete_messages(chat_id=-100), "Deleted 2 messages")
+        self.assertEqual(self.engine.search("")["totalHits"], 0)
+
+    def test_punctuation_only(self):
+        # 没有可搜索的词时不返回所有消息
+        self.assertEqual(self.engine.search("!!!")["totalHits"], 0)
+        self.assertEqual(self.engine.search("!!!", mode="e")["totalHits"], 0)
+        self.assertEqual(list(self.engine.iter_documents("!!!")), [])
+
+    def test_iter_documents(self):
+        # 时间戳相同的消息跨越批次边界时不重复也不遗漏
+        self.engine.upsert_many([make_message(i, -300, f"bulk {i}") for i in range(10, 20)])
+        self.engine.upsert_many([dict(make_message(i, -400, "same second"), timestamp=1) for i in range(5)])
+        ids = [document["ID"] for document in self.engine.iter_documents(batch_size=3)]
+        self.assertEqual(len(ids), 18)
+        self.assertEqual(len(set(ids)), 18)
+        self.assertEqual(ids[0], "-300-19")
+        self.assertEqual(len(list(self.engine.iter_documents("bulk", user="-300", batch_size=4))), 10)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_sync_config.py
+
+import os
+import tempfile
+import unittest
+
+from sync_config import ChatFilter, load_config, save_config
+
+
+class TestChatFilter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "sync.ini")
+        self.filter = ChatFilter(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, whitelist=(), blacklist=()):
+        config = load_config(self.path)
+        for section, options in (("whitelist", whitelist), ("blacklist", blacklist)):
+            config.remove_section(section)
+            config.add_section(section)
+            for option in options:
+                config.set(section, option, None)
+        save_config(config, self.path)
+
+    def test_allow_all_without_file(self):
+        self.assertTrue(self.filter.is_allowed(-100, "ChatType.GROUP"))
+
+    def test_whitelist(self):
+        self.write(whitelist=["-100", "`ChatType.PRIVATE`"], blacklist=["-200"])
+        self.assertTrue(self.filter.is_allowed(-100, "ChatType.GROUP"))
+        self.assertTrue(self.filter.is_allowed(5, "ChatType.PRIVATE"))
+        # 有白名单时忽略黑名单
+        self.assertFalse(self.filter.is_allowed(-200, "ChatType.GROUP"))
+        self.assertFalse(self.filter.is_allowed(-300, "ChatType.CHANNEL"))
+
+    def test_blacklist(self):
+        self.write(blacklist=["-200", "`ChatType.CHANNEL`"])
+        self.assertTrue(self.filter.is_allowed(-100, "ChatType.GROUP"))
+        self.assertFalse(self.filter.is_allowed(-200, "ChatType.GROUP"))
+        self.assertFalse(self.filter.is_allowed(-300, "ChatType.CHANNEL"))
+
+    def test_reload_on_change(self):
+        self.write(blacklist=["-200"])
+        self.assertFalse(self.filter.is_allowed(-200, "ChatType.GROUP"))
+        signature = self.filter.signature
+        # 文件没有变化时不重新解析
+        self.filter.is_allowed(-200, "ChatType.GROUP")
+        self.assertEqual(self.filter.signature, signature)
+
+        self.write()
+        self.assertTrue(self.filter.is_allowed(-200, "ChatType.GROUP"))
+
+    def test_save_keeps_permissions(self):
+        self.write()
+        os.chmod(self.path, 0o644)
+        self.write(blacklist=["-200"])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+
+if __name__ == '__main__':
+    unittest.main()
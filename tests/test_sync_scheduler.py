@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_sync_scheduler.py
+
+import datetime
+import unittest
+from types import SimpleNamespace
+
+from sync_checkpoint import Checkpoint, legacy_checkpoint
+from sync_scheduler import SyncScheduler, ChatSync, RequestBudget, GapFill
+
+
+class FakeApp:
+    def __init__(self, top_id, fail_after=None):
+        self.top_id = top_id
+        self.fail_after = fail_after
+        self.served = 0
+
+    def get_chat_history(self, chat_id, limit=0, offset_id=0):
+        start = offset_id - 1 if offset_id else self.top_id
+        for message_id in range(start, max(start - limit, 0), -1):
+            if self.fail_after is not None and self.served >= self.fail_after:
+                raise ConnectionError("connection lost")
+            self.served += 1
+            yield SimpleNamespace(id=message_id)
+
+
+def make_dialog(chat_id, top_id, date, pinned=False):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id, type="ChatType.GROUP"), is_pinned=pinned,
+                           top_message=SimpleNamespace(id=top_id, date=datetime.datetime.fromtimestamp(date)))
+
+
+class FakeDialogsApp:
+    def __init__(self, dialogs):
+        self.dialogs = dialogs
+        self.history_requests = []
+
+    def get_dialogs(self, limit=0):
+        return iter(self.dialogs[:limit])
+
+    def get_chat_history(self, chat_id, limit=0, offset_id=0):
+        self.history_requests.append(chat_id)
+        top_id = next(dialog.top_message.id for dialog in self.dialogs if dialog.chat.id == chat_id)
+        return FakeApp(top_id).get_chat_history(chat_id, limit, offset_id)
+
+
+class MemoryCheckpoints:
+    def __init__(self):
+        self.saved = {}
+
+    def load(self, chat_id):
+        high, low, backfilled = self.saved.get(chat_id, (0, 0, False))
+        return Checkpoint(high, low, backfilled)
+
+    def save(self, chat_id, checkpoint):
+        self.saved[chat_id] = (checkpoint.high, checkpoint.low, checkpoint.backfilled)
+
+
+class TestSyncScheduler(unittest.TestCase):
+    def sync(self, app, checkpoints):
+        enqueued = []
+        scheduler = SyncScheduler(app, lambda msg: enqueued.append(msg.id), checkpoints, budget=RequestBudget(1000),
+                                  concurrency=1, chunk_size=250)
+        scheduler.add(ChatSync("1", 1, checkpoints.load(1)))
+        scheduler.run()
+        return enqueued
+
+    def test_resume_backfill_after_crash(self):
+        checkpoints = MemoryCheckpoints()
+        first = self.sync(FakeApp(1000, fail_after=420), checkpoints)
+        self.assertEqual(first, list(range(1000, 580, -1)))
+        self.assertEqual(checkpoints.saved[1], (1000, 581, False))
+
+        # 重启后从中断的位置继续，不会重复入队
+        second = self.sync(FakeApp(1000), checkpoints)
+        self.assertEqual(second, list(range(580, 0, -1)))
+        self.assertEqual(checkpoints.saved[1], (1000, 1, True))
+
+    def test_catch_up_new_messages(self):
+        checkpoints = MemoryCheckpoints()
+        checkpoints.saved[1] = (1000, 1, True)
+        enqueued = self.sync(FakeApp(1030), checkpoints)
+        self.assertEqual(enqueued, list(range(1030, 1000, -1)))
+        self.assertEqual(checkpoints.saved[1], (1030, 1, True))
+
+    def test_catch_up_before_resuming_backfill(self):
+        checkpoints = MemoryCheckpoints()
+        checkpoints.saved[1] = (1000, 900, False)
+        enqueued = self.sync(FakeApp(1010), checkpoints)
+        self.assertEqual(enqueued, list(range(1010, 1000, -1)) + list(range(899, 0, -1)))
+        self.assertEqual(checkpoints.saved[1], (1010, 1, True))
+
+    def test_resumed_backfill_remaining(self):
+        # 继续回填的聊天没有消息总数，按 low 估算剩余的消息，小聊天仍然优先
+        small = ChatSync("1", 1, Checkpoint(0, 50, False))
+        large = ChatSync("2", 2, Checkpoint(0, 0, False), total=10000)
+        self.assertEqual(small.remaining(), 50)
+        self.assertLess(small, large)
+        self.assertEqual(ChatSync("3", 3, Checkpoint(1000, 1, True)).remaining(), 0)
+
+    def test_resume_legacy_sync(self):
+        # 旧版本中断在 900，迁移后先补齐 900 之后的消息，再继续回填
+        checkpoints = MemoryCheckpoints()
+        checkpoint = legacy_checkpoint(0, {"completed": False, "last_id": 900})
+        checkpoints.save(1, checkpoint)
+        enqueued = self.sync(FakeApp(1010), checkpoints)
+        self.assertEqual(enqueued, list(range(1010, 900, -1)) + list(range(899, 0, -1)))
+        self.assertEqual(checkpoints.saved[1], (1010, 1, True))
+
+    def test_legacy_checkpoint(self):
+        completed = legacy_checkpoint(5, {"completed": True, "last_id": 5}, head_id=1200)
+        self.assertEqual((completed.high, completed.low, completed.backfilled), (1200, 5, True))
+        # 只有 last_synced 而没有 sync_status.json 记录，说明同步已经完成
+        self.assertTrue(legacy_checkpoint(5, {}, head_id=1200).backfilled)
+        self.assertIsNone(legacy_checkpoint(0, {}))
+
+
+class TestGapFill(unittest.TestCase):
+    def test_fill_only_new_messages(self):
+        checkpoints = MemoryCheckpoints()
+        checkpoints.saved = {1: (100, 1, True), 2: (50, 0, False), 3: (70, 0, False), 4: (10, 0, False)}
+        app = FakeDialogsApp([
+            make_dialog(4, 12, 0, pinned=True),
+            make_dialog(1, 105, 2000),
+            make_dialog(5, 40, 1900),
+            make_dialog(2, 50, 1800),
+            make_dialog(3, 90, 900),
+        ])
+        enqueued = []
+        filler = GapFill(app, lambda msg: enqueued.append(msg.id), checkpoints, lambda chat_id, chat_type: True,
+                         RequestBudget(1000), max_dialogs=10, max_messages=3)
+        filler.run(since=1000)
+
+        # 没有检查点或没有新消息的聊天不请求历史，上次在线之前就不活跃的对话不再检查
+        self.assertEqual(app.history_requests, [4, 1])
+        self.assertEqual(enqueued, [12, 11, 105, 104, 103])
+        self.assertEqual(checkpoints.saved[1], (105, 1, True))
+        self.assertEqual(checkpoints.saved[3], (70, 0, False))
+        self.assertEqual(filler.dialogs, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# SearchGram - test_task_tracker.py
+
+import unittest
+from types import SimpleNamespace
+
+from search_engine import TaskTracker
+
+
+class TestTaskTracker(unittest.TestCase):
+    def setUp(self):
+        self.statuses = {}
+        client = SimpleNamespace(get_tasks=lambda query: {
+            "results": [{"uid": int(uid), "status": self.statuses[int(uid)]} for uid in query["uids"]]})
+        self.resubmitted = []
+        self.tracker = TaskTracker(client, self.resubmit)
+
+    def resubmit(self, documents, retries):
+        self.resubmitted.append([document["ID"] for document in documents])
+        return SimpleNamespace(task_uid=100)
+
+    def test_resubmit_failed(self):
+        self.tracker.track(SimpleNamespace(task_uid=0), [{"ID": "1-1"}, {"ID": "1-2"}])
+        self.statuses[0] = "failed"
+        self.tracker.poll(force=True)
+        self.assertEqual(self.resubmitted, [["1-1", "1-2"]])
+
+    def test_skip_newer_versions(self):
+        # 失败任务之后又提交了 1-1 的新版本，重试时不能用旧版本覆盖它
+        self.tracker.track(SimpleNamespace(task_uid=0), [{"ID": "1-1"}, {"ID": "1-2"}])
+        self.tracker.track(SimpleNamespace(task_uid=1), [{"ID": "1-1"}])
+        self.statuses.update({0: "failed", 1: "succeeded"})
+        self.tracker.poll(force=True)
+        self.assertEqual(self.resubmitted, [["1-2"]])
+        self.assertEqual(self.tracker.versions, {})
+
+    def test_poll_error(self):
+        from meilisearch.errors import MeiliSearchCommunicationError
+
+        def get_tasks(query):
+            raise MeiliSearchCommunicationError("connection refused")
+
+        self.tracker.client = SimpleNamespace(get_tasks=get_tasks)
+        self.tracker.track(SimpleNamespace(task_uid=0), [{"ID": "1-1"}])
+        self.tracker.poll(force=True)
+        self.assertEqual(self.tracker.lag(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
 #!/usr/local/bin/python3
 # coding: utf-8
 
+import argparse
 import logging
+import threading
 import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
 import coloredlogs
 
 def setup_logger():
@@ -19,23 +24,54 @@ def sizeof_fmt(num: int, suffix="B"):
         num /= 1024.0
     return "%.1f%s%s" % (num, "Yi", suffix)
 
+def to_epoch(date):
+    return int(datetime.fromisoformat(date).timestamp())
+
+def parse_date(value, end_of_day=False):
+    # 支持 Unix 时间戳、YYYY-MM-DD 和 YYYY-MM-DDTHH:MM[:SS]
+    if value.isdigit():
+        return int(value)
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {value}")
+    if end_of_day and len(value) == 10:
+        date += timedelta(days=1, seconds=-1)
+    return int(date.timestamp())
+
+def build_document(message):
+    # 由队列中的消息构建索引文档，所有搜索引擎使用相同的结构
+    return {
+        "ID": f"{message['chat']['id']}-{message['id']}",
+        "message_id": message['id'],
+        "chat": message['chat'],
+        "date": message['date'],
+        "text": message.get('text', ''),
+        "caption": message.get('caption', ''),
+        "from_user": message.get('from_user', {}),
+        # 数字形式的时间戳，用于排序和按时间范围筛选
+        "timestamp": message.get('timestamp') or to_epoch(message['date'])
+    }
+
 class TokenBucket:
     def __init__(self, tokens, fill_rate):
         self.capacity = tokens
         self.tokens = tokens
         self.fill_rate = fill_rate
         self.timestamp = time.time()
+        self.lock = threading.Lock()
 
     def consume(self, tokens):
-        now = time.time()
-        self.tokens += (now - self.timestamp) * self.fill_rate
-        if self.tokens > self.capacity:
-            self.tokens = self.capacity
-        self.timestamp = now
-        if self.tokens >= tokens:
-            self.tokens -= tokens
-            return True
-        return False
+        with self.lock:
+            now = time.time()
+            self.tokens += (now - self.timestamp) * self.fill_rate
+            if self.tokens > self.capacity:
+                self.tokens = self.capacity
+            self.timestamp = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
 
 def rate_limit(seconds):
     def decorator(func):
@@ -47,4 +83,38 @@ def rate_limit(seconds):
             last_called[func] = now
             return func(*args, **kwargs)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+class TTLCache:
+    """LRU 缓存，条目超过 ttl 秒后失效"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.time() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()